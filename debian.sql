@@ -11,6 +11,44 @@ CREATE TABLE debian_build (
 CREATE INDEX ON debian_build (run_id);
 CREATE INDEX ON debian_build (distribution, source, version);
 
+-- Let the scheduler know that cached dependency availability for this
+-- source is stale.
+CREATE OR REPLACE FUNCTION debian_build_trigger_notify()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    PERFORM pg_notify('debian_build', NEW.source);
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER debian_build_notify
+  AFTER INSERT
+  ON debian_build
+  FOR EACH ROW
+  EXECUTE PROCEDURE debian_build_trigger_notify();
+
+-- The archive versions of packages are also included in
+-- all_debian_versions; let the scheduler know when they change.
+CREATE OR REPLACE FUNCTION package_trigger_notify_archive_version()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP = 'INSERT' OR NEW.archive_version IS DISTINCT FROM OLD.archive_version THEN
+        PERFORM pg_notify('debian_archive_version', NEW.name);
+    END IF;
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER package_notify_archive_version
+  AFTER INSERT OR UPDATE OF archive_version
+  ON package
+  FOR EACH ROW
+  EXECUTE PROCEDURE package_trigger_notify_archive_version();
+
 
 CREATE OR REPLACE VIEW debian_run AS
 SELECT
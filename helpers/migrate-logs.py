@@ -20,6 +20,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument(
     '--config', type=str, default='janitor.conf',
     help='Path to configuration.')
+parser.add_argument(
+    '--seekable-logs', action='store_true',
+    help='Store logs in a block-compressed format with a line index')
 parser.add_argument('from_location', type=str, nargs=1)
 parser.add_argument('to_location', type=str, nargs=1)
 args = parser.parse_args()
@@ -28,7 +31,7 @@ with open(args.config, 'r') as f:
     config = read_config(f)
 
 from_manager = get_log_manager(args.from_location)
-to_manager = get_log_manager(args.to_location)
+to_manager = get_log_manager(args.to_location, seekable=args.seekable_logs)
 
 
 async def reprocess_run(pool, package, log_id, logfilenames):
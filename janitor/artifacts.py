@@ -17,21 +17,61 @@
 
 """Artifacts."""
 
-from typing import Optional, List
+from typing import AsyncIterator, Dict, Optional, List, Tuple
 import asyncio
 
-from io import BytesIO
+from contextlib import asynccontextmanager
+import errno
+import hashlib
+import json
 import logging
 import os
 import shutil
 import tempfile
 
-from aiohttp import ClientSession, ClientResponseError
+from aiohttp import (
+    ClientPayloadError,
+    ClientResponseError,
+    ClientSession,
+    ServerDisconnectedError,
+)
+from aiohttp_openmetrics import Counter, Histogram
 from yarl import URL
 
+from .compat import to_thread
+
 
 DEFAULT_GCS_TIMEOUT = 60
 
+# Maximum number of artifacts to upload at once.
+DEFAULT_MAX_CONCURRENT_UPLOADS = 8
+
+# Maximum number of artifacts to download at once.
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 8
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Artifacts retrieved through get_artifact are spooled to disk above this size.
+ARTIFACT_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Number of attempts for downloading a single artifact.
+DOWNLOAD_ATTEMPTS = 3
+
+
+# Content-addressed storage: blobs are stored once under BLOB_PREFIX,
+# named by their SHA-256. Each run only stores a manifest mapping
+# artifact names to blobs.
+BLOB_PREFIX = "_blobs"
+MANIFEST_NAME = ".manifest.json"
+MANIFEST_VERSION = 1
+
+
+artifact_upload_duration = Histogram(
+    "artifact_upload_duration", "Time spent uploading a single artifact")
+artifact_blobs_reused = Counter(
+    "artifact_blobs_reused",
+    "Number of artifacts whose contents were already stored")
+
 
 class ServiceUnavailable(Exception):
     """The remote server is temporarily unavailable."""
@@ -41,6 +81,74 @@ class ArtifactsMissing(Exception):
     """The specified artifacts are missing."""
 
 
+# ioctl to share data blocks between two files (Linux).
+FICLONE = 0x40049409
+
+
+def _clone_file(src: str, dst: str) -> None:
+    """Copy a file, sharing data blocks with the original if possible.
+
+    On filesystems that support reflinks (btrfs, xfs) this is a cheap
+    copy-on-write clone; otherwise it falls back to a regular copy.
+    """
+    try:
+        import fcntl
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (ImportError, OSError):
+        shutil.copy(src, dst)
+    else:
+        shutil.copymode(src, dst)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """Hardlink a file, falling back to a copy across filesystems.
+
+    The caller must not modify either file in place afterwards.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        os.unlink(dst)
+        _link_or_copy(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        _clone_file(src, dst)
+
+
+def _hash_file(path: str) -> Tuple[str, int]:
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+def _hash_artifacts(local_path: str, names: List[str]) -> Dict[str, Dict]:
+    ret = {}
+    for name in names:
+        digest, size = _hash_file(os.path.join(local_path, name))
+        ret[name] = {"sha256": digest, "size": size}
+    return ret
+
+
+def _parse_manifest(data: bytes) -> Dict[str, Dict]:
+    manifest = json.loads(data)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(
+            "unsupported manifest version %r" % manifest.get("version"))
+    return manifest["artifacts"]
+
+
+def _serialize_manifest(artifacts: Dict[str, Dict]) -> bytes:
+    return json.dumps(
+        {"version": MANIFEST_VERSION, "artifacts": artifacts},
+        sort_keys=True).encode("utf-8")
+
+
 class ArtifactManager(object):
     """Manage sets of per-run artifacts.
 
@@ -54,21 +162,81 @@ class ArtifactManager(object):
           local_path: Local path to retrieve files from
           names: Optional list of filenames in local_path to upload.
             Defaults to all files in local_path.
+        Returns:
+          the sizes and sha256 of the stored artifacts, if they were
+          computed while storing them; otherwise None
         """
         raise NotImplementedError(self.store_artifacts)
 
     async def get_artifact(self, run_id, filename, timeout=None):
         raise NotImplementedError(self.get_artifact)
 
+    async def iter_artifact(
+        self, run_id, filename, chunk_size=DEFAULT_CHUNK_SIZE, timeout=None
+    ) -> AsyncIterator[bytes]:
+        """Iterate over the contents of an artifact.
+
+        Raises:
+          FileNotFoundError: if the artifact does not exist
+        """
+        f = await self.get_artifact(run_id, filename, timeout=timeout)
+        with f:
+            while True:
+                chunk = await to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
     def public_artifact_url(self, run_id, filename):
         raise NotImplementedError(self.public_artifact_url)
 
     async def retrieve_artifacts(
-        self, run_id, local_path, filter_fn=None, timeout=None
+        self, run_id, local_path, filter_fn=None, timeout=None, manifest=None
     ):
+        """Retrieve the artifacts of a run.
+
+        Args:
+          run_id: The run id
+          local_path: Local path to write files to
+          filter_fn: Optional callable to filter artifact names
+          timeout: Timeout
+          manifest: Optional recorded manifest for the run (see
+            store_artifacts_with_backup); allows the artifacts to be
+            found without listing the store
+        Raises:
+          ArtifactsMissing: if there are no artifacts for the run
+        """
         raise NotImplementedError(self.retrieve_artifacts)
 
+    @asynccontextmanager
+    async def artifact_paths(
+        self, run_id, filter_fn=None, timeout=None, manifest=None
+    ) -> AsyncIterator[List[Tuple[str, str]]]:
+        """Provide local paths for the artifacts of a run.
+
+        The paths are only valid within the context and must be treated
+        as read-only; where possible they refer to the stored artifacts
+        directly rather than to copies.
+
+        Returns:
+          list of (name, path) tuples, sorted by name
+        Raises:
+          ArtifactsMissing: if there are no artifacts for the run
+        """
+        with tempfile.TemporaryDirectory() as td:
+            await self.retrieve_artifacts(
+                run_id, td, filter_fn=filter_fn, timeout=timeout,
+                manifest=manifest)
+            yield sorted(
+                (entry.name, entry.path) for entry in os.scandir(td))
+
     async def iter_ids(self):
+        """Iterate over the ids of runs with artifacts in this store.
+
+        This lists the store, which can be slow. The artifact table in the
+        database records the same information (see
+        janitor.state.get_artifact_run_ids).
+        """
         raise NotImplementedError(self.iter_ids)
 
     async def __aenter__(self):
@@ -79,14 +247,49 @@ class ArtifactManager(object):
 
 
 class LocalArtifactManager(ArtifactManager):
-    def __init__(self, path):
+    def __init__(self, path, content_addressed=False):
         self.path = os.path.abspath(path)
+        self.content_addressed = content_addressed
         if not os.path.isdir(self.path):
             os.makedirs(self.path)
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, self.path)
 
+    def _blob_path(self, digest):
+        return os.path.join(self.path, BLOB_PREFIX, digest[:2], digest)
+
+    def _read_manifest(self, run_id):
+        try:
+            with open(os.path.join(self.path, run_id, MANIFEST_NAME), "rb") as f:
+                return _parse_manifest(f.read())
+        except FileNotFoundError:
+            return None
+
+    def _store_blob(self, path, digest):
+        blob_path = self._blob_path(digest)
+        if os.path.exists(blob_path):
+            artifact_blobs_reused.inc()
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+        os.close(fd)
+        _link_or_copy(path, tmp_path)
+        os.replace(tmp_path, blob_path)
+
+    def _store_content_addressed(self, run_id, local_path, names):
+        artifacts = self._read_manifest(run_id) or {}
+        hashes = _hash_artifacts(local_path, names)
+        for name, entry in hashes.items():
+            with artifact_upload_duration.time():
+                self._store_blob(os.path.join(local_path, name), entry["sha256"])
+        artifacts.update(hashes)
+        manifest_path = os.path.join(self.path, run_id, MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "wb") as f:
+            f.write(_serialize_manifest(artifacts))
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return hashes
+
     async def store_artifacts(self, run_id, local_path, names=None, timeout=None):
         run_dir = os.path.join(self.path, run_id)
         try:
@@ -95,39 +298,92 @@ class LocalArtifactManager(ArtifactManager):
             pass
         if names is None:
             names = os.listdir(local_path)
+        if self.content_addressed:
+            return await to_thread(
+                self._store_content_addressed, run_id, local_path, names)
         for name in names:
-            shutil.copy(os.path.join(local_path, name), os.path.join(run_dir, name))
+            with artifact_upload_duration.time():
+                _link_or_copy(os.path.join(local_path, name), os.path.join(run_dir, name))
 
     async def iter_ids(self):
         for entry in os.scandir(self.path):
+            if entry.name == BLOB_PREFIX:
+                continue
             yield entry.name
 
     async def delete_artifacts(self, run_id):
+        # Blobs may be shared with other runs, so they are left in place.
         shutil.rmtree(os.path.join(self.path, run_id))
 
     async def get_artifact(self, run_id, filename, timeout=None):
+        artifacts = self._read_manifest(run_id)
+        if artifacts is not None and filename in artifacts:
+            return open(self._blob_path(artifacts[filename]["sha256"]), "rb")
         return open(os.path.join(self.path, run_id, filename), "rb")
 
     def public_artifact_url(self, run_id, filename):
         raise NotImplementedError(self.public_artifact_url)
 
     async def retrieve_artifacts(
-        self, run_id, local_path, filter_fn=None, timeout=None
+        self, run_id, local_path, filter_fn=None, timeout=None, manifest=None
     ):
         run_path = os.path.join(self.path, run_id)
         if not os.path.isdir(run_path):
             raise ArtifactsMissing(run_id)
         for entry in os.scandir(run_path):
+            if entry.name == MANIFEST_NAME:
+                continue
             if filter_fn is not None and not filter_fn(entry.name):
                 continue
-            shutil.copy(entry.path, os.path.join(local_path, entry.name))
+            _clone_file(entry.path, os.path.join(local_path, entry.name))
+        for name, entry in (self._read_manifest(run_id) or {}).items():
+            if filter_fn is not None and not filter_fn(name):
+                continue
+            _clone_file(
+                self._blob_path(entry["sha256"]), os.path.join(local_path, name))
+
+    @asynccontextmanager
+    async def artifact_paths(
+        self, run_id, filter_fn=None, timeout=None, manifest=None
+    ):
+        run_path = os.path.join(self.path, run_id)
+        if not os.path.isdir(run_path):
+            raise ArtifactsMissing(run_id)
+        ret = {}
+        for entry in os.scandir(run_path):
+            if entry.name == MANIFEST_NAME:
+                continue
+            if filter_fn is not None and not filter_fn(entry.name):
+                continue
+            ret[entry.name] = entry.path
+        artifacts = self._read_manifest(run_id)
+        if not artifacts:
+            yield sorted(ret.items())
+            return
+        # Blobs are not named after the artifact, which some tools (e.g.
+        # debdiff) rely on; link them into a directory under the original
+        # names instead.
+        with tempfile.TemporaryDirectory(
+                dir=os.path.join(self.path, BLOB_PREFIX)) as td:
+            for name, entry in artifacts.items():
+                if filter_fn is not None and not filter_fn(name):
+                    continue
+                ret[name] = os.path.join(td, name)
+                _link_or_copy(self._blob_path(entry["sha256"]), ret[name])
+            yield sorted(ret.items())
 
 
 class GCSArtifactManager(ArtifactManager):
-    def __init__(self, location, creds_path=None, trace_configs=None):
+    def __init__(self, location, creds_path=None, trace_configs=None,
+                 max_concurrent_uploads=DEFAULT_MAX_CONCURRENT_UPLOADS,
+                 max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+                 content_addressed=False):
         self.bucket_name = URL(location).host
         self.creds_path = creds_path
         self.trace_configs = trace_configs
+        self.max_concurrent_uploads = max_concurrent_uploads
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.content_addressed = content_addressed
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, "gs://%s/" % self.bucket_name)
@@ -144,25 +400,114 @@ class GCSArtifactManager(ArtifactManager):
         await self.session.__aexit__(exc_type, exc, tb)
         return False
 
+    async def _download(self, object_name, timeout):
+        return await self.storage.download(
+            bucket=self.bucket_name, object_name=object_name, timeout=timeout)
+
+    async def _download_stream(self, object_name, timeout):
+        return await self.storage.download_stream(
+            self.bucket_name, object_name, session=self.session,
+            timeout=timeout)
+
+    async def _download_to_file(self, object_name, path, timeout):
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                stream = await self._download_stream(object_name, timeout)
+                async with stream:
+                    with open(path, "wb") as f:
+                        while True:
+                            chunk = await stream.read(DEFAULT_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            await to_thread(f.write, chunk)
+                return
+            except ClientResponseError as e:
+                if e.status < 500 or attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                error = e
+            except (ClientPayloadError, ServerDisconnectedError,
+                    asyncio.TimeoutError) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                error = e
+            logging.warning(
+                "Error downloading %s (attempt %d), retrying: %r",
+                object_name, attempt, error)
+            await asyncio.sleep(2 ** attempt)
+
+    async def _get_manifest(self, run_id, timeout):
+        try:
+            data = await self._download(
+                "%s/%s" % (run_id, MANIFEST_NAME), timeout)
+        except ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise
+        return _parse_manifest(data)
+
+    async def _blob_object_name(self, run_id, filename, timeout):
+        artifacts = await self._get_manifest(run_id, timeout)
+        if artifacts is None or filename not in artifacts:
+            return None
+        return "%s/%s" % (BLOB_PREFIX, artifacts[filename]["sha256"])
+
+    async def _store_content_addressed(self, run_id, local_path, names, timeout):
+        hashes = await to_thread(_hash_artifacts, local_path, names)
+        # Artifacts within a single run may have identical contents too.
+        by_digest = {}
+        for name, entry in hashes.items():
+            by_digest.setdefault(entry["sha256"], name)
+        sem = asyncio.Semaphore(self.max_concurrent_uploads)
+
+        async def upload(digest, name):
+            blob_name = "%s/%s" % (BLOB_PREFIX, digest)
+            async with sem:
+                if await self.bucket.blob_exists(blob_name):
+                    artifact_blobs_reused.inc()
+                    return
+                with artifact_upload_duration.time():
+                    await self.storage.upload_from_filename(
+                        self.bucket_name, blob_name,
+                        os.path.join(local_path, name), timeout=timeout)
+
+        await asyncio.gather(
+            *[upload(digest, name) for (digest, name) in by_digest.items()])
+        # The manifest is written last, so that it never refers to blobs
+        # that are missing.
+        artifacts = await self._get_manifest(run_id, timeout) or {}
+        artifacts.update(hashes)
+        await self.storage.upload(
+            self.bucket_name, "%s/%s" % (run_id, MANIFEST_NAME),
+            _serialize_manifest(artifacts), content_type="application/json",
+            timeout=timeout)
+        return hashes
+
     async def store_artifacts(self, run_id, local_path, names=None, timeout=None):
         if timeout is None:
             timeout = DEFAULT_GCS_TIMEOUT
         if names is None:
             names = os.listdir(local_path)
         if not names:
-            return
-        todo = []
-        for name in names:
-            todo.append(
-                self.storage.upload_from_filename(
-                    self.bucket_name,
-                    "%s/%s" % (run_id, name),
-                    os.path.join(local_path, name),
-                    timeout=timeout,
-                )
-            )
+            return {}
+        sem = asyncio.Semaphore(self.max_concurrent_uploads)
+
+        async def upload(name):
+            async with sem:
+                with artifact_upload_duration.time():
+                    await self.storage.upload_from_filename(
+                        self.bucket_name,
+                        "%s/%s" % (run_id, name),
+                        os.path.join(local_path, name),
+                        timeout=timeout,
+                    )
+
+        hashes = None
         try:
-            await asyncio.gather(*todo)
+            if self.content_addressed:
+                hashes = await self._store_content_addressed(
+                    run_id, local_path, names, timeout)
+            else:
+                await asyncio.gather(*[upload(name) for name in names])
         except ClientResponseError as e:
             if e.status == 503:
                 raise ServiceUnavailable()
@@ -170,49 +515,105 @@ class GCSArtifactManager(ArtifactManager):
         logging.info(
             "Uploaded %r to run %s in bucket %s.", names, run_id, self.bucket_name
         )
+        return hashes
 
     async def iter_ids(self):
-        ids = set()
-        for name in await self.bucket.list_blobs():
-            log_id = name.split("/")[0]
-            if log_id not in ids:
-                yield log_id
-            ids.add(log_id)
+        # Only list the top-level prefixes, rather than every object.
+        params = {"delimiter": "/"}
+        while True:
+            response = await self.storage.list_objects(
+                self.bucket_name, params=params)
+            for prefix in response.get("prefixes", []):
+                run_id = prefix.rstrip("/")
+                if run_id != BLOB_PREFIX:
+                    yield run_id
+            if not response.get("nextPageToken"):
+                break
+            params["pageToken"] = response["nextPageToken"]
+
+    def _object_names(self, run_id, name, entry):
+        """Return candidate object names for an artifact, most likely first."""
+        blob_name = "%s/%s" % (BLOB_PREFIX, entry["sha256"])
+        plain_name = "%s/%s" % (run_id, name)
+        if self.content_addressed:
+            return [blob_name, plain_name]
+        return [plain_name, blob_name]
 
     async def retrieve_artifacts(
-        self, run_id, local_path, filter_fn=None, timeout=None
+        self, run_id, local_path, filter_fn=None, timeout=None, manifest=None
     ):
         if timeout is None:
             timeout = DEFAULT_GCS_TIMEOUT
-        names = await self.bucket.list_blobs(prefix=run_id + "/")
-        if not names:
-            raise ArtifactsMissing(run_id)
 
-        async def download_blob(name):
-            with open(os.path.join(local_path, os.path.basename(name)), "wb+") as f:
-                f.write(
-                    await self.storage.download(
-                        bucket=self.bucket_name, object_name=name, timeout=timeout
-                    )
-                )
-
-        await asyncio.gather(
-            *[
-                download_blob(name)
-                for name in names
-                if filter_fn is None or filter_fn(os.path.basename(name))
-            ]
-        )
+        # Map from artifact name to the objects it may be retrieved from
+        objects = {}
+        if manifest:
+            for name, entry in manifest.items():
+                objects[name] = self._object_names(run_id, name, entry)
+        else:
+            names = await self.bucket.list_blobs(prefix=run_id + "/")
+            if not names:
+                raise ArtifactsMissing(run_id)
+            for name in names:
+                if os.path.basename(name) == MANIFEST_NAME:
+                    artifacts = await self._get_manifest(run_id, timeout)
+                    for artifact_name, entry in (artifacts or {}).items():
+                        objects.setdefault(
+                            artifact_name,
+                            ["%s/%s" % (BLOB_PREFIX, entry["sha256"])])
+                else:
+                    objects[os.path.basename(name)] = [name]
+
+        sem = asyncio.Semaphore(self.max_concurrent_downloads)
+
+        async def download_blob(name, object_names):
+            async with sem:
+                for object_name in object_names[:-1]:
+                    try:
+                        return await self._download_to_file(
+                            object_name, os.path.join(local_path, name),
+                            timeout)
+                    except ClientResponseError as e:
+                        if e.status != 404:
+                            raise
+                await self._download_to_file(
+                    object_names[-1], os.path.join(local_path, name), timeout)
 
-    async def get_artifact(self, run_id, filename, timeout=DEFAULT_GCS_TIMEOUT):
         try:
-            return BytesIO(
-                await self.storage.download(
-                    bucket=self.bucket_name,
-                    object_name="%s/%s" % (run_id, filename),
-                    timeout=timeout,
-                )
+            await asyncio.gather(
+                *[
+                    download_blob(name, object_names)
+                    for (name, object_names) in objects.items()
+                    if filter_fn is None or filter_fn(name)
+                ]
             )
+        except ClientResponseError as e:
+            if e.status == 503:
+                raise ServiceUnavailable()
+            if e.status == 404:
+                raise ArtifactsMissing(run_id)
+            raise
+
+    async def _open_artifact(self, run_id, filename, timeout):
+        object_name = "%s/%s" % (run_id, filename)
+        try:
+            # Try the layout this manager writes first, then fall back to
+            # the other one.
+            if self.content_addressed:
+                blob_name = await self._blob_object_name(
+                    run_id, filename, timeout)
+                return await self._download_stream(
+                    blob_name or object_name, timeout)
+            try:
+                return await self._download_stream(object_name, timeout)
+            except ClientResponseError as e:
+                if e.status != 404:
+                    raise
+                blob_name = await self._blob_object_name(
+                    run_id, filename, timeout)
+                if blob_name is None:
+                    raise
+            return await self._download_stream(blob_name, timeout)
         except ClientResponseError as e:
             if e.status == 503:
                 raise ServiceUnavailable()
@@ -220,6 +621,33 @@ class GCSArtifactManager(ArtifactManager):
                 raise FileNotFoundError
             raise
 
+    async def get_artifact(self, run_id, filename, timeout=DEFAULT_GCS_TIMEOUT):
+        f = tempfile.SpooledTemporaryFile(max_size=ARTIFACT_SPOOL_SIZE)
+        try:
+            async for chunk in self.iter_artifact(
+                    run_id, filename, timeout=timeout):
+                await to_thread(f.write, chunk)
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    async def iter_artifact(
+        self, run_id, filename, chunk_size=DEFAULT_CHUNK_SIZE,
+        timeout=DEFAULT_GCS_TIMEOUT
+    ):
+        stream = await self._open_artifact(run_id, filename, timeout)
+        try:
+            async with stream:
+                while True:
+                    chunk = await stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        except (ClientPayloadError, ServerDisconnectedError):
+            raise ServiceUnavailable()
+
     def public_artifact_url(self, run_id, filename):
         from gcloud.aio.storage.storage import API_ROOT
         from urllib.parse import quote
@@ -228,10 +656,19 @@ class GCSArtifactManager(ArtifactManager):
             quote("%s/%s" % (run_id, filename), safe=''))
 
 
-def get_artifact_manager(location, trace_configs=None):
+def get_artifact_manager(location, trace_configs=None, content_addressed=False):
+    """Create an artifact manager.
+
+    Args:
+      content_addressed: Store new artifacts by SHA-256, with a per-run
+        manifest, so that identical files are only stored once. Artifacts
+        in either layout can be retrieved regardless.
+    """
     if location.startswith("gs://"):
-        return GCSArtifactManager(location, trace_configs=trace_configs)
-    return LocalArtifactManager(location)
+        return GCSArtifactManager(
+            location, trace_configs=trace_configs,
+            content_addressed=content_addressed)
+    return LocalArtifactManager(location, content_addressed=content_addressed)
 
 
 async def list_ids(manager):
@@ -240,14 +677,46 @@ async def list_ids(manager):
             print(id)
 
 
+async def list_ids_from_db(db_location):
+    from . import state
+    async with state.create_pool(db_location) as pool, \
+            pool.acquire() as conn:
+        for id in await state.get_artifact_run_ids(conn):
+            print(id)
+
+
 async def upload_backup_artifacts(
-    backup_artifact_manager, artifact_manager, timeout=None
+    backup_artifact_manager, artifact_manager, timeout=None, db=None
 ):
-    async for run_id in backup_artifact_manager.iter_ids():
+    """Upload artifacts from the backup store to the main one.
+
+    Args:
+      db: Database pool; if set, runs that the artifact table has as
+        being in the backup store are uploaded too, even if the backup
+        store doesn't list them
+    """
+    # The backup store is local, so listing it is cheap. It also has runs
+    # that were never recorded in the database, e.g. because the run
+    # could not be stored.
+    run_ids = [run_id async for run_id in backup_artifact_manager.iter_ids()]
+    if db is not None:
+        from . import state
+        async with db.acquire() as conn:
+            listed = set(run_ids)
+            run_ids.extend(
+                run_id for run_id in await state.get_artifact_run_ids(
+                    conn, backup=True)
+                if run_id not in listed)
+    for run_id in run_ids:
         with tempfile.TemporaryDirectory() as td:
-            await backup_artifact_manager.retrieve_artifacts(
-                run_id, td, timeout=timeout
-            )
+            try:
+                await backup_artifact_manager.retrieve_artifacts(
+                    run_id, td, timeout=timeout
+                )
+            except ArtifactsMissing:
+                logging.warning(
+                    "Backup artifacts for %r are missing, skipping.", run_id)
+                continue
             try:
                 await artifact_manager.store_artifacts(run_id, td, timeout=timeout)
             except Exception as e:
@@ -255,22 +724,42 @@ async def upload_backup_artifacts(
                     "Unable to upload backup artifacts (%r): %s", run_id, e
                 )
             else:
+                if db is not None:
+                    async with db.acquire() as conn:
+                        await conn.execute(
+                            "UPDATE artifact SET backup = false "
+                            "WHERE run_id = $1", run_id)
                 await backup_artifact_manager.delete_artifacts(run_id)
 
 
 async def store_artifacts_with_backup(manager, backup_manager, from_dir, run_id, names):
+    """Store artifacts, falling back to a backup manager.
+
+    Returns:
+      tuple with the manifest of the stored artifacts (a dictionary mapping
+      names to their size and sha256) and whether they were stored in the
+      backup manager
+    """
+    if names is None:
+        names = os.listdir(from_dir)
+    backup = False
     try:
-        await manager.store_artifacts(run_id, from_dir, names)
+        manifest = await manager.store_artifacts(run_id, from_dir, names)
     except Exception as e:
         logging.warning("Unable to upload artifacts for %r: %r", run_id, e)
         if backup_manager:
-            await backup_manager.store_artifacts(run_id, from_dir, names)
+            manifest = await backup_manager.store_artifacts(
+                run_id, from_dir, names)
+            backup = True
             logging.info(
                 "Uploading results to backup artifact " "location %r.", backup_manager
             )
         else:
             logging.warning("No backup artifact manager set. ")
             raise
+    if manifest is None:
+        manifest = await to_thread(_hash_artifacts, from_dir, names)
+    return manifest, backup
 
 
 if __name__ == "__main__":
@@ -279,8 +768,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest="command")
     list_parser = subparsers.add_parser("list")
-    list_parser.add_argument("location", type=str)
+    list_parser.add_argument("location", type=str, nargs="?")
+    list_parser.add_argument(
+        "--config", type=str,
+        help="Look up runs in the database of this configuration, "
+        "rather than listing the artifact store.")
     args = parser.parse_args()
     if args.command == "list":
-        manager = get_artifact_manager(args.location)
-        asyncio.run(list_ids(manager))
+        if args.config:
+            from .config import read_config
+            with open(args.config, "r") as f:
+                config = read_config(f)
+            asyncio.run(list_ids_from_db(config.database_location))
+        else:
+            manager = get_artifact_manager(args.location)
+            asyncio.run(list_ids(manager))
@@ -18,12 +18,11 @@
 from aiohttp.web_middlewares import normalize_path_middleware
 import aiozipkin
 import asyncio
-from contextlib import ExitStack
+from contextlib import AsyncExitStack
 import json
 import logging
 import os
 import sys
-from tempfile import TemporaryDirectory
 import traceback
 
 from aiohttp import web
@@ -52,17 +51,42 @@ PRECACHE_RETRIEVE_TIMEOUT = 300
 routes = web.RouteTableDef()
 
 
-def find_binaries(path):
-    ret = []
-    for entry in os.scandir(path):
-        ret.append((entry.name, entry.path))
-    return ret
-
-
 def is_binary(n):
     return n.endswith(".deb") or n.endswith(".udeb")
 
 
+async def get_binaries(stack, app, old_id, new_id, timeout=None):
+    """Get local paths to the binaries of two runs.
+
+    The paths remain valid until stack is closed.
+
+    Returns:
+      tuple with lists of (name, path) tuples for the old and new run
+    """
+    async with app['pool'].acquire() as conn:
+        old_manifest = await state.get_artifact_manifest(conn, old_id)
+        new_manifest = await state.get_artifact_manifest(conn, new_id)
+    cms = [
+        app.artifact_manager.artifact_paths(
+            old_id, filter_fn=is_binary, timeout=timeout,
+            manifest=old_manifest),
+        app.artifact_manager.artifact_paths(
+            new_id, filter_fn=is_binary, timeout=timeout,
+            manifest=new_manifest),
+    ]
+    # Retrieve both concurrently, but make sure that any context that was
+    # entered ends up on the stack even if the other one failed.
+    results = await asyncio.gather(
+        *[cm.__aenter__() for cm in cms], return_exceptions=True)
+    for cm, result in zip(cms, results):
+        if not isinstance(result, BaseException):
+            stack.push_async_exit(cm)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
 class ArtifactRetrievalTimeout(Exception):
     """Timeout while retrieving artifacts."""
 
@@ -116,19 +140,10 @@ async def handle_debdiff(request):
             new_run['build_version'],
             new_run['campaign'],
         )
-        with ExitStack() as es:
-            old_dir = es.enter_context(TemporaryDirectory())
-            new_dir = es.enter_context(TemporaryDirectory())
-
+        async with AsyncExitStack() as es:
             try:
-                await asyncio.gather(
-                    request.app.artifact_manager.retrieve_artifacts(
-                        old_run['id'], old_dir, filter_fn=is_binary
-                    ),
-                    request.app.artifact_manager.retrieve_artifacts(
-                        new_run['id'], new_dir, filter_fn=is_binary
-                    ),
-                )
+                old_binaries, new_binaries = await get_binaries(
+                    es, request.app, old_run['id'], new_run['id'])
             except ArtifactsMissing as e:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %r" % e,
@@ -137,14 +152,12 @@ async def handle_debdiff(request):
             except asyncio.TimeoutError:
                 raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts")
 
-            old_binaries = find_binaries(old_dir)
             if not old_binaries:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %s" % old_run['id'],
                     headers={"unavailable_run_id": old_run['id']},
                 )
 
-            new_binaries = find_binaries(new_dir)
             if not new_binaries:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %s" % new_run['id'],
@@ -289,19 +302,10 @@ async def handle_diffoscope(request):
             new_run['build_version'],
             new_run['campaign'],
         )
-        with ExitStack() as es:
-            old_dir = es.enter_context(TemporaryDirectory())
-            new_dir = es.enter_context(TemporaryDirectory())
-
+        async with AsyncExitStack() as es:
             try:
-                await asyncio.gather(
-                    request.app.artifact_manager.retrieve_artifacts(
-                        old_run['id'], old_dir, filter_fn=is_binary
-                    ),
-                    request.app.artifact_manager.retrieve_artifacts(
-                        new_run['id'], new_dir, filter_fn=is_binary
-                    ),
-                )
+                old_binaries, new_binaries = await get_binaries(
+                    es, request.app, old_run['id'], new_run['id'])
             except ArtifactsMissing as e:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %r" % e,
@@ -310,14 +314,12 @@ async def handle_diffoscope(request):
             except asyncio.TimeoutError:
                 raise web.HTTPGatewayTimeout(text="Timeout retrieving artifacts")
 
-            old_binaries = find_binaries(old_dir)
             if not old_binaries:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %s" % old_run['id'],
                     headers={"unavailable_run_id": old_run['id']},
                 )
 
-            new_binaries = find_binaries(new_dir)
             if not new_binaries:
                 raise web.HTTPNotFound(
                     text="No artifacts for run id: %s" % new_run['id'],
@@ -391,24 +393,14 @@ async def precache(app, old_id, new_id):
       DiffCommandMemoryError: if the diff command used too much memory
       DiffCommandError: if a diff command failed
     """
-    with ExitStack() as es:
-        old_dir = es.enter_context(TemporaryDirectory())
-        new_dir = es.enter_context(TemporaryDirectory())
-
-        await asyncio.gather(
-            app.artifact_manager.retrieve_artifacts(
-                old_id, old_dir, filter_fn=is_binary, timeout=PRECACHE_RETRIEVE_TIMEOUT
-            ),
-            app.artifact_manager.retrieve_artifacts(
-                new_id, new_dir, filter_fn=is_binary, timeout=PRECACHE_RETRIEVE_TIMEOUT
-            ),
-        )
+    async with AsyncExitStack() as es:
+        old_binaries, new_binaries = await get_binaries(
+            es, app, old_id, new_id,
+            timeout=PRECACHE_RETRIEVE_TIMEOUT)
 
-        old_binaries = find_binaries(old_dir)
         if not old_binaries:
             raise ArtifactsMissing(old_id)
 
-        new_binaries = find_binaries(new_dir)
         if not new_binaries:
             raise ArtifactsMissing(new_id)
 
@@ -21,17 +21,168 @@ from aiohttp import (
     ClientTimeout,
     ServerDisconnectedError,
 )
+import asyncio
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import gzip
+import hashlib
 from io import BytesIO
+import json
 import os
+import shutil
+import tempfile
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import zlib
+from aiohttp_openmetrics import Counter
 from yarl import URL
 
+from .compat import to_thread
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Approximate amount of uncompressed data per gzip member in seekable logs.
+LOG_BLOCK_SIZE = 64 * 1024
+
+LOG_INDEX_VERSION = 1
+
+DEFAULT_LOG_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_LOG_CACHE_TTL = 24 * 60 * 60
+
+
+log_cache_hit_count = Counter(
+    "log_cache_hits", "Number of log requests served from the local cache")
+log_cache_miss_count = Counter(
+    "log_cache_misses", "Number of log requests not in the local cache")
+log_cache_eviction_count = Counter(
+    "log_cache_evictions", "Number of logs evicted from the local cache")
+
 
 class ServiceUnavailable(Exception):
     """The remote server is temporarily unavailable."""
 
 
+class _GzipStreamDecoder(object):
+    """Incrementally decompress a (possibly multi-member) gzip stream."""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decode(self, data: bytes) -> bytes:
+        ret = []
+        while data:
+            ret.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b"".join(ret)
+
+
+async def _iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
+
+
+def _split_lines(data: bytes) -> List[bytes]:
+    lines = data.split(b"\n")
+    last = lines.pop()
+    ret = [line + b"\n" for line in lines]
+    if last:
+        ret.append(last)
+    return ret
+
+
+def _gzip_file(path, mtime=None) -> bytes:
+    with open(path, "rb") as f:
+        return gzip.compress(f.read(), mtime=mtime)
+
+
+def _gzip_blocks_to(path, outf, mtime=None, block_size=LOG_BLOCK_SIZE):
+    """Compress a file as a series of independent gzip members.
+
+    Each member holds a run of complete lines, so that line ranges can be
+    read by only decompressing the relevant members. The concatenation is
+    still a valid gzip file.
+
+    Returns:
+      index of the members, suitable for passing to _blocks_for_lines
+    """
+    blocks = []
+    lineno = 1
+    with open(path, "rb") as inf:
+        while True:
+            data = inf.read(block_size)
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += inf.readline()
+            offset = outf.tell()
+            outf.write(gzip.compress(data, mtime=mtime))
+            nlines = len(_split_lines(data))
+            blocks.append([offset, outf.tell() - offset, lineno, nlines])
+            lineno += nlines
+    if not blocks:
+        outf.write(gzip.compress(b"", mtime=mtime))
+    return {
+        "version": LOG_INDEX_VERSION,
+        "lines": lineno - 1,
+        "blocks": blocks,
+    }
+
+
+def _gzip_blocks(path, mtime=None) -> Tuple[bytes, Dict[str, Any]]:
+    f = BytesIO()
+    index = _gzip_blocks_to(path, f, mtime=mtime)
+    return f.getvalue(), index
+
+
+def _gzip_blocks_to_file(path, dest_path, index_path, mtime=None) -> None:
+    with open(dest_path, "wb") as f:
+        index = _gzip_blocks_to(path, f, mtime=mtime)
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+
+
+def _blocks_for_lines(
+        index: Dict[str, Any], start: int, end: int) -> Tuple[int, int, int]:
+    """Find the compressed byte range holding a range of lines.
+
+    Returns:
+      tuple with offset and length of the compressed data, and the number
+      of the first line in it
+    """
+    blocks = index["blocks"]
+    first_lines = [block[2] for block in blocks]
+    i = bisect_right(first_lines, start) - 1
+    j = bisect_right(first_lines, end) - 1
+    offset = blocks[i][0]
+    return offset, blocks[j][0] + blocks[j][1] - offset, blocks[i][2]
+
+
+def _gzip_file_to(path, dest_path, mtime=None) -> None:
+    with open(path, "rb") as inf, \
+            gzip.GzipFile(dest_path, mode="wb", mtime=mtime) as outf:
+        shutil.copyfileobj(inf, outf)
+
+
+def _gzip_fileobj_to(path, outf, mtime=None) -> None:
+    with open(path, "rb") as inf, \
+            gzip.GzipFile(fileobj=outf, mode="wb", mtime=mtime) as gz:
+        shutil.copyfileobj(inf, gz)
+    outf.seek(0)
+
+
 class LogFileManager(object):
     async def has_log(self, pkg: str, run_id: str, name: str, timeout=None):
         raise NotImplementedError(self.has_log)
@@ -39,6 +190,97 @@ class LogFileManager(object):
     async def get_log(self, pkg: str, run_id: str, name: str, timeout=None):
         raise NotImplementedError(self.get_log)
 
+    async def iter_log(
+            self, pkg: str, run_id: str, name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            timeout=None) -> AsyncIterator[bytes]:
+        """Iterate over the decompressed contents of a log in chunks.
+
+        Implementations should avoid holding the whole log in memory.
+        """
+        with await self.get_log(pkg, run_id, name, timeout=timeout) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def _get_index(
+            self, pkg: str, run_id: str, name: str,
+            timeout=None) -> Optional[Dict[str, Any]]:
+        """Retrieve the line index for a seekable log, if there is one."""
+        return None
+
+    async def _get_range(
+            self, pkg: str, run_id: str, name: str, offset: int,
+            length: int, timeout=None) -> bytes:
+        """Retrieve a range of the compressed data for a log."""
+        raise NotImplementedError(self._get_range)
+
+    async def _get_indexed_lines(
+            self, index, pkg, run_id, name, start, end, timeout=None):
+        if end is None or end > index["lines"]:
+            end = index["lines"]
+        start = max(start, 1)
+        if start > end:
+            return []
+        offset, length, first_line = _blocks_for_lines(index, start, end)
+        data = gzip.decompress(await self._get_range(
+            pkg, run_id, name, offset, length, timeout=timeout))
+        return _split_lines(data)[start - first_line:end - first_line + 1]
+
+    async def get_log_lines(
+            self, pkg: str, run_id: str, name: str, start: int = 1,
+            end: Optional[int] = None, timeout=None) -> List[bytes]:
+        """Retrieve a range of lines from a log.
+
+        For seekable logs, only the compressed blocks holding the lines are
+        retrieved. Other logs are streamed up to the last requested line.
+
+        Args:
+          start: Number of the first line to return (1-based)
+          end: Number of the last line to return (inclusive), or None
+            for the end of the log
+        Returns:
+          list of lines, including line endings
+        """
+        index = await self._get_index(pkg, run_id, name, timeout=timeout)
+        if index is not None:
+            return await self._get_indexed_lines(
+                index, pkg, run_id, name, start, end, timeout=timeout)
+        ret = []
+        lineno = 0
+        chunks = self.iter_log(pkg, run_id, name, timeout=timeout)
+        async for line in _iter_lines(chunks):
+            lineno += 1
+            if end is not None and lineno > end:
+                break
+            if lineno >= start:
+                ret.append(line)
+        return ret
+
+    async def get_log_tail(
+            self, pkg: str, run_id: str, name: str, count: int,
+            timeout=None) -> Tuple[int, List[bytes]]:
+        """Retrieve the last lines of a log.
+
+        Returns:
+          tuple with the total number of lines in the log and the last
+          count lines
+        """
+        index = await self._get_index(pkg, run_id, name, timeout=timeout)
+        if index is not None:
+            return index["lines"], await self._get_indexed_lines(
+                index, pkg, run_id, name, index["lines"] - count + 1, None,
+                timeout=timeout)
+        ret: deque = deque(maxlen=count)
+        lineno = 0
+        chunks = self.iter_log(pkg, run_id, name, timeout=timeout)
+        async for line in _iter_lines(chunks):
+            lineno += 1
+            ret.append(line)
+        return lineno, list(ret)
+
     async def import_log(self, pkg: str, run_id: str, orig_path: str, timeout=None, mtime=None):
         raise NotImplementedError(self.import_log)
 
@@ -50,8 +292,9 @@ class LogFileManager(object):
 
 
 class FileSystemLogFileManager(LogFileManager):
-    def __init__(self, log_directory):
+    def __init__(self, log_directory, seekable=False):
         self.log_directory = log_directory
+        self.seekable = seekable
 
     def _get_paths(self, pkg, run_id, name):
         if "/" in pkg or "/" in run_id or "/" in name:
@@ -64,7 +307,9 @@ class FileSystemLogFileManager(LogFileManager):
     async def iter_logs(self):
         for pkg in os.scandir(self.log_directory):
             for entry in os.scandir(pkg.path):
-                yield pkg.name, entry.name, os.listdir(entry.path)
+                yield pkg.name, entry.name, [
+                    name for name in os.listdir(entry.path)
+                    if not name.endswith(".idx")]
 
     async def has_log(self, pkg, run_id, name):
         return any(map(os.path.exists, self._get_paths(pkg, run_id, name)))
@@ -87,16 +332,49 @@ class FileSystemLogFileManager(LogFileManager):
                 return open(path, "rb")
         raise FileNotFoundError(name)
 
+    async def iter_log(self, pkg, run_id, name, chunk_size=DEFAULT_CHUNK_SIZE,
+                       timeout=None):
+        with await self.get_log(pkg, run_id, name) as f:
+            while True:
+                chunk = await to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def _get_index(self, pkg, run_id, name, timeout=None):
+        paths = self._get_paths(pkg, run_id, name)
+        if not paths:
+            return None
+        try:
+            with open(paths[1] + ".idx", "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    async def _get_range(self, pkg, run_id, name, offset, length,
+                         timeout=None):
+        def read():
+            with open(self._get_paths(pkg, run_id, name)[1], "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+        return await to_thread(read)
+
     async def import_log(self, pkg, run_id, orig_path, timeout=None, mtime=None):
         dest_dir = os.path.join(self.log_directory, pkg, run_id)
         os.makedirs(dest_dir, exist_ok=True)
-        with open(orig_path, "rb") as inf:
-            dest_path = os.path.join(dest_dir, os.path.basename(orig_path) + ".gz")
-            with gzip.GzipFile(dest_path, mode="wb", mtime=mtime) as outf:
-                outf.write(inf.read())
+        dest_path = os.path.join(dest_dir, os.path.basename(orig_path) + ".gz")
+        if self.seekable:
+            await to_thread(
+                _gzip_blocks_to_file, orig_path, dest_path,
+                dest_path + ".idx", mtime=mtime)
+        else:
+            await to_thread(_gzip_file_to, orig_path, dest_path, mtime=mtime)
 
     async def delete_log(self, pkg, run_id, name):
-        for path in self._get_paths(pkg, run_id, name):
+        paths = self._get_paths(pkg, run_id, name)
+        if paths:
+            paths.append(paths[1] + ".idx")
+        for path in paths:
             try:
                 os.unlink(path)
             except FileNotFoundError:
@@ -108,17 +386,129 @@ class LogRetrievalError(Exception):
 
 
 class S3LogFileManager(LogFileManager):
-    def __init__(self, endpoint_url, bucket_name="debian-janitor", trace_configs=None):
+    """Log file manager that stores logs in an S3 bucket.
+
+    boto3 is synchronous, so all calls to it are made from a bounded
+    thread pool rather than from the event loop.
+    """
+
+    # Logs larger than this (after compression) are uploaded in parts.
+    MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+    # Compressed logs up to this size are kept in memory while uploading.
+    SPOOL_SIZE = 8 * 1024 * 1024
+
+    # Socket timeouts for requests made by boto3. Calls running in the
+    # thread pool can't be cancelled, so these are what bound the time a
+    # stuck request holds on to a worker thread.
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+
+    def __init__(self, endpoint_url, bucket_name="debian-janitor",
+                 trace_configs=None, max_workers=8, seekable=False):
         import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
 
         self.base_url = endpoint_url + ("/%s/" % bucket_name)
         self.session = ClientSession(trace_configs=trace_configs)
-        self.s3 = boto3.resource("s3", endpoint_url=endpoint_url)
+        self.s3 = boto3.resource(
+            "s3", endpoint_url=endpoint_url,
+            config=Config(
+                connect_timeout=self.CONNECT_TIMEOUT,
+                read_timeout=self.READ_TIMEOUT))
         self.s3_bucket = self.s3.Bucket(bucket_name)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='s3-logs')
+        self._transfer_config = TransferConfig(
+            multipart_threshold=self.MULTIPART_THRESHOLD,
+            multipart_chunksize=self.MULTIPART_THRESHOLD,
+            use_threads=False)
+        self.seekable = seekable
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
 
     def _get_key(self, pkg, run_id, name):
         return "logs/%s/%s/%s.gz" % (pkg, run_id, name)
 
+    def _get_index_key(self, pkg, run_id, name):
+        return self._get_key(pkg, run_id, name) + ".idx"
+
+    async def _get_index(self, pkg, run_id, name, timeout=10):
+        url = "%s%s" % (self.base_url, self._get_index_key(pkg, run_id, name))
+        client_timeout = ClientTimeout(timeout)
+        async with self.session.get(url, timeout=client_timeout) as resp:
+            if resp.status == 200:
+                return json.loads(await resp.read())
+            if resp.status in (403, 404):
+                return None
+            raise LogRetrievalError(
+                "Unexpected response code %d: %s" % (
+                    resp.status, await resp.text()))
+
+    async def _get_range(self, pkg, run_id, name, offset, length,
+                         timeout=10):
+        url = self._get_url(pkg, run_id, name)
+        client_timeout = ClientTimeout(timeout)
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+        async with self.session.get(
+                url, headers=headers, timeout=client_timeout) as resp:
+            if resp.status == 206:
+                return await resp.read()
+            if resp.status == 200:
+                return (await resp.read())[offset:offset + length]
+            if resp.status == 404:
+                raise FileNotFoundError(name)
+            raise LogRetrievalError(
+                "Unexpected response code %d: %s" % (
+                    resp.status, await resp.text()))
+
+    async def iter_logs(self):
+        pages = iter(
+            self.s3.meta.client.get_paginator("list_objects_v2").paginate(
+                Bucket=self.s3_bucket.name, Prefix="logs/"))
+        current = None
+        lfns = []
+        while True:
+            page = await self._run(next, pages, None)
+            if page is None:
+                break
+            for entry in page.get("Contents", []):
+                try:
+                    pkg, log_id, lfn = entry["Key"][len("logs/"):].split("/")
+                except ValueError:
+                    continue
+                if lfn.endswith(".idx"):
+                    continue
+                # Keys are listed in order, so all logs for a run are
+                # adjacent.
+                if (pkg, log_id) != current:
+                    if current is not None:
+                        yield current[0], current[1], lfns
+                    current = (pkg, log_id)
+                    lfns = []
+                lfns.append(lfn)
+        if current is not None:
+            yield current[0], current[1], lfns
+
+    async def get_ctime(self, pkg, run_id, name):
+        from botocore.exceptions import ClientError
+        key = self._get_key(pkg, run_id, name)
+        try:
+            obj = await self._run(
+                self.s3.meta.client.head_object,
+                Bucket=self.s3_bucket.name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise FileNotFoundError(name)
+            raise ServiceUnavailable()
+        # S3 doesn't track creation times; objects are never modified
+        # after upload, so this is equivalent.
+        return obj["LastModified"]
+
     def _get_url(self, pkg, run_id, name):
         return "%s%s" % (self.base_url, self._get_key(pkg, run_id, name))
 
@@ -149,31 +539,76 @@ class S3LogFileManager(LogFileManager):
                 "Unexpected response code %d: %s" % (resp.status, await resp.text())
             )
 
-    async def import_log(self, pkg, run_id, orig_path, timeout=360, mtime=None):
-        with open(orig_path, "rb") as f:
-            data = gzip.compress(f.read(), mtime=mtime)
+    async def iter_log(self, pkg, run_id, name, chunk_size=DEFAULT_CHUNK_SIZE,
+                       timeout=10):
+        url = self._get_url(pkg, run_id, name)
+        # Only bound the time to the response headers; large logs can
+        # take a while to stream.
+        client_timeout = ClientTimeout(sock_connect=timeout, sock_read=timeout)
+        async with self.session.get(url, timeout=client_timeout) as resp:
+            if resp.status == 404:
+                raise FileNotFoundError(name)
+            if resp.status == 403:
+                raise PermissionError(await resp.text())
+            if resp.status != 200:
+                raise LogRetrievalError(
+                    "Unexpected response code %d: %s" % (
+                        resp.status, await resp.text()))
+            decoder = _GzipStreamDecoder()
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                data = decoder.decode(chunk)
+                if data:
+                    yield data
+
+    def _upload(self, orig_path, key, mtime=None):
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as f:
+            if self.seekable:
+                index = _gzip_blocks_to(orig_path, f, mtime=mtime)
+                f.seek(0)
+            else:
+                _gzip_fileobj_to(orig_path, f, mtime=mtime)
+            self.s3_bucket.upload_fileobj(
+                f, key, ExtraArgs={"ACL": "public-read"},
+                Config=self._transfer_config)
+        if self.seekable:
+            # Upload the index last, so that readers never see an index
+            # without the log it describes.
+            self.s3_bucket.put_object(
+                Key=key + ".idx", Body=json.dumps(index).encode("utf-8"),
+                ACL="public-read")
 
+    async def import_log(self, pkg, run_id, orig_path, timeout=360, mtime=None):
+        # timeout is not enforced here: the upload can't be cancelled once
+        # it runs in the thread pool. Individual requests are bounded by
+        # CONNECT_TIMEOUT and READ_TIMEOUT instead.
         key = self._get_key(pkg, run_id, os.path.basename(orig_path))
-        self.s3_bucket.put_object(Key=key, Body=data, ACL="public-read")
+        await self._run(self._upload, orig_path, key, mtime=mtime)
 
     async def delete_log(self, pkg, run_id, name):
         key = self._get_key(pkg, run_id, name)
-        self.s3_bucket.delete_objects(Delete={"Objects": [{"Key": key}]})
+        await self._run(
+            self.s3_bucket.delete_objects,
+            Delete={"Objects": [
+                {"Key": key}, {"Key": self._get_index_key(pkg, run_id, name)}]})
 
 
 class GCSLogFilemanager(LogFileManager):
-    def __init__(self, location, creds_path=None, trace_configs=None):
+    def __init__(self, location, creds_path=None, trace_configs=None,
+                 seekable=False):
         from gcloud.aio.storage import Storage
 
         self.bucket_name = URL(location).host
         self.session = ClientSession(trace_configs=trace_configs)
         self.storage = Storage(service_file=creds_path, session=self.session)
         self.bucket = self.storage.get_bucket(self.bucket_name)
+        self.seekable = seekable
 
     async def iter_logs(self):
         seen = {}
         for name in await self.bucket.list_blobs():
             pkg, log_id, lfn = name.split("/")
+            if lfn.endswith(".idx"):
+                continue
             seen.setdefault((pkg, log_id), []).append(lfn)
         for (pkg, log_id), lfns in seen.items():
             yield pkg, log_id, lfns
@@ -181,6 +616,35 @@ class GCSLogFilemanager(LogFileManager):
     def _get_object_name(self, pkg, run_id, name):
         return "%s/%s/%s.gz" % (pkg, run_id, name)
 
+    async def _get_index(self, pkg, run_id, name, timeout=30):
+        object_name = self._get_object_name(pkg, run_id, name) + ".idx"
+        try:
+            data = await self.storage.download(
+                self.bucket_name, object_name, session=self.session,
+                timeout=timeout)
+        except ClientResponseError as e:
+            if e.status == 404:
+                return None
+            raise ServiceUnavailable()
+        except ServerDisconnectedError:
+            raise ServiceUnavailable()
+        return json.loads(data)
+
+    async def _get_range(self, pkg, run_id, name, offset, length,
+                         timeout=30):
+        object_name = self._get_object_name(pkg, run_id, name)
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+        try:
+            return await self.storage.download(
+                self.bucket_name, object_name, headers=headers,
+                session=self.session, timeout=timeout)
+        except ClientResponseError as e:
+            if e.status == 404:
+                raise FileNotFoundError(name)
+            raise ServiceUnavailable()
+        except ServerDisconnectedError:
+            raise ServiceUnavailable()
+
     async def has_log(self, pkg, run_id, name):
         object_name = self._get_object_name(pkg, run_id, name)
         return await self.bucket.blob_exists(object_name, self.session)
@@ -212,14 +676,44 @@ class GCSLogFilemanager(LogFileManager):
         except ServerDisconnectedError:
             raise ServiceUnavailable()
 
+    async def iter_log(self, pkg, run_id, name, chunk_size=DEFAULT_CHUNK_SIZE,
+                       timeout=30):
+        object_name = self._get_object_name(pkg, run_id, name)
+        try:
+            stream = await self.storage.download_stream(
+                self.bucket_name, object_name, session=self.session,
+                timeout=timeout)
+            async with stream:
+                decoder = _GzipStreamDecoder()
+                while True:
+                    chunk = await stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    data = decoder.decode(chunk)
+                    if data:
+                        yield data
+        except ClientResponseError as e:
+            if e.status == 404:
+                raise FileNotFoundError(name)
+            raise ServiceUnavailable()
+        except ServerDisconnectedError:
+            raise ServiceUnavailable()
+
     async def import_log(self, pkg, run_id, orig_path, timeout=360, mtime=None):
         object_name = self._get_object_name(pkg, run_id, os.path.basename(orig_path))
-        with open(orig_path, "rb") as f:
-            uploaded_data = gzip.compress(f.read(), mtime=mtime)
+        if self.seekable:
+            uploaded_data, index = await to_thread(
+                _gzip_blocks, orig_path, mtime=mtime)
+        else:
+            uploaded_data = await to_thread(_gzip_file, orig_path, mtime=mtime)
         try:
             await self.storage.upload(
                 self.bucket_name, object_name, uploaded_data, timeout=timeout
             )
+            if self.seekable:
+                await self.storage.upload(
+                    self.bucket_name, object_name + ".idx",
+                    json.dumps(index).encode("utf-8"), timeout=timeout)
         except ClientResponseError as e:
             if e.status == 503:
                 raise ServiceUnavailable()
@@ -228,9 +722,198 @@ class GCSLogFilemanager(LogFileManager):
             raise
 
 
-def get_log_manager(location, trace_configs=None):
+class CachingLogFileManager(LogFileManager):
+    """Read-through disk cache for another log file manager.
+
+    Decompressed logs are kept in a directory, up to max_size bytes in
+    total; the least recently used logs are evicted first. Concurrent
+    requests for a log that is not cached yet share a single download.
+
+    Line ranges of seekable logs that are not cached are read from the
+    inner log file manager, rather than downloading the whole log.
+    """
+
+    def __init__(self, inner: LogFileManager, directory: str,
+                 max_size: int = DEFAULT_LOG_CACHE_SIZE,
+                 ttl: Optional[int] = DEFAULT_LOG_CACHE_TTL):
+        self.inner = inner
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        # Maps cache file names to (size, retrieval time), least recently
+        # used first.
+        self._entries: Dict[str, Tuple[int, float]] = OrderedDict()
+        self._size = 0
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Number of readers per cache file that are about to open it;
+        # these files are not evicted.
+        self._pins: Dict[str, int] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (type(self).__name__, self.inner, self.directory)
+
+    def _load(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)
+                continue
+            st = entry.stat()
+            entries.append((st.st_mtime, entry.name, st.st_size))
+        for (mtime, filename, size) in sorted(entries):
+            self._entries[filename] = (size, mtime)
+            self._size += size
+        self._evict()
+
+    def _filename(self, pkg, run_id, name):
+        return hashlib.sha256(
+            ("%s\0%s\0%s" % (pkg, run_id, name)).encode("utf-8")).hexdigest()
+
+    def _evict(self):
+        for filename in list(self._entries):
+            if self._size <= self.max_size:
+                break
+            if filename in self._pins:
+                continue
+            self._remove(filename)
+            log_cache_eviction_count.inc()
+
+    def _remove(self, filename):
+        (size, fetched) = self._entries.pop(filename)
+        self._size -= size
+        try:
+            os.unlink(os.path.join(self.directory, filename))
+        except FileNotFoundError:
+            pass
+
+    async def _fetch(self, pkg, run_id, name, filename):
+        path = os.path.join(self.directory, filename)
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in self.inner.iter_log(pkg, run_id, name):
+                    await to_thread(f.write, chunk)
+            os.rename(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if filename in self._entries:
+            self._remove(filename)
+        size = os.path.getsize(path)
+        self._entries[filename] = (size, time.time())
+        self._size += size
+        self._evict()
+
+    def _cached_path(self, pkg, run_id, name) -> Optional[str]:
+        filename = self._filename(pkg, run_id, name)
+        try:
+            (size, fetched) = self._entries[filename]
+        except KeyError:
+            return None
+        if self.ttl is not None and time.time() - fetched > self.ttl:
+            self._remove(filename)
+            return None
+        self._entries.move_to_end(filename)
+        return os.path.join(self.directory, filename)
+
+    async def _get_path(self, pkg, run_id, name) -> str:
+        """Retrieve the path of the cached copy of a log.
+
+        The caller should hold a pin on the cache file (see _open), since it
+        may otherwise be evicted before it is opened.
+        """
+        path = self._cached_path(pkg, run_id, name)
+        if path is not None:
+            log_cache_hit_count.inc()
+            return path
+        log_cache_miss_count.inc()
+        filename = self._filename(pkg, run_id, name)
+        try:
+            fut = self._pending[filename]
+        except KeyError:
+            fut = self._pending[filename] = asyncio.ensure_future(
+                self._fetch(pkg, run_id, name, filename))
+            fut.add_done_callback(
+                lambda fut: self._pending.pop(filename, None))
+        await asyncio.shield(fut)
+        return os.path.join(self.directory, filename)
+
+    async def has_log(self, pkg, run_id, name):
+        if self._cached_path(pkg, run_id, name) is not None:
+            return True
+        return await self.inner.has_log(pkg, run_id, name)
+
+    async def _open(self, pkg, run_id, name):
+        filename = self._filename(pkg, run_id, name)
+        # Pin the file until it is open; other downloads finishing in the
+        # meantime would otherwise be able to evict it.
+        self._pins[filename] = self._pins.get(filename, 0) + 1
+        try:
+            return open(await self._get_path(pkg, run_id, name), "rb")
+        finally:
+            self._pins[filename] -= 1
+            if not self._pins[filename]:
+                del self._pins[filename]
+
+    async def get_log(self, pkg, run_id, name, timeout=None):
+        return await self._open(pkg, run_id, name)
+
+    async def _get_index(self, pkg, run_id, name, timeout=None):
+        if self._cached_path(pkg, run_id, name) is not None:
+            # Reading the local copy is cheaper.
+            return None
+        return await self.inner._get_index(
+            pkg, run_id, name, timeout=timeout)
+
+    async def _get_range(self, pkg, run_id, name, offset, length,
+                         timeout=None):
+        return await self.inner._get_range(
+            pkg, run_id, name, offset, length, timeout=timeout)
+
+    async def iter_log(self, pkg, run_id, name, chunk_size=DEFAULT_CHUNK_SIZE,
+                       timeout=None):
+        with await self.get_log(pkg, run_id, name) as f:
+            while True:
+                chunk = await to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def get_ctime(self, pkg, run_id, name):
+        return await self.inner.get_ctime(pkg, run_id, name)
+
+    async def iter_logs(self):
+        async for entry in self.inner.iter_logs():
+            yield entry
+
+    async def import_log(self, pkg, run_id, orig_path, timeout=None, mtime=None):
+        await self.inner.import_log(
+            pkg, run_id, orig_path, timeout=timeout, mtime=mtime)
+
+    async def delete_log(self, pkg, run_id, name):
+        filename = self._filename(pkg, run_id, name)
+        if filename in self._entries:
+            self._remove(filename)
+        await self.inner.delete_log(pkg, run_id, name)
+
+
+def get_log_manager(location, trace_configs=None, seekable=False):
+    """Create a log file manager.
+
+    Args:
+      seekable: Store new logs in a block-compressed format with a line
+        index, allowing line ranges to be read without retrieving the
+        whole log. Logs in either format can be read regardless.
+    """
     if location.startswith("gs://"):
-        return GCSLogFilemanager(location, trace_configs=trace_configs)
+        return GCSLogFilemanager(
+            location, trace_configs=trace_configs, seekable=seekable)
     if location.startswith("http:") or location.startswith("https:"):
-        return S3LogFileManager(location, trace_configs=trace_configs)
-    return FileSystemLogFileManager(location)
+        return S3LogFileManager(
+            location, trace_configs=trace_configs, seekable=seekable)
+    return FileSystemLogFileManager(location, seekable=seekable)
@@ -26,7 +26,10 @@ import logging
 import os
 import sys
 import time
-from typing import Dict, List, Optional, Any, Tuple, Set, AsyncIterable, Iterator
+from typing import (
+    Dict, List, Optional, Any, Tuple, Set, AsyncIterable, AsyncIterator,
+    Iterator)
+import urllib.parse
 import uuid
 import warnings
 
@@ -105,6 +108,21 @@ override_launchpad_consumer_name()
 
 EXISTING_RUN_RETRY_INTERVAL = 30
 
+# Publish result codes that don't count as attempts for exponential backoff.
+TRANSIENT_PUBLISH_RESULT_CODES = {"differ-unreachable"}
+
+# Number of publish worker processes to run at once.
+DEFAULT_PUBLISH_WORKERS = 4
+
+# Number of pending runs to consider at once, overall and per forge host.
+DEFAULT_PUBLISH_CONCURRENCY = 4
+DEFAULT_FORGE_CONCURRENCY = 2
+
+# Recycle publish workers after this many jobs, or once their peak memory
+# use exceeds this many megabytes.
+DEFAULT_PUBLISH_WORKER_MAX_JOBS = 100
+DEFAULT_PUBLISH_WORKER_MAX_RSS = 1024
+
 MODE_SKIP = "skip"
 MODE_BUILD_ONLY = "build-only"
 MODE_PUSH = "push"
@@ -146,6 +164,13 @@ last_scan_existing_success = Gauge(
 publish_latency = Histogram(
     "publish_latency", "Delay between build finish and publish."
 )
+publish_ready_queue_depth = Gauge(
+    "publish_ready_queue_depth",
+    "Number of publish-ready runs still to be considered in this cycle")
+forge_publish_duration = Histogram(
+    "forge_publish_duration",
+    "Time spent considering a publish-ready run, by forge host",
+    labelnames=("forge", ))
 
 exponential_backoff_count = Counter(
     "exponential_backoff_count",
@@ -190,6 +215,10 @@ forge_rate_limited_count = Counter(
     "Runs were not published because the relevant forge was rate-limiting",
     labelnames=("forge", ))
 
+publish_worker_started_count = Counter(
+    "publish_worker_started_count",
+    "Number of publish worker processes started")
+
 unexpected_http_response_count = Counter(
     "unexpected_http_response_count",
     "Number of unexpected HTTP responses during checks of existing "
@@ -372,6 +401,118 @@ def branches_match(url_a: Optional[str], url_b: Optional[str]) -> bool:
         return False
 
 
+class PublishWorkerError(Exception):
+    """A publish worker process failed."""
+
+
+class PublishWorkerPool(object):
+    """Pool of long-lived janitor.publish_one worker processes.
+
+    Workers handle one request at a time and keep their imports and forge
+    connections around between requests. They are recycled after a number
+    of jobs, or once their peak memory use exceeds a limit.
+    """
+
+    def __init__(
+        self,
+        template_env_path: Optional[str] = None,
+        size: int = DEFAULT_PUBLISH_WORKERS,
+        max_jobs: int = DEFAULT_PUBLISH_WORKER_MAX_JOBS,
+        max_rss: int = DEFAULT_PUBLISH_WORKER_MAX_RSS,
+    ):
+        self.template_env_path = template_env_path
+        self.size = size
+        self.max_jobs = max_jobs
+        # In megabytes
+        self.max_rss = max_rss
+        self._idle: List[Tuple[asyncio.subprocess.Process, int]] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _worker_args(self) -> List[str]:
+        args = [sys.executable, "-m", "janitor.publish_one", "--serve"]
+        if self.template_env_path:
+            args.append('--template-env-path=%s' % self.template_env_path)
+        return args
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        publish_worker_started_count.inc()
+        return await asyncio.create_subprocess_exec(
+            *self._worker_args(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # Responses may include tracebacks
+            limit=1024 * 1024,
+        )
+
+    async def _kill(self, p: asyncio.subprocess.Process) -> None:
+        try:
+            p.kill()
+        except ProcessLookupError:
+            # Already gone
+            pass
+        await p.wait()
+
+    async def _stop(self, p: asyncio.subprocess.Process) -> None:
+        # Workers exit once their stdin is closed.
+        p.stdin.close()
+        await p.wait()
+
+    async def request(self, request: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Send a request to an idle worker.
+
+        Returns:
+          tuple with exit status (0 on success, 1 on failure) and response
+        Raises:
+          PublishWorkerError: if the worker exited unexpectedly or sent an
+            invalid response
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        async with self._semaphore:
+            while self._idle:
+                p, jobs = self._idle.pop()
+                if p.returncode is None:
+                    break
+            else:
+                p, jobs = await self._spawn(), 0
+            try:
+                p.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+                await p.stdin.drain()
+                line = await p.stdout.readline()
+            except (OSError, ValueError, asyncio.LimitOverrunError) as e:
+                # The worker died (BrokenPipeError, ConnectionResetError) or
+                # its response exceeded the stream limit (ValueError).
+                await self._kill(p)
+                raise PublishWorkerError(
+                    "error communicating with publish worker: %r" % e)
+            except BaseException:
+                # Cancelled or failed half-way through a request; the
+                # worker is in an unknown state.
+                await self._kill(p)
+                raise
+            if not line:
+                returncode = await p.wait()
+                raise PublishWorkerError(
+                    "publish worker exited with status %d" % returncode)
+            try:
+                response = json.loads(line)
+            except ValueError as e:
+                await self._kill(p)
+                raise PublishWorkerError(
+                    "invalid response from publish worker: %s" % e)
+            jobs += 1
+            if jobs >= self.max_jobs or response["maxrss"] > self.max_rss * 1024:
+                await self._stop(p)
+            else:
+                self._idle.append((p, jobs))
+            return response["status"], response["response"]
+
+    async def close(self) -> None:
+        while self._idle:
+            p, jobs = self._idle.pop()
+            await self._stop(p)
+
+
 @dataclass
 class PublishResult:
 
@@ -382,7 +523,7 @@ class PublishResult:
 
 
 async def publish_one(
-    template_env_path: Optional[str],
+    publish_worker_pool: PublishWorkerPool,
     campaign: str,
     pkg: str,
     command,
@@ -455,52 +596,33 @@ async def publish_one(
     else:
         request["tags"] = {}
 
-    args = [sys.executable, "-m", "janitor.publish_one"]
-
-    if template_env_path:
-        args.append('--template-env-path=%s' % template_env_path)
-
-    p = await asyncio.create_subprocess_exec(
-        *args,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        stdin=asyncio.subprocess.PIPE
-    )
-
-    (stdout, stderr) = await p.communicate(json.dumps(request).encode())
+    try:
+        returncode, response = await publish_worker_pool.request(request)
+    except PublishWorkerError as e:
+        raise PublishFailure(mode, "publisher-invalid-response", str(e))
 
-    if p.returncode == 1:
-        try:
-            response = json.loads(stdout.decode())
-        except json.JSONDecodeError:
-            raise PublishFailure(mode, "publisher-invalid-response", stderr.decode())
-        sys.stderr.write(stderr.decode())
+    if returncode == 1:
         raise PublishFailure(mode, response["code"], response["description"])
 
-    if p.returncode == 0:
-        response = json.loads(stdout.decode())
+    proposal_url = response.get("proposal_url")
+    branch_name = response.get("branch_name")
+    is_new = response.get("is_new")
+    description = response.get('description')
 
-        proposal_url = response.get("proposal_url")
-        branch_name = response.get("branch_name")
-        is_new = response.get("is_new")
-        description = response.get('description')
+    if proposal_url and is_new:
+        await redis.publish_json(
+            'merge-proposal',
+            {"url": proposal_url, "status": "open", "package": pkg,
+             "campaign": campaign,
+             "target_branch_url": main_branch_url.rstrip("/")})
 
-        if proposal_url and is_new:
-            await redis.publish_json(
-                'merge-proposal',
-                {"url": proposal_url, "status": "open", "package": pkg,
-                 "campaign": campaign,
-                 "target_branch_url": main_branch_url.rstrip("/")})
+        merge_proposal_count.labels(status="open").inc()
+        maintainer_rate_limiter.inc(maintainer_email)
+        open_proposal_count.labels(maintainer=maintainer_email).inc()
 
-            merge_proposal_count.labels(status="open").inc()
-            maintainer_rate_limiter.inc(maintainer_email)
-            open_proposal_count.labels(maintainer=maintainer_email).inc()
-
-        return PublishResult(
-            proposal_url=proposal_url, branch_name=branch_name, is_new=is_new,
-            description=description)
-
-    raise PublishFailure(mode, "publisher-invalid-response", stderr.decode())
+    return PublishResult(
+        proposal_url=proposal_url, branch_name=branch_name, is_new=is_new,
+        description=description)
 
 
 def calculate_next_try_time(finish_time: datetime, attempt_count: int) -> datetime:
@@ -513,35 +635,35 @@ def calculate_next_try_time(finish_time: datetime, attempt_count: int) -> dateti
 
 
 async def consider_publish_run(
-        conn, config, template_env_path,
+        conn, config, publish_worker_pool,
         vcs_managers, maintainer_rate_limiter, external_url, differ_url,
         redis,
         run, maintainer_email,
         unpublished_branches, command,
         push_limit=None, require_binary_diff=False,
-        dry_run=False):
+        dry_run=False, check_backoff=True):
     if run.revision is None:
         logger.warning(
             "Run %s is publish ready, but does not have revision set.", run.id
         )
         return {}
     campaign_config = get_campaign_config(config, run.suite)
-    # TODO(jelmer): next try in SQL query
-    attempt_count = await get_publish_attempt_count(
-        conn, run.revision, {"differ-unreachable"}
-    )
-    next_try_time = calculate_next_try_time(run.finish_time, attempt_count)
-    if datetime.utcnow() < next_try_time:
-        logger.info(
-            "Not attempting to push %s / %s (%s) due to "
-            "exponential backoff. Next try in %s.",
-            run.package,
-            run.suite,
-            run.id,
-            next_try_time - datetime.utcnow(),
+    if check_backoff:
+        attempt_count = await get_publish_attempt_count(
+            conn, run.revision, TRANSIENT_PUBLISH_RESULT_CODES
         )
-        exponential_backoff_count.inc()
-        return {}
+        next_try_time = calculate_next_try_time(run.finish_time, attempt_count)
+        if datetime.utcnow() < next_try_time:
+            logger.info(
+                "Not attempting to push %s / %s (%s) due to "
+                "exponential backoff. Next try in %s.",
+                run.package,
+                run.suite,
+                run.id,
+                next_try_time - datetime.utcnow(),
+            )
+            exponential_backoff_count.inc()
+            return {}
     ms = [b[4] for b in unpublished_branches]
     if push_limit is not None and (
             MODE_PUSH in ms or MODE_ATTEMPT_PUSH in ms):
@@ -583,7 +705,7 @@ async def consider_publish_run(
         actual_modes[role] = await publish_from_policy(
             conn,
             campaign_config,
-            template_env_path,
+            publish_worker_pool,
             maintainer_rate_limiter,
             vcs_managers,
             run,
@@ -613,6 +735,7 @@ async def iter_publish_ready(
     needs_review: Optional[bool] = None,
     run_id: Optional[str] = None,
     change_set_state: Optional[List[str]] = None,
+    due_only: bool = False,
 ) -> AsyncIterable[
     Tuple[
         state.Run,
@@ -621,8 +744,36 @@ async def iter_publish_ready(
         List[Tuple[str, str, bytes, bytes, Optional[str], Optional[int], Optional[str]]],
     ]
 ]:
+    """Iterate over runs that are ready to be published.
+
+    Args:
+      due_only: Only include runs that are not held back by exponential
+        backoff (see calculate_next_try_time)
+    """
     args: List[Any] = []
-    query = """
+    if due_only:
+        args.append(TRANSIENT_PUBLISH_RESULT_CODES)
+        # Mirrors calculate_next_try_time, including its fallback to a
+        # week when the backoff overflows.
+        query = """
+SELECT * FROM (
+  SELECT publish_ready.*,
+    CASE
+      WHEN attempt_count = 0 THEN finish_time
+      WHEN 2 ^ attempt_count > extract(
+          epoch FROM '9999-12-31 23:59:59.999999'::timestamp - finish_time
+          ) / 3600
+        THEN finish_time + interval '7 days'
+      ELSE finish_time + (2 ^ attempt_count) * interval '1 hour'
+    END AS next_try_time
+  FROM publish_ready, LATERAL (
+    SELECT count(*) AS attempt_count FROM publish
+    WHERE publish.revision = publish_ready.revision
+    AND publish.result_code != ALL($1::text[])) AS attempts
+) AS publish_ready
+"""
+    else:
+        query = """
 SELECT * FROM publish_ready
 """
     conditions = []
@@ -650,6 +801,9 @@ SELECT * FROM publish_ready
         args.append(needs_review)
         conditions.append('needs_review = $%d' % (len(args)))
 
+    if due_only:
+        conditions.append("next_try_time <= NOW() AT TIME ZONE 'UTC'")
+
     if conditions:
         query += " WHERE " + " AND ".join(conditions)
 
@@ -676,7 +830,7 @@ async def publish_pending_ready(
     db,
     redis,
     config,
-    template_env_path,
+    publish_worker_pool,
     maintainer_rate_limiter,
     vcs_managers,
     dry_run: bool,
@@ -685,7 +839,14 @@ async def publish_pending_ready(
     reviewed_only: bool = False,
     push_limit: Optional[int] = None,
     require_binary_diff: bool = False,
+    concurrency: int = DEFAULT_PUBLISH_CONCURRENCY,
+    forge_concurrency: int = DEFAULT_FORGE_CONCURRENCY,
 ):
+    """Consider all publish-ready runs for publishing.
+
+    Runs are considered concurrently, with at most concurrency runs
+    overall and forge_concurrency runs per forge host at a time.
+    """
     start = time.time()
     actions: Dict[str, int] = {}
 
@@ -694,36 +855,93 @@ async def publish_pending_ready(
     else:
         review_status = ["approved", "unreviewed"]
 
-    async with db.acquire() as conn1, db.acquire() as conn:
+    pushes_left = push_limit
+    concurrency_semaphore = asyncio.Semaphore(concurrency)
+    forge_semaphores: Dict[str, asyncio.Semaphore] = {}
+    # Runs for the same maintainer are considered one at a time, so that
+    # checking and updating maintainer_rate_limiter stays atomic.
+    maintainer_locks: Dict[str, asyncio.Lock] = {}
+
+    async def consider(run, maintainer_email, command, unpublished_branches):
+        nonlocal pushes_left
+        forge_host = urllib.parse.urlparse(run.branch_url or '').netloc
+        forge_semaphore = forge_semaphores.setdefault(
+            forge_host, asyncio.Semaphore(forge_concurrency))
+        async with AsyncExitStack() as stack:
+            # Wait for the maintainer lock before taking a forge or global
+            # slot, so that runs waiting for another run of the same
+            # maintainer don't hold slots that other runs could use. Runs
+            # without a maintainer are not rate limited, so don't need it.
+            if maintainer_email is not None:
+                await stack.enter_async_context(maintainer_locks.setdefault(
+                    maintainer_email, asyncio.Lock()))
+            await stack.enter_async_context(forge_semaphore)
+            await stack.enter_async_context(concurrency_semaphore)
+            publish_ready_queue_depth.dec()
+            # Reserve a push up front, and return it if it wasn't used.
+            may_push = any(
+                b[4] in (MODE_PUSH, MODE_ATTEMPT_PUSH) for b in unpublished_branches)
+            run_push_limit: Optional[int]
+            if pushes_left is None or not may_push:
+                run_push_limit = None
+            elif pushes_left > 0:
+                pushes_left -= 1
+                run_push_limit = 1
+            else:
+                run_push_limit = 0
+            actual_modes: Dict[str, Optional[str]] = {}
+            try:
+                with forge_publish_duration.labels(forge=forge_host).time():
+                    async with db.acquire() as conn:
+                        actual_modes = await consider_publish_run(
+                            conn, config=config,
+                            publish_worker_pool=publish_worker_pool,
+                            vcs_managers=vcs_managers,
+                            maintainer_rate_limiter=maintainer_rate_limiter,
+                            external_url=external_url, differ_url=differ_url,
+                            redis=redis,
+                            run=run,
+                            command=command,
+                            maintainer_email=maintainer_email,
+                            unpublished_branches=unpublished_branches,
+                            push_limit=run_push_limit,
+                            require_binary_diff=require_binary_diff,
+                            dry_run=dry_run,
+                            check_backoff=False)
+            finally:
+                if run_push_limit == 1 and (
+                        MODE_PUSH not in actual_modes.values()):
+                    pushes_left += 1
+        for actual_mode in actual_modes.values():
+            actions.setdefault(actual_mode, 0)
+            actions[actual_mode] += 1
+
+    tasks = []
+    async with db.acquire() as conn:
         async for (
             run,
             maintainer_email,
             command,
             unpublished_branches,
         ) in iter_publish_ready(
-            conn1, review_status=review_status,
+            conn, review_status=review_status,
             needs_review=False,
             change_set_state=['ready', 'publishing'],
+            due_only=True,
         ):
-            actual_modes = await consider_publish_run(
-                conn, config=config,
-                template_env_path=template_env_path,
-                vcs_managers=vcs_managers,
-                maintainer_rate_limiter=maintainer_rate_limiter,
-                external_url=external_url, differ_url=differ_url,
-                redis=redis,
-                run=run,
-                command=command,
-                maintainer_email=maintainer_email,
-                unpublished_branches=unpublished_branches,
-                push_limit=push_limit,
-                require_binary_diff=require_binary_diff,
-                dry_run=dry_run)
-            for actual_mode in actual_modes.values():
-                actions.setdefault(actual_mode, 0)
-                actions[actual_mode] += 1
-            if MODE_PUSH in actual_modes.values() and push_limit is not None:
-                push_limit -= 1
+            publish_ready_queue_depth.inc()
+            tasks.append(asyncio.ensure_future(consider(
+                run, maintainer_email, command, unpublished_branches)))
+
+    errors = []
+    for ret in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(ret, BaseException):
+            logger.error(
+                "Error considering run for publishing", exc_info=ret)
+            errors.append(ret)
+    publish_ready_queue_depth.set(0)
+    if errors:
+        raise errors[0]
 
     logger.info("Actions performed: %r", actions)
     logger.info(
@@ -935,7 +1153,7 @@ async def store_publish(
 async def publish_from_policy(
     conn,
     campaign_config: Campaign,
-    template_env_path,
+    publish_worker_pool,
     maintainer_rate_limiter,
     vcs_managers,
     run: state.Run,
@@ -1046,7 +1264,7 @@ async def publish_from_policy(
     )
     try:
         publish_result = await publish_one(
-            template_env_path,
+            publish_worker_pool,
             run.suite,
             run.package,
             run.command,
@@ -1160,7 +1378,7 @@ async def publish_and_store(
     db,
     redis,
     campaign_config: Campaign,
-    template_env_path: str,
+    publish_worker_pool: PublishWorkerPool,
     publish_id: str,
     run: state.Run,
     mode: str,
@@ -1195,7 +1413,7 @@ async def publish_and_store(
 
         try:
             publish_result = await publish_one(
-                template_env_path,
+                publish_worker_pool,
                 run.suite,
                 run.package,
                 run.command,
@@ -1454,7 +1672,7 @@ async def consider_request(request):
                 return
             await consider_publish_run(
                 conn, request.app['config'],
-                template_env_path=request.app['template_env_path'],
+                publish_worker_pool=request.app['publish_worker_pool'],
                 vcs_managers=request.app['vcs_managers'],
                 maintainer_rate_limiter=request.app['maintainer_rate_limiter'],
                 external_url=request.app['external_url'],
@@ -1536,7 +1754,7 @@ async def publish_request(request):
                 request.app['db'],
                 request.app['redis'],
                 get_campaign_config(request.app['config'], run.suite),
-                request.app['template_env_path'],
+                request.app['publish_worker_pool'],
                 publish_id,
                 run,
                 mode,
@@ -1608,7 +1826,7 @@ async def credentials_request(request):
 async def run_web_server(
     listen_addr: str,
     port: int,
-    template_env_path: Optional[str],
+    publish_worker_pool: PublishWorkerPool,
     maintainer_rate_limiter: RateLimiter,
     forge_rate_limiter: Dict[str, datetime],
     vcs_managers: Dict[str, VcsManager],
@@ -1626,7 +1844,7 @@ async def run_web_server(
     app = web.Application(middlewares=[trailing_slash_redirect])
     app.router.add_routes(routes)
     app['gpg'] = gpg.Context(armor=True)
-    app['template_env_path'] = template_env_path
+    app['publish_worker_pool'] = publish_worker_pool
     app['vcs_managers'] = vcs_managers
     app['db'] = db
     app['redis'] = redis
@@ -1683,20 +1901,19 @@ async def get_mp_status(mp):
 @routes.post("/scan", name='scan')
 async def scan_request(request):
     async def scan():
-        async with request.app['db'].acquire() as conn:
-            await check_existing(
-                conn,
-                request.app['redis'],
-                request.app['config'],
-                request.app['template_env_path'],
-                request.app['maintainer_rate_limiter'],
-                request.app['forge_rate_limiter'],
-                request.app['vcs_managers'],
-                dry_run=request.app['dry_run'],
-                differ_url=request.app['differ_url'],
-                external_url=request.app['external_url'],
-                modify_limit=request.app['modify_mp_limit'],
-            )
+        await check_existing(
+            request.app['db'],
+            request.app['redis'],
+            request.app['config'],
+            request.app['publish_worker_pool'],
+            request.app['maintainer_rate_limiter'],
+            request.app['forge_rate_limiter'],
+            request.app['vcs_managers'],
+            dry_run=request.app['dry_run'],
+            differ_url=request.app['differ_url'],
+            external_url=request.app['external_url'],
+            modify_limit=request.app['modify_mp_limit'],
+        )
 
     create_background_task(scan(), 'merge proposal refresh scan')
     return web.Response(status=202, text="Scan started.")
@@ -1720,7 +1937,7 @@ async def refresh_proposal_status_request(request):
                     conn,
                     request.app['redis'],
                     request.app['config'],
-                    request.app['template_env_path'],
+                    request.app['publish_worker_pool'],
                     mp,
                     status,
                     vcs_managers=request.app['vcs_managers'],
@@ -1748,7 +1965,7 @@ async def autopublish_request(request):
             request.app['db'],
             request.app['redis'],
             request.app['config'],
-            request.app['template_env_path'],
+            request.app['publish_worker_pool'],
             request.app['maintainer_rate_limiter'],
             request.app['vcs_managers'],
             dry_run=request.app['dry_run'],
@@ -1837,7 +2054,7 @@ WHERE run.id = $1
         if run['revision'] is not None:
             attempt_count = await get_publish_attempt_count(
                 conn, run['revision'].encode('utf-8'),
-                {"differ-unreachable"})
+                TRANSIENT_PUBLISH_RESULT_CODES)
         else:
             attempt_count = 0
     ret = {}
@@ -1903,7 +2120,7 @@ async def process_queue_loop(
     db,
     redis,
     config,
-    template_env_path,
+    publish_worker_pool,
     maintainer_rate_limiter,
     forge_rate_limiter,
     dry_run,
@@ -1916,29 +2133,30 @@ async def process_queue_loop(
     push_limit: Optional[int] = None,
     modify_mp_limit: Optional[int] = None,
     require_binary_diff: bool = False,
+    concurrency: int = DEFAULT_PUBLISH_CONCURRENCY,
+    forge_concurrency: int = DEFAULT_FORGE_CONCURRENCY,
 ):
     while True:
         cycle_start = datetime.utcnow()
-        async with db.acquire() as conn:
-            await check_existing(
-                conn,
-                redis,
-                config,
-                template_env_path,
-                maintainer_rate_limiter,
-                forge_rate_limiter,
-                vcs_managers,
-                dry_run=dry_run,
-                external_url=external_url,
-                differ_url=differ_url,
-                modify_limit=modify_mp_limit,
-            )
+        await check_existing(
+            db,
+            redis,
+            config,
+            publish_worker_pool,
+            maintainer_rate_limiter,
+            forge_rate_limiter,
+            vcs_managers,
+            dry_run=dry_run,
+            external_url=external_url,
+            differ_url=differ_url,
+            modify_limit=modify_mp_limit,
+        )
         if auto_publish:
             await publish_pending_ready(
                 db,
                 redis,
                 config,
-                template_env_path,
+                publish_worker_pool,
                 maintainer_rate_limiter,
                 vcs_managers,
                 dry_run=dry_run,
@@ -1947,6 +2165,8 @@ async def process_queue_loop(
                 reviewed_only=reviewed_only,
                 push_limit=push_limit,
                 require_binary_diff=require_binary_diff,
+                concurrency=concurrency,
+                forge_concurrency=forge_concurrency,
             )
         cycle_duration = datetime.utcnow() - cycle_start
         to_wait = max(0, interval - cycle_duration.total_seconds())
@@ -2100,7 +2320,7 @@ async def check_existing_mp(
     conn,
     redis,
     config,
-    template_env_path,
+    publish_worker_pool,
     mp,
     status,
     vcs_managers,
@@ -2120,8 +2340,8 @@ async def check_existing_mp(
             # as applied rather than closed?
             pass
         if status == "merged":
-            merged_by = mp.get_merged_by()
-            merged_at = mp.get_merged_at()
+            merged_by = await to_thread(mp.get_merged_by)
+            merged_at = await to_thread(mp.get_merged_at)
             if merged_at is not None:
                 merged_at = merged_at.replace(tzinfo=None)
         else:
@@ -2423,7 +2643,9 @@ applied independently.
         # the default branch name.
         if not dry_run and mp_remote_branch_name is not None:
             try:
-                mp.set_target_branch_name(last_run_remote_branch_name or "")
+                await to_thread(
+                    mp.set_target_branch_name,
+                    last_run_remote_branch_name or "")
             except NotImplementedError:
                 logger.info(
                     "%s: Closing merge proposal, since branch for role "
@@ -2529,7 +2751,7 @@ This merge proposal will be closed, since the branch has moved to %s.
 
         try:
             publish_result = await publish_one(
-                template_env_path,
+                publish_worker_pool,
                 last_run.suite,
                 last_run.package,
                 last_run.command,
@@ -2669,6 +2891,37 @@ applied independently.
         return False
 
 
+def _iter_forge_mps(
+    instance: Forge, statuses: List[str]
+) -> Iterator[Tuple[MergeProposal, str]]:
+    for status in statuses:
+        try:
+            for mp in instance.iter_my_proposals(status=status):
+                yield mp, status
+        except ForgeLoginRequired:
+            logging.info(
+                'Skipping %r, no credentials known.',
+                instance)
+        except UnexpectedHttpStatus as e:
+            logging.warning(
+                'Got unexpected HTTP status %s, skipping %r',
+                e, instance)
+        except UnsupportedForge as e:
+            logging.warning(
+                'Unsupported host instance, skipping %r: %s',
+                instance, e)
+
+
+async def _iter_in_thread(iterator: Iterator[Any]) -> AsyncIterator[Any]:
+    """Iterate over a blocking iterator, retrieving each item in a thread."""
+    done = object()
+    while True:
+        item = await to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
 def iter_all_mps(
     statuses: Optional[List[str]] = None,
 ) -> Iterator[Tuple[Forge, MergeProposal, str]]:
@@ -2676,29 +2929,37 @@ def iter_all_mps(
     if statuses is None:
         statuses = ["open", "merged", "closed"]
     for instance in iter_forge_instances():
-        for status in statuses:
-            try:
-                for mp in instance.iter_my_proposals(status=status):
-                    yield instance, mp, status
-            except ForgeLoginRequired:
-                logging.info(
-                    'Skipping %r, no credentials known.',
-                    instance)
-            except UnexpectedHttpStatus as e:
-                logging.warning(
-                    'Got unexpected HTTP status %s, skipping %r',
-                    e, instance)
-            except UnsupportedForge as e:
-                logging.warning(
-                    'Unsupported host instance, skipping %r: %s',
-                    instance, e)
+        for mp, status in _iter_forge_mps(instance, statuses):
+            yield instance, mp, status
+
+
+async def get_terminal_proposals(
+    conn: asyncpg.Connection
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Retrieve the merge proposals that are known to be merged or closed.
+
+    Returns:
+      dictionary mapping URLs to status and maintainer email
+    """
+    rows = await conn.fetch("""\
+SELECT
+    merge_proposal.url,
+    merge_proposal.status,
+    package.maintainer_email
+FROM
+    merge_proposal
+LEFT JOIN package ON merge_proposal.package = package.name
+WHERE
+    merge_proposal.status IN ('merged', 'closed', 'applied', 'abandoned', 'rejected')
+""")
+    return {row[0]: (row[1], row[2]) for row in rows}
 
 
 async def check_existing(
-    conn,
+    db,
     redis,
     config,
-    template_env_path,
+    publish_worker_pool,
     maintainer_rate_limiter,
     forge_rate_limiter: Dict[Forge, datetime],
     vcs_managers,
@@ -2708,6 +2969,12 @@ async def check_existing(
     modify_limit=None,
     unexpected_limit: int = 5,
 ):
+    """Scan existing merge proposals.
+
+    Forges are scanned concurrently. Proposals that the database already
+    has as merged or closed, and that the forge still lists that way,
+    are not checked again.
+    """
     mps_per_maintainer: Dict[str, Dict[str, int]] = {
         "open": {},
         "closed": {},
@@ -2716,7 +2983,6 @@ async def check_existing(
         "abandoned": {},
         "rejected": {},
     }
-    possible_transports: List[Transport] = []
     status_count = {
         "open": 0,
         "closed": 0,
@@ -2731,70 +2997,121 @@ async def check_existing(
     check_only = False
     was_forge_ratelimited = False
 
-    for forge, mp, status in iter_all_mps():
-        status_count[status] += 1
-        if forge in forge_rate_limiter:
-            if datetime.utcnow() < forge_rate_limiter[forge]:
-                del forge_rate_limiter[forge]
-            else:
-                forge_rate_limited_count.labels(forge=str(forge)).inc()
-                was_forge_ratelimited = True
-                continue
-        try:
-            modified = await check_existing_mp(
-                conn,
-                redis,
-                config,
-                template_env_path,
-                mp,
-                status,
-                vcs_managers=vcs_managers,
-                dry_run=dry_run,
-                external_url=external_url,
-                differ_url=differ_url,
-                maintainer_rate_limiter=maintainer_rate_limiter,
-                possible_transports=possible_transports,
-                mps_per_maintainer=mps_per_maintainer,
-                check_only=check_only,
-            )
-        except NoRunForMergeProposal as e:
-            logger.warning("Unable to find metadata for %s, skipping.", e.mp.url)
-            modified = False
-        except ForgeLoginRequired as e:
-            logger.warning('Login required for forge %s, skipping.', e)
-            modified = False
-        except BranchRateLimited as e:
-            logger.warning(
-                "Rate-limited accessing %s. Skipping %r for this cycle.",
-                mp.url, forge)
-            if e.retry_after is None:
-                retry_after = timedelta(minutes=30)
-            else:
-                retry_after = timedelta(seconds=e.retry_after)
-            forge_rate_limiter[forge] = datetime.utcnow() + retry_after
-            continue
-        except UnexpectedHttpStatus as e:
-            logging.warning(
-                'Got unexpected HTTP status %s, skipping %r',
-                e, mp.url)
-            # TODO(jelmer): print traceback?
-            unexpected += 1
+    async with db.acquire() as conn:
+        terminal = await get_terminal_proposals(conn)
 
-        if unexpected > unexpected_limit:
-            unexpected_http_response_count.inc()
-            logging.warning(
-                "Saw %d unexpected HTTP responses, over threshold of %d. "
-                "Giving up for now.", unexpected, unexpected_limit)
-            return
+    def is_unchanged_terminal(mp, status):
+        try:
+            (old_status, maintainer_email) = terminal[mp.url]
+        except KeyError:
+            return False
+        if status == "merged":
+            if old_status != "merged":
+                return False
+        elif status == "closed":
+            if old_status not in ("closed", "abandoned", "applied", "rejected"):
+                return False
+        else:
+            return False
+        if maintainer_email is not None:
+            mps_per_maintainer[old_status].setdefault(maintainer_email, 0)
+            mps_per_maintainer[old_status][maintainer_email] += 1
+        return True
 
-        if modified:
-            modified_mps += 1
-            if modify_limit and modified_mps > modify_limit:
-                logger.warning(
-                    "Already modified %d merge proposals, "
-                    "waiting with the rest.", modified_mps,
+    async def scan_forge(forge):
+        possible_transports: List[Transport] = []
+        # Proposals that don't need to be checked again; last_scanned is
+        # updated for these in a single query.
+        unchanged_urls: List[str] = []
+        async with db.acquire() as conn:
+            try:
+                await scan_forge_mps(
+                    conn, forge, possible_transports, unchanged_urls)
+            finally:
+                if unchanged_urls:
+                    await conn.execute(
+                        'UPDATE merge_proposal SET last_scanned = NOW() '
+                        'WHERE url = ANY($1::text[])', unchanged_urls)
+
+    async def scan_forge_mps(
+            conn, forge, possible_transports, unchanged_urls):
+        nonlocal modified_mps, unexpected, check_only, was_forge_ratelimited
+        # Proposals are retrieved lazily, so that checking can start
+        # before the forge has returned all of them.
+        async for mp, status in _iter_in_thread(
+                _iter_forge_mps(forge, ["open", "merged", "closed"])):
+            status_count[status] += 1
+            if unexpected > unexpected_limit:
+                return
+            if forge in forge_rate_limiter:
+                if datetime.utcnow() < forge_rate_limiter[forge]:
+                    del forge_rate_limiter[forge]
+                else:
+                    forge_rate_limited_count.labels(forge=str(forge)).inc()
+                    was_forge_ratelimited = True
+                    continue
+            if is_unchanged_terminal(mp, status):
+                unchanged_urls.append(mp.url)
+                continue
+            try:
+                modified = await check_existing_mp(
+                    conn,
+                    redis,
+                    config,
+                    publish_worker_pool,
+                    mp,
+                    status,
+                    vcs_managers=vcs_managers,
+                    dry_run=dry_run,
+                    external_url=external_url,
+                    differ_url=differ_url,
+                    maintainer_rate_limiter=maintainer_rate_limiter,
+                    possible_transports=possible_transports,
+                    mps_per_maintainer=mps_per_maintainer,
+                    check_only=check_only,
                 )
-                check_only = True
+            except NoRunForMergeProposal as e:
+                logger.warning("Unable to find metadata for %s, skipping.", e.mp.url)
+                modified = False
+            except ForgeLoginRequired as e:
+                logger.warning('Login required for forge %s, skipping.', e)
+                modified = False
+            except BranchRateLimited as e:
+                logger.warning(
+                    "Rate-limited accessing %s. Skipping %r for this cycle.",
+                    mp.url, forge)
+                if e.retry_after is None:
+                    retry_after = timedelta(minutes=30)
+                else:
+                    retry_after = timedelta(seconds=e.retry_after)
+                forge_rate_limiter[forge] = datetime.utcnow() + retry_after
+                continue
+            except UnexpectedHttpStatus as e:
+                logging.warning(
+                    'Got unexpected HTTP status %s, skipping %r',
+                    e, mp.url)
+                # TODO(jelmer): print traceback?
+                unexpected += 1
+                modified = False
+
+            if modified:
+                modified_mps += 1
+                if modify_limit and modified_mps > modify_limit:
+                    logger.warning(
+                        "Already modified %d merge proposals, "
+                        "waiting with the rest.", modified_mps,
+                    )
+                    check_only = True
+
+    forges = await to_thread(list, iter_forge_instances())
+    await asyncio.gather(*[scan_forge(forge) for forge in forges])
+
+    if unexpected > unexpected_limit:
+        unexpected_http_response_count.inc()
+        logging.warning(
+            "Saw %d unexpected HTTP responses, over threshold of %d. "
+            "Giving up for now.", unexpected, unexpected_limit)
+        return
 
     logging.info('Successfully scanned existing merge proposals')
     last_scan_existing_success.set_to_current_time()
@@ -2869,7 +3186,7 @@ async def listen_to_runner(
     db,
     redis,
     config,
-    template_env_path,
+    publish_worker_pool,
     maintainer_rate_limiter,
     vcs_managers,
     dry_run: bool,
@@ -2885,7 +3202,7 @@ async def listen_to_runner(
             await publish_from_policy(
                 conn,
                 get_campaign_config(config, run.suite),
-                template_env_path,
+                publish_worker_pool,
                 maintainer_rate_limiter,
                 vcs_managers,
                 run,
@@ -3027,6 +3344,23 @@ async def main(argv=None):
     parser.add_argument(
         "--template-env-path", type=str,
         help="Path to merge proposal templates")
+    parser.add_argument(
+        "--concurrency", type=int, default=DEFAULT_PUBLISH_CONCURRENCY,
+        help="Number of publish-ready runs to consider at once.")
+    parser.add_argument(
+        "--forge-concurrency", type=int, default=DEFAULT_FORGE_CONCURRENCY,
+        help="Number of publish-ready runs to consider at once per forge host.")
+    parser.add_argument(
+        "--publish-workers", type=int, default=DEFAULT_PUBLISH_WORKERS,
+        help="Number of publish worker processes.")
+    parser.add_argument(
+        "--publish-worker-max-jobs", type=int,
+        default=DEFAULT_PUBLISH_WORKER_MAX_JOBS,
+        help="Number of jobs after which a publish worker is restarted.")
+    parser.add_argument(
+        "--publish-worker-max-rss", type=int,
+        default=DEFAULT_PUBLISH_WORKER_MAX_RSS,
+        help="Memory use (in MB) after which a publish worker is restarted.")
 
     args = parser.parse_args()
 
@@ -3068,12 +3402,18 @@ async def main(argv=None):
         redis = await aioredis.create_redis(config.redis_location)
         stack.callback(redis.close)
 
+        publish_worker_pool = PublishWorkerPool(
+            args.template_env_path, size=args.publish_workers,
+            max_jobs=args.publish_worker_max_jobs,
+            max_rss=args.publish_worker_max_rss)
+        stack.push_async_callback(publish_worker_pool.close)
+
         if args.once:
             await publish_pending_ready(
                 db,
                 redis,
                 config,
-                args.template_env_path,
+                publish_worker_pool,
                 maintainer_rate_limiter,
                 dry_run=args.dry_run,
                 external_url=args.external_url,
@@ -3081,6 +3421,8 @@ async def main(argv=None):
                 vcs_managers=vcs_managers,
                 reviewed_only=args.reviewed_only,
                 require_binary_diff=args.require_binary_diff,
+                concurrency=args.concurrency,
+                forge_concurrency=args.forge_concurrency,
             )
             if args.prometheus:
                 await push_to_gateway(
@@ -3092,7 +3434,7 @@ async def main(argv=None):
                         db,
                         redis,
                         config,
-                        args.template_env_path,
+                        publish_worker_pool,
                         maintainer_rate_limiter,
                         forge_rate_limiter,
                         dry_run=args.dry_run,
@@ -3105,13 +3447,15 @@ async def main(argv=None):
                         push_limit=args.push_limit,
                         modify_mp_limit=args.modify_mp_limit,
                         require_binary_diff=args.require_binary_diff,
+                        concurrency=args.concurrency,
+                        forge_concurrency=args.forge_concurrency,
                     )
                 ),
                 loop.create_task(
                     run_web_server(
                         args.listen_address,
                         args.port,
-                        args.template_env_path,
+                        publish_worker_pool,
                         maintainer_rate_limiter,
                         forge_rate_limiter,
                         vcs_managers,
@@ -3135,7 +3479,7 @@ async def main(argv=None):
                             db,
                             redis,
                             config,
-                            args.template_env_path,
+                            publish_worker_pool,
                             maintainer_rate_limiter,
                             vcs_managers,
                             dry_run=args.dry_run,
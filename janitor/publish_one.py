@@ -20,13 +20,19 @@
 This is the worker module for the publish service. For each branch that needs
 to be published, this module gets invoked. It accepts some JSON on stdin with a
 request, and writes results to standard out as JSON.
+
+With --serve, it instead keeps handling requests (one JSON object per line)
+until stdin is closed, writing one line of JSON per response.
 """
 
 from contextlib import ExitStack
+import json
 import os
-from typing import Optional, List, Any, Dict, Tuple
+from typing import Optional, List, Any, Dict, Tuple, TextIO
 
 import logging
+import resource
+import traceback
 
 import shlex
 
@@ -521,29 +527,24 @@ def publish_one(
     return publish_result, derived_branch_name
 
 
-if __name__ == "__main__":
-    import argparse
-    import json
-    import sys
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        '--template-env-path',
-        type=str,
-        default=os.path.join(
-            os.path.dirname(__file__), '..', "proposal-templates"),
-        help='Path to templates')
-    args = parser.parse_args()
-
-    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
-
-    request = json.load(sys.stdin)
-
-    template_env = Environment(
-        loader=FileSystemLoader(args.template_env_path),
+def load_template_env(path: str) -> Environment:
+    return Environment(
+        loader=FileSystemLoader(path),
         autoescape=select_autoescape(disabled_extensions=('txt', 'md'), default=False),
     )
 
+
+def handle_request(
+    template_env: Environment,
+    request: Dict[str, Any],
+    possible_forges: Optional[List[Forge]] = None,
+    possible_transports: Optional[List[Transport]] = None,
+) -> Tuple[int, Dict[str, Any]]:
+    """Handle a single publish request.
+
+    Returns:
+      tuple with exit status (0 on success, 1 on failure) and response
+    """
     try:
         publish_result, branch_name = publish_one(
             template_env,
@@ -562,8 +563,8 @@ if __name__ == "__main__":
             dry_run=request["dry-run"],
             derived_owner=request.get("derived-owner"),
             require_binary_diff=request["require-binary-diff"],
-            possible_forges=None,
-            possible_transports=None,
+            possible_forges=possible_forges,
+            possible_transports=possible_transports,
             allow_create_proposal=request["allow_create_proposal"],
             differ_url=request["differ_url"],
             reviewers=request.get("reviewers"),
@@ -573,18 +574,81 @@ if __name__ == "__main__":
             existing_mp_url=request.get('existing_mp_url'),
         )
     except PublishFailure as e:
-        json.dump({"code": e.code, "description": e.description}, sys.stdout)
-        sys.exit(1)
+        return 1, {"code": e.code, "description": e.description}
     except PublishNothingToDo as e:
-        json.dump({"code": "nothing-to-do", "description": e.description}, sys.stdout)
-        sys.exit(1)
+        return 1, {"code": "nothing-to-do", "description": e.description}
 
-    result = {}
+    result: Dict[str, Any] = {}
     if publish_result.proposal:
         result["proposal_url"] = publish_result.proposal.url
         result["is_new"] = publish_result.is_new
     result["branch_name"] = branch_name
+    return 0, result
+
+
+def serve(template_env: Environment, requests: TextIO, responses: TextIO) -> None:
+    """Handle publish requests until EOF.
+
+    Forges and transports are kept across requests, so that connections
+    (and forge logins) can be reused.
+    """
+    possible_forges: List[Forge] = []
+    possible_transports: List[Transport] = []
+    for line in requests:
+        request = json.loads(line)
+        try:
+            status, response = handle_request(
+                template_env, request, possible_forges=possible_forges,
+                possible_transports=possible_transports)
+        except Exception:
+            logging.exception('Error publishing %s', request.get('log_id'))
+            status, response = 1, {
+                "code": "publisher-invalid-response",
+                "description": traceback.format_exc()}
+            # Don't reuse connections that may be in a bad state.
+            possible_transports = []
+        json.dump({
+            "status": status,
+            "response": response,
+            # Peak resident set size, in kilobytes
+            "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }, responses)
+        responses.write("\n")
+        responses.flush()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--template-env-path',
+        type=str,
+        default=os.path.join(
+            os.path.dirname(__file__), '..', "proposal-templates"),
+        help='Path to templates')
+    parser.add_argument(
+        '--serve', action='store_true',
+        help='Handle requests (one per line) until stdin is closed.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    template_env = load_template_env(args.template_env_path)
+
+    if args.serve:
+        # Keep the response stream to ourselves; anything else that writes
+        # to stdout ends up on stderr.
+        responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        serve(template_env, sys.stdin, responses)
+        sys.exit(0)
+
+    request = json.load(sys.stdin)
+
+    status, response = handle_request(template_env, request)
 
-    json.dump(result, sys.stdout)
+    json.dump(response, sys.stdout)
 
-    sys.exit(0)
+    sys.exit(status)
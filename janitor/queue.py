@@ -16,7 +16,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from datetime import timedelta
-from typing import Optional
+from typing import Optional, Iterable, Dict, Any, List, Tuple
 
 
 import asyncpg
@@ -94,13 +94,55 @@ class Queue(object):
         self.conn = conn
 
     async def get_position(self, campaign, package):
-        row = await self.conn.fetchrow(
-            "SELECT position, wait_time FROM queue_positions "
-            "WHERE package = $1 AND suite = $2",
-            package, campaign)
-        if not row:
-            return (None, None)
-        return row
+        return (await self.get_positions([(campaign, package)])).get(
+            (campaign, package), (None, None))
+
+    async def get_positions(
+        self, items: Iterable[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], Tuple[int, Optional[timedelta]]]:
+        """Look up the queue positions for a set of campaign/package pairs.
+
+        Args:
+          items: Iterable over (campaign, package) tuples
+        Returns:
+          dictionary mapping (campaign, package) to (position, wait_time)
+          for the pairs that are queued
+        """
+        items = list(items)
+        query = """
+SELECT DISTINCT ON (queue.package, queue.suite)
+    queue.package AS package,
+    queue.suite AS campaign,
+    coalesce(p.position, pred.position + 1, 1) AS position,
+    coalesce(
+        p.wait_time,
+        pred.wait_time + coalesce(pred.estimated_duration, interval '0'),
+        interval '0') AS wait_time
+FROM
+    queue
+LEFT JOIN queue_positions p ON p.id = queue.id
+LEFT JOIN LATERAL (
+    SELECT position, wait_time, estimated_duration
+    FROM queue_positions
+    WHERE p.id IS NULL
+      AND (bucket, priority, id) < (queue.bucket, queue.priority, queue.id)
+    ORDER BY bucket DESC, priority DESC, id DESC
+    LIMIT 1) pred ON true
+WHERE (queue.suite, queue.package) IN (
+    SELECT * FROM unnest($1::text[], $2::text[]))
+ORDER BY queue.package, queue.suite,
+    queue.bucket ASC, queue.priority ASC, queue.id ASC
+"""
+        return {
+            (row['campaign'], row['package']): (
+                row['position'], row['wait_time'])
+            for row in await self.conn.fetch(
+                query, [c for (c, p) in items], [p for (c, p) in items])}
+
+    async def refresh_positions(self) -> None:
+        """Recalculate the materialized queue positions."""
+        await self.conn.execute(
+            "REFRESH MATERIALIZED VIEW CONCURRENTLY queue_positions")
 
     async def get_item(self, queue_id: int):
         query = """
@@ -161,6 +203,75 @@ queue.id ASC
         for row in await self.conn.fetch(query, *args):
             yield QueueItem.from_row(row)
 
+    async def next_item(
+            self,
+            package: Optional[str] = None,
+            campaign: Optional[str] = None,
+            exclude: Optional[Iterable[int]] = None,
+            avoid_hosts: Optional[Iterable[str]] = None
+    ) -> Tuple[Optional[QueueItem], Optional[Dict[str, Any]]]:
+        """Select and lock the next eligible queue item.
+
+        The item is returned together with the VCS information of its package.
+        Rows that are locked by a concurrent transaction are skipped, so the
+        caller should hold a transaction open until it has claimed the item.
+
+        Args:
+          package: Only consider items for this package
+          campaign: Only consider items for this campaign
+          exclude: Queue ids to skip (e.g. because they are already assigned)
+          avoid_hosts: Hosts whose branches should not be processed
+        Returns:
+          tuple with QueueItem and VCS info dict, or (None, None)
+        """
+        query = """
+SELECT
+    queue.package AS package,
+    queue.command AS command,
+    queue.context AS context,
+    queue.id AS id,
+    queue.estimated_duration AS estimated_duration,
+    queue.suite AS campaign,
+    queue.refresh AS refresh,
+    queue.requestor AS requestor,
+    queue.change_set AS change_set,
+    package.vcs_type AS vcs_type,
+    package.branch_url AS branch_url,
+    package.subpath AS subpath
+FROM
+    queue
+LEFT JOIN package ON package.name = queue.package
+WHERE
+    NOT (queue.id = ANY($1::int[])) AND
+    (package.branch_url IS NULL OR NOT coalesce(
+        lower((regexp_match(package.branch_url, '^[^:/]+://(?:[^/@]*@)?([^/:,]+)'))[1])
+        = ANY($2::text[]), False))
+"""
+        args = [list(exclude or []), [host.lower() for host in avoid_hosts or []]]
+        if package:
+            args.append(package)
+            query += " AND queue.package = $%d" % len(args)
+        if campaign:
+            args.append(campaign)
+            query += " AND queue.suite = $%d" % len(args)
+        query += """
+ORDER BY
+queue.bucket ASC,
+queue.priority ASC,
+queue.id ASC
+LIMIT 1
+FOR UPDATE OF queue SKIP LOCKED
+"""
+        row = await self.conn.fetchrow(query, *args)
+        if row is None:
+            return None, None
+        vcs_info = {
+            'vcs_type': row['vcs_type'],
+            'branch_url': row['branch_url'],
+            'subpath': row['subpath'],
+        }
+        return QueueItem.from_row(row), vcs_info
+
     async def add(
             self,
             package: str,
@@ -173,35 +284,88 @@ queue.id ASC
             estimated_duration: Optional[timedelta] = None,
             refresh: bool = False,
             requestor: Optional[str] = None) -> None:
-        await self.conn.execute(
-            "INSERT INTO queue "
-            "(package, command, priority, bucket, context, "
-            "estimated_duration, suite, refresh, requestor, change_set) "
-            "VALUES "
-            "($1, $2, "
-            "(SELECT COALESCE(MIN(priority), 0) FROM queue)"
-            + " + $3, $4, $5, $6, $7, $8, $9, $10) "
-            "ON CONFLICT (package, suite, coalesce(change_set, ''::text)) "
-            "DO UPDATE SET "
-            "context = EXCLUDED.context, priority = EXCLUDED.priority, "
-            "bucket = EXCLUDED.bucket, "
-            "estimated_duration = EXCLUDED.estimated_duration, "
-            "refresh = EXCLUDED.refresh, requestor = EXCLUDED.requestor, "
-            "command = EXCLUDED.command "
-            "WHERE queue.bucket >= EXCLUDED.bucket OR "
-            "(queue.bucket = EXCLUDED.bucket AND "
-            "queue.priority >= EXCLUDED.priority)",
-            package,
-            command,
-            offset,
-            bucket,
-            context,
-            estimated_duration,
-            campaign,
-            refresh,
-            requestor,
-            change_set,
-        )
+        await self.add_many([dict(
+            package=package, command=command, campaign=campaign,
+            change_set=change_set, offset=offset, bucket=bucket,
+            context=context, estimated_duration=estimated_duration,
+            refresh=refresh, requestor=requestor)])
+
+    async def add_many(
+        self, items: Iterable[Dict[str, Any]]
+    ) -> Tuple[List[Tuple[str, str, Optional[str]]],
+               List[Tuple[str, str, Optional[str]]]]:
+        """Add several items to the queue.
+
+        The priority base is determined once, and all items are upserted
+        in a single statement. If there are several items for the same
+        package, campaign and change set, the one that would run first wins.
+
+        Args:
+          items: Iterable over dictionaries with the same keys as the
+            arguments to add()
+        Returns:
+          tuple with lists of (package, campaign, change_set) for the
+          inserted and the updated queue items; existing items that would
+          run earlier are left alone and not included
+        """
+        items = list(items)
+        if not items:
+            return [], []
+        query = """
+WITH base AS (
+    SELECT COALESCE(MIN(priority), 0) AS priority FROM queue
+), item AS (
+    SELECT DISTINCT ON (package, suite, coalesce(change_set, ''))
+        *
+    FROM unnest(
+        $1::text[], $2::text[], $3::float8[], $4::queue_bucket[],
+        $5::text[], $6::interval[], $7::text[], $8::boolean[],
+        $9::text[], $10::text[]) WITH ORDINALITY AS i(
+        package, command, "offset", bucket, context, estimated_duration,
+        suite, refresh, requestor, change_set, n)
+    ORDER BY package, suite, coalesce(change_set, ''),
+        bucket ASC, "offset" ASC, n DESC
+)
+INSERT INTO queue
+    (package, command, priority, bucket, context, estimated_duration,
+     suite, refresh, requestor, change_set)
+SELECT
+    item.package, item.command, base.priority + item."offset",
+    item.bucket, item.context, item.estimated_duration, item.suite,
+    item.refresh, item.requestor, item.change_set
+FROM item, base
+ON CONFLICT (package, suite, coalesce(change_set, ''::text))
+DO UPDATE SET
+    context = EXCLUDED.context, priority = EXCLUDED.priority,
+    bucket = EXCLUDED.bucket,
+    estimated_duration = EXCLUDED.estimated_duration,
+    refresh = EXCLUDED.refresh, requestor = EXCLUDED.requestor,
+    command = EXCLUDED.command
+WHERE queue.bucket >= EXCLUDED.bucket OR
+    (queue.bucket = EXCLUDED.bucket AND queue.priority >= EXCLUDED.priority)
+RETURNING package, suite AS campaign, change_set, xmax = 0 AS inserted
+"""
+        rows = await self.conn.fetch(
+            query,
+            [item['package'] for item in items],
+            [item['command'] for item in items],
+            [item.get('offset', 0.0) for item in items],
+            [item.get('bucket', 'default') for item in items],
+            [item.get('context') for item in items],
+            [item.get('estimated_duration') for item in items],
+            [item['campaign'] for item in items],
+            [item.get('refresh', False) for item in items],
+            [item.get('requestor') for item in items],
+            [item.get('change_set') for item in items])
+        inserted = []
+        updated = []
+        for row in rows:
+            key = (row['package'], row['campaign'], row['change_set'])
+            if row['inserted']:
+                inserted.append(key)
+            else:
+                updated.append(key)
+        return inserted, updated
 
     async def get_buckets(self):
         return await self.conn.fetch(
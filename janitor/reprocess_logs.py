@@ -24,7 +24,7 @@ from typing import Optional
 import silver_platter  # noqa: E402, F401
 from buildlog_consultant.common import find_build_failure_description  # noqa: E402
 from buildlog_consultant.sbuild import worker_failure_from_sbuild_log  # noqa: E402
-from janitor.schedule import do_schedule  # noqa: E402
+from janitor.schedule import do_schedule, refresh_run_statistics  # noqa: E402
 
 
 def process_sbuild_log(logf):
@@ -131,7 +131,7 @@ async def reprocess_run_logs(
             new_phase
         )
         if not dry_run:
-            async with db.acquire() as conn:
+            async with db.acquire() as conn, conn.transaction():
                 await conn.execute(
                     "UPDATE run SET result_code = $1, description = $2, failure_details = $3 WHERE id = $4",
                     new_code,
@@ -139,6 +139,7 @@ async def reprocess_run_logs(
                     new_failure_details,
                     log_id,
                 )
+                await refresh_run_statistics(conn, [(package, campaign)])
                 if reschedule and new_code != result_code:
                     await do_schedule(
                         conn,
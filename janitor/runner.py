@@ -16,10 +16,12 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import asyncio
+import calendar
 from contextlib import AsyncExitStack
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from email.utils import parseaddr
+import heapq
 import json
 from io import BytesIO
 import logging
@@ -27,6 +29,7 @@ import os
 import ssl
 import sys
 import tempfile
+import time
 from typing import List, Any, Optional, Dict, Tuple, Type, Set, Iterator
 import uuid
 import warnings
@@ -98,7 +101,11 @@ from .logs import (
 )
 from .policy import read_policy, PolicyConfig
 from .queue import QueueItem, Queue
-from .schedule import do_schedule_control, do_schedule
+from .schedule import (
+    do_schedule_control,
+    do_schedule,
+    update_run_statistics,
+)
 from .vcs import (
     get_vcs_abbreviation,
     is_authenticated_url,
@@ -118,6 +125,9 @@ DEFAULT_RETRY_AFTER = 120
 REMOTE_BRANCH_OPEN_TIMEOUT = 10.0
 VCS_STORE_BRANCH_OPEN_TIMEOUT = 5.0
 
+# Maximum number of concurrent uploads per run, for both logs and artifacts.
+MAX_CONCURRENT_UPLOADS = 8
+
 
 routes = web.RouteTableDef()
 run_count = Counter("run_count", "Number of runs executed.")
@@ -135,6 +145,8 @@ primary_logfile_upload_failed_count = Counter(
     "primary_logfile_upload_failed", "Number of failed logs to primary logfile target")
 logfile_uploaded_count = Counter(
     "logfile_uploads", "Number of uploaded log files")
+logfile_upload_duration = Histogram(
+    "logfile_upload_duration", "Time spent uploading a single log file")
 
 
 async def to_thread_timeout(timeout, func, *args, **kwargs):
@@ -418,6 +430,8 @@ class JanitorResult(object):
         self.worker_name = worker_name
         self.vcs_type = vcs_type
         self.change_set = change_set
+        self.artifacts = None
+        self.artifacts_in_backup = False
         if worker_result is not None:
             self.context = worker_result.context
             self.code = worker_result.code or code
@@ -653,6 +667,38 @@ def gather_logs(output_directory: str) -> Iterator[os.DirEntry]:
             yield entry
 
 
+async def import_log(
+    entry,
+    logfile_manager: LogFileManager,
+    backup_logfile_manager: Optional[LogFileManager],
+    pkg: str,
+    log_id: str,
+    mtime: Optional[int] = None,
+):
+    try:
+        with logfile_upload_duration.time():
+            await logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
+    except ServiceUnavailable as e:
+        logging.warning("Unable to upload logfile %s: %s", entry.name, e)
+        primary_logfile_upload_failed_count.inc()
+        if backup_logfile_manager:
+            await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
+    except asyncio.TimeoutError as e:
+        logging.warning("Timeout uploading logfile %s: %s", entry.name, e)
+        primary_logfile_upload_failed_count.inc()
+        if backup_logfile_manager:
+            await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
+    except PermissionDenied as e:
+        logging.warning(
+            "Permission denied error while uploading logfile %s: %s",
+            entry.name, e)
+        primary_logfile_upload_failed_count.inc()
+        if backup_logfile_manager:
+            await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
+    else:
+        logfile_uploaded_count.inc()
+
+
 async def import_logs(
     entries,
     logfile_manager: LogFileManager,
@@ -660,29 +706,28 @@ async def import_logs(
     pkg: str,
     log_id: str,
     mtime: Optional[int] = None,
+    max_concurrent: int = MAX_CONCURRENT_UPLOADS,
 ):
-    for entry in entries:
-        try:
-            await logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
-        except ServiceUnavailable as e:
-            logging.warning("Unable to upload logfile %s: %s", entry.name, e)
-            primary_logfile_upload_failed_count.inc()
-            if backup_logfile_manager:
-                await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
-        except asyncio.TimeoutError as e:
-            logging.warning("Timeout uploading logfile %s: %s", entry.name, e)
-            primary_logfile_upload_failed_count.inc()
-            if backup_logfile_manager:
-                await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
-        except PermissionDenied as e:
-            logging.warning(
-                "Permission denied error while uploading logfile %s: %s",
-                entry.name, e)
-            primary_logfile_upload_failed_count.inc()
-            if backup_logfile_manager:
-                await backup_logfile_manager.import_log(pkg, log_id, entry.path, mtime=mtime)
-        else:
-            logfile_uploaded_count.inc()
+    """Upload a set of log files concurrently.
+
+    Args:
+      max_concurrent: Maximum number of log files to upload at once
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def _import_log(entry):
+        async with sem:
+            await import_log(
+                entry, logfile_manager, backup_logfile_manager, pkg, log_id,
+                mtime=mtime)
+
+    # Let all uploads finish before raising, since the caller is likely
+    # to remove the log files.
+    for ret in await asyncio.gather(
+            *[_import_log(entry) for entry in entries],
+            return_exceptions=True):
+        if isinstance(ret, BaseException):
+            raise ret
 
 
 class ActiveRunDisappeared(Exception):
@@ -974,7 +1019,8 @@ class PollingBackchannel(Backchannel):
                     'Failed to ping client %s: %r', self.my_url, err)
                 return False
 
-            if log_id != expected_log_id:
+            # Workers that have leased a batch of runs report all of them.
+            if expected_log_id not in log_id.splitlines():
                 raise ActiveRunDisappeared(
                     'Worker started processing new run %s rather than %s' %
                     (log_id, expected_log_id))
@@ -1237,6 +1283,21 @@ async def store_run(
             ],
         )
 
+    await update_run_statistics(
+        conn, name, campaign, result_code, instigated_context, context,
+        failure_details, finish_time - start_time)
+
+
+async def store_artifact_manifest(
+    conn: asyncpg.Connection, run_id: str,
+    artifacts: Dict[str, Dict[str, Any]], backup: bool = False
+) -> None:
+    await conn.executemany(
+        "INSERT INTO artifact (run_id, name, size, sha256, backup) "
+        "VALUES ($1, $2, $3, $4, $5)",
+        [(run_id, name, entry["size"], entry["sha256"], backup)
+         for (name, entry) in artifacts.items()])
+
 
 def has_relation(v, pkg):
     from debian.deb822 import PkgRelation
@@ -1397,6 +1458,38 @@ async def change_set_ready(conn, change_set_id):
     return True
 
 
+class RateLimitedHosts(object):
+    """Index of rate limited hosts, keyed on the time the limit expires."""
+
+    def __init__(self):
+        self._until: Dict[str, datetime] = {}
+        self._expiry: List[Tuple[datetime, str]] = []
+
+    def set(self, host: str, until: datetime) -> None:
+        self._until[host] = until
+        heapq.heappush(self._expiry, (until, host))
+
+    def _expire(self) -> None:
+        now = datetime.now()
+        while self._expiry and self._expiry[0][0] <= now:
+            until, host = heapq.heappop(self._expiry)
+            # The host may have been rate limited again since.
+            if self._until.get(host) == until:
+                del self._until[host]
+
+    def __contains__(self, host: str) -> bool:
+        self._expire()
+        return host in self._until
+
+    def hosts(self) -> Set[str]:
+        self._expire()
+        return set(self._until)
+
+    def json(self) -> Dict[str, str]:
+        self._expire()
+        return {host: until.isoformat() for (host, until) in self._until.items()}
+
+
 class QueueProcessor(object):
 
     avoid_hosts: Set[str]
@@ -1417,9 +1510,18 @@ class QueueProcessor(object):
         committer: Optional[str] = None,
         backup_artifact_manager: Optional[ArtifactManager] = None,
         backup_logfile_manager: Optional[LogFileManager] = None,
-        avoid_hosts: Optional[Set[str]] = None
+        avoid_hosts: Optional[Set[str]] = None,
+        status_interval: int = 30,
+        queue_position_interval: int = 30,
     ):
         """Create a queue processor.
+
+        Args:
+          status_interval: Minimum number of seconds between publishing
+            full queue status snapshots; changes in between are published
+            as deltas
+          queue_position_interval: Number of seconds between refreshes
+            of the materialized queue positions
         """
         self.database = database
         self.redis = redis
@@ -1436,7 +1538,14 @@ class QueueProcessor(object):
         self.backup_logfile_manager = backup_logfile_manager
         self.run_timeout = run_timeout
         self.avoid_hosts = avoid_hosts or set()
+        self.rate_limit_hosts = RateLimitedHosts()
+        self.status_interval = status_interval
+        self.queue_position_interval = queue_position_interval
         self._watch_dog = None
+        self._status_publisher = None
+        self._queue_position_refresher = None
+        self._status_dirty = True
+        self._rate_limit_listener = None
 
     def start_watchdog(self):
         if self._watch_dog is not None:
@@ -1453,55 +1562,212 @@ class QueueProcessor(object):
             pass
         self._watch_dog = None
 
+    def start_status_publisher(self):
+        if self._status_publisher is not None:
+            raise Exception("Status publisher already started")
+        self._status_publisher = create_background_task(
+            self._publish_status(), 'status publisher for %r' % self)
+
+    def stop_status_publisher(self):
+        if self._status_publisher is None:
+            return
+        try:
+            self._status_publisher.cancel()
+        except asyncio.CancelledError:
+            pass
+        self._status_publisher = None
+
+    def start_queue_position_refresher(self):
+        if self._queue_position_refresher is not None:
+            raise Exception("Queue position refresher already started")
+        self._queue_position_refresher = create_background_task(
+            self._refresh_queue_positions(),
+            'queue position refresher for %r' % self)
+
+    def stop_queue_position_refresher(self):
+        if self._queue_position_refresher is None:
+            return
+        try:
+            self._queue_position_refresher.cancel()
+        except asyncio.CancelledError:
+            pass
+        self._queue_position_refresher = None
+
+    async def _refresh_queue_positions(self):
+        while True:
+            try:
+                async with self.database.acquire() as conn:
+                    await Queue(conn).refresh_positions()
+            except asyncpg.PostgresError as e:
+                logging.warning('Failed to refresh queue positions: %s', e)
+            await asyncio.sleep(self.queue_position_interval)
+
+    async def _publish_status(self):
+        while True:
+            if self._status_dirty:
+                self._status_dirty = False
+                await self.redis.publish_json('queue', await self.status_json())
+            await asyncio.sleep(self.status_interval)
+
+    async def _publish_status_delta(self, delta):
+        """Publish a change to the queue status.
+
+        Subscribers can apply these to the last full snapshot they received.
+        """
+        self._status_dirty = True
+        await self.redis.publish_json('queue', delta)
+
+    async def start_rate_limit_listener(self, redis):
+        """Start tracking rate limited hosts.
+
+        Args:
+          redis: Redis connection pool to use for the subscription; this can
+            not be shared with other users. A pool is needed so that a new
+            connection can be used when the subscription is lost.
+        """
+        if self._rate_limit_listener is not None:
+            raise Exception("Rate limit listener already started")
+        ch = await self._subscribe_rate_limits(redis)
+        self._rate_limit_listener = create_background_task(
+            self._listen_rate_limits(redis, ch),
+            'rate limit listener for %r' % self)
+
+    def stop_rate_limit_listener(self):
+        if self._rate_limit_listener is None:
+            return
+        try:
+            self._rate_limit_listener.cancel()
+        except asyncio.CancelledError:
+            pass
+        self._rate_limit_listener = None
+
+    async def _subscribe_rate_limits(self, redis):
+        # Subscribe before loading the current state, so no updates get lost.
+        ch = (await redis.subscribe('rate-limit-hosts'))[0]
+        for host, until in (await self.redis.hgetall('rate-limit-hosts')).items():
+            self.rate_limit_hosts.set(
+                host.decode('utf-8'),
+                datetime.fromisoformat(until.decode('utf-8')))
+        return ch
+
+    # Number of seconds to wait before resubscribing to rate limit updates
+    RATE_LIMIT_RESUBSCRIBE_INTERVAL = 5
+
+    async def _listen_rate_limits(self, redis, ch):
+        while True:
+            if ch is not None:
+                while (await ch.wait_message()):
+                    msg = await ch.get_json()
+                    self.rate_limit_hosts.set(
+                        msg['host'], datetime.fromisoformat(msg['until']))
+                logging.warning(
+                    'Rate limit channel closed; resubscribing in %d seconds.',
+                    self.RATE_LIMIT_RESUBSCRIBE_INTERVAL)
+            await asyncio.sleep(self.RATE_LIMIT_RESUBSCRIBE_INTERVAL)
+            try:
+                ch = await self._subscribe_rate_limits(redis)
+            except (aioredis.RedisError, OSError) as e:
+                logging.warning(
+                    'Unable to resubscribe to rate limit updates: %s', e)
+                ch = None
+
     KEEPALIVE_INTERVAL = 10
 
+    # Maximum number of workers to ping at the same time
+    MAX_CONCURRENT_PINGS = 20
+
+    async def _backfill_keepalives(self):
+        """Add keepalive scores for active runs that don't have one.
+
+        Runs registered before keepalives were tracked in the 'keepalives'
+        sorted set only have an entry in the 'last-keepalive' hash, if any.
+        """
+        active_runs = await self.redis.hgetall('active-runs')
+        legacy_keepalives = await self.redis.hgetall('last-keepalive')
+        pairs: List[Any] = []
+        for log_id, serialized in active_runs.items():
+            lk = legacy_keepalives.get(log_id)
+            if lk:
+                last_keepalive = datetime.fromisoformat(lk.decode('utf-8'))
+            else:
+                last_keepalive = ActiveRun.from_json(
+                    json.loads(serialized)).start_time
+            pairs.extend(
+                [calendar.timegm(last_keepalive.utctimetuple()), log_id])
+        if pairs:
+            await self.redis.zadd(
+                'keepalives', *pairs, exist=self.redis.ZSET_IF_NOT_EXIST)
+        await self.redis.delete('last-keepalive')
+
     async def _watchdog(self):
+        await self._backfill_keepalives()
         while True:
-            for serialized in (await self.redis.hgetall('active-runs')).values():
-                js = json.loads(serialized)
-                active_run = ActiveRun.from_json(js)
-                lk = await self.redis.hget('last-keepalive', js['id'])
-                if lk:
-                    last_keepalive = datetime.fromisoformat(lk.decode('utf-8'))
-                else:
-                    last_keepalive = active_run.start_time
-                keepalive_age = datetime.utcnow() - last_keepalive
-                if keepalive_age < timedelta(minutes=(self.run_timeout // 3)):
-                    continue
-                try:
-                    if await active_run.ping():
-                        await self.redis.hset(
-                            'last-keepalive', active_run.log_id,
-                            datetime.utcnow().isoformat())
-                        keepalive_age = timedelta(seconds=0)
-                except ActiveRunDisappeared as e:
-                    if keepalive_age > timedelta(minutes=self.run_timeout):
-                        try:
-                            await self.abort_run(active_run, 'run-disappeared', e.reason)
-                        except RunExists:
-                            logging.warning('Run not properly cleaned up?')
-                        continue
-                if keepalive_age > timedelta(minutes=self.run_timeout):
-                    logging.warning(
-                        "No keepalives received from %s for %s in %s, aborting.",
-                        active_run.worker_name,
-                        active_run.log_id,
-                        keepalive_age,
-                    )
-                    try:
-                        await self.abort_run(
-                            active_run, code='worker-timeout',
-                            description=("No keepalives received in %s." % keepalive_age))
-                    except RunExists:
-                        logging.warning('Run not properly cleaned up?')
-                    continue
+            # Only runs that haven't sent a keepalive recently need a ping.
+            stale = await self.redis.zrangebyscore(
+                'keepalives',
+                max=time.time() - (self.run_timeout // 3) * 60,
+                withscores=True)
+            if stale:
+                serialized_runs = await self.redis.hmget(
+                    'active-runs', *[log_id for (log_id, score) in stale])
+                missing = [
+                    log_id for (serialized, (log_id, score))
+                    in zip(serialized_runs, stale) if serialized is None]
+                if missing:
+                    # The run was unclaimed without its keepalive being removed.
+                    await self.redis.zrem('keepalives', *missing)
+                sem = asyncio.Semaphore(self.MAX_CONCURRENT_PINGS)
+
+                async def check(serialized, last_keepalive):
+                    async with sem:
+                        await self._check_keepalive(
+                            ActiveRun.from_json(json.loads(serialized)),
+                            last_keepalive)
+
+                await asyncio.gather(*[
+                    check(serialized, datetime.utcfromtimestamp(score))
+                    for (serialized, (log_id, score)) in zip(serialized_runs, stale)
+                    if serialized is not None])
             await asyncio.sleep(self.KEEPALIVE_INTERVAL)
 
+    async def _check_keepalive(self, active_run, last_keepalive):
+        keepalive_age = datetime.utcnow() - last_keepalive
+        try:
+            if await active_run.ping():
+                await self.redis.zadd(
+                    'keepalives', time.time(), active_run.log_id)
+                await self._publish_status_delta({
+                    'delta': 'keepalive',
+                    'id': active_run.log_id,
+                    'last-keepalive': datetime.utcnow().isoformat(
+                        timespec='seconds')})
+                keepalive_age = timedelta(seconds=0)
+        except ActiveRunDisappeared as e:
+            if keepalive_age > timedelta(minutes=self.run_timeout):
+                try:
+                    await self.abort_run(active_run, 'run-disappeared', e.reason)
+                except RunExists:
+                    logging.warning('Run not properly cleaned up?')
+                return
+        if keepalive_age > timedelta(minutes=self.run_timeout):
+            logging.warning(
+                "No keepalives received from %s for %s in %s, aborting.",
+                active_run.worker_name,
+                active_run.log_id,
+                keepalive_age,
+            )
+            try:
+                await self.abort_run(
+                    active_run, code='worker-timeout',
+                    description=("No keepalives received in %s." % keepalive_age))
+            except RunExists:
+                logging.warning('Run not properly cleaned up?')
+
     async def status_json(self) -> Any:
-        rate_limit_hosts = await self.redis.hgetall('rate-limit-hosts')
         last_keepalives = {
-            r.decode('utf-8'): datetime.fromisoformat(v.decode('utf-8'))
-            for (r, v) in (await self.redis.hgetall('last-keepalive')).items()}
+            r.decode('utf-8'): datetime.utcfromtimestamp(score)
+            for (r, score) in await self.redis.zrange(
+                'keepalives', withscores=True)}
         processing = []
         for e in (await self.redis.hgetall('active-runs')).values():
             js = json.loads(e)
@@ -1518,7 +1784,7 @@ class QueueProcessor(object):
         return {
             "processing": processing,
             "avoid_hosts": list(self.avoid_hosts),
-            "rate_limit_hosts": rate_limit_hosts,
+            "rate_limit_hosts": self.rate_limit_hosts.json(),
         }
 
     async def register_run(self, active_run: ActiveRun) -> None:
@@ -1527,10 +1793,13 @@ class QueueProcessor(object):
             'active-runs', active_run.log_id, json.dumps(active_run.json()))
         tr.hset(
             'assigned-queue-items', str(active_run.queue_id), active_run.log_id)
-        tr.hset(
-            'last-keepalive', active_run.log_id, datetime.utcnow().isoformat())
+        tr.zadd('keepalives', time.time(), active_run.log_id)
         await tr.execute()
-        await self.redis.publish_json('queue', await self.status_json())
+        js = active_run.json()
+        js['last-keepalive'] = datetime.utcnow().isoformat(timespec='seconds')
+        js['keepalive_age'] = 0
+        js['mia'] = False
+        await self._publish_status_delta({'delta': 'add', 'run': js})
         active_run_count.labels(worker=active_run.worker_name).inc()
         run_count.inc()
 
@@ -1549,8 +1818,9 @@ class QueueProcessor(object):
         tr = self.redis.multi_exec()
         tr.hdel('assigned-queue-items', str(active_run.queue_id))
         tr.hdel('active-runs', log_id)
-        tr.hdel('last-keepalive', log_id)
+        tr.zrem('keepalives', log_id)
         await tr.execute()
+        await self._publish_status_delta({'delta': 'remove', 'id': log_id})
 
     async def abort_run(self, run: ActiveRun, code: str, description: str) -> None:
         result = run.create_result(
@@ -1608,6 +1878,10 @@ class QueueProcessor(object):
                     logging.info('Unique violation error creating run: %r', e)
                     await self.unclaim_run(result.log_id)
                     raise RunExists(result.log_id)
+                if result.artifacts:
+                    await store_artifact_manifest(
+                        conn, result.log_id, result.artifacts,
+                        backup=result.artifacts_in_backup)
                 if result.builder_result:
                     await result.builder_result.store(conn, result.log_id)
                 await conn.execute("DELETE FROM queue WHERE id = $1", active_run.queue_id)
@@ -1624,15 +1898,17 @@ class QueueProcessor(object):
 
         await self.redis.publish_json('result', result.json())
         await self.unclaim_run(result.log_id)
-        await self.redis.publish_json('queue', await self.status_json())
         last_success_gauge.set_to_current_time()
 
     async def rate_limited(self, host, retry_after):
         rate_limited_count.labels(host=host).inc()
         if not retry_after:
             retry_after = datetime.now() + timedelta(seconds=DEFAULT_RETRY_AFTER)
+        self.rate_limit_hosts.set(host, retry_after)
         await self.redis.hset(
             'rate-limit-hosts', host, retry_after.isoformat())
+        await self.redis.publish_json(
+            'rate-limit-hosts', {'host': host, 'until': retry_after.isoformat()})
 
     async def can_process_url(self, url) -> bool:
         if url is None:
@@ -1640,25 +1916,37 @@ class QueueProcessor(object):
         host = urlutils.URL.from_string(url).host
         if host in self.avoid_hosts:
             return False
-        until = await self.redis.hget('rate-limit-hosts', host)
-        if until and datetime.fromisoformat(until.decode('utf-8')) > datetime.now():
+        if host in self.rate_limit_hosts:
             return False
         return True
 
     async def next_queue_item(self, conn, package=None, campaign=None):
-        limit = (await self.redis.hlen('active-runs')) + 300
+        """Find and claim the next queue item that can be processed.
+
+        The item is marked as assigned in redis; the claim is released again
+        by unclaim_run().
+        """
+        assigned = {
+            int(queue_id)
+            for queue_id in await self.redis.hkeys('assigned-queue-items')}
+        avoid_hosts = self.avoid_hosts | self.rate_limit_hosts.hosts()
         queue = Queue(conn)
-        async for item in queue.iter_queue(
-                limit=limit, campaign=campaign, package=package):
-            if await self.is_queue_item_assigned(item.id):
-                continue
-            vcs_info = await conn.fetchrow(
-                'SELECT vcs_type, branch_url, subpath FROM package '
-                'WHERE name = $1', item.package)
-            if vcs_info and not (await self.can_process_url(vcs_info["branch_url"])):
-                continue
-            return item, dict(vcs_info) if vcs_info else None
-        return None, None
+        while True:
+            async with conn.transaction():
+                item, vcs_info = await queue.next_item(
+                    package=package, campaign=campaign, exclude=assigned,
+                    avoid_hosts=avoid_hosts)
+                if item is None:
+                    return None, None
+                # The row lock only protects us against other transactions;
+                # the claim in redis is what sticks around for the duration
+                # of the run.
+                if await self.redis.hsetnx(
+                        'assigned-queue-items', str(item.id), ''):
+                    return item, vcs_info
+            # Somebody else claimed this item after we read the assigned
+            # items.
+            assigned.add(item.id)
 
     async def is_queue_item_assigned(self, queue_item_id: int) -> bool:
         """Check if a queue item has been assigned already."""
@@ -1782,6 +2070,20 @@ async def handle_get_active_runs(request):
 @routes.post("/active-runs", name="assign")
 async def handle_assign(request):
     json = await request.json()
+    try:
+        count = int(request.query.get('count', '1'))
+    except ValueError:
+        raise web.HTTPBadRequest(text='invalid count')
+    if count < 1:
+        raise web.HTTPBadRequest(text='count should be at least 1')
+    if 'count' in request.query:
+        return await next_items(
+            request, count, worker=json.get("worker"),
+            worker_link=json.get("worker_link"),
+            backchannel=json['backchannel'],
+            package=json.get('package'),
+            campaign=json.get('campaign')
+        )
     assignment_count.labels(worker=json.get("worker")).inc()
     return await next_item(
         request, 'assign', worker=json.get("worker"),
@@ -1821,163 +2123,179 @@ async def handle_queue(request):
     return web.json_response(response_obj)
 
 
-async def next_item(request, mode, worker=None, worker_link=None, backchannel=None, package=None, campaign=None):
-    possible_transports = []
-    possible_forges = []
+async def abort_assignment(queue_processor, active_run, code, description):
+    result = active_run.create_result(
+        branch_url=active_run.main_branch_url,
+        vcs_type=active_run.vcs_type,
+        code=code,
+        description=description
+    )
+    try:
+        await queue_processor.finish_run(active_run, result)
+    except RunExists:
+        pass
 
-    span = aiozipkin.request_span(request)
 
-    async def abort(active_run, code, description):
-        result = active_run.create_result(
-            branch_url=active_run.main_branch_url,
-            vcs_type=active_run.vcs_type,
-            code=code,
-            description=description
+async def claim_active_run(
+        queue_processor, conn, span, worker=None, worker_link=None,
+        backchannel=None, package=None, campaign=None):
+    """Claim the next queue item and register an active run for it.
+
+    Returns:
+      tuple with ActiveRun, QueueItem, VCS info and campaign config, or None
+      if the queue is empty
+    """
+    while True:
+        with span.new_child('sql:queue-item'):
+            item, vcs_info = await queue_processor.next_queue_item(
+                conn, package=package, campaign=campaign)
+        if item is None:
+            return None
+
+        if backchannel and backchannel['kind'] == 'http':
+            bc = PollingBackchannel(my_url=URL(backchannel['url']))
+        elif backchannel and backchannel['kind'] == 'jenkins':
+            bc = JenkinsBackchannel(my_url=URL(backchannel['url']))
+        else:
+            bc = None
+
+        active_run = ActiveRun.from_queue_item(
+            backchannel=bc,
+            worker_name=worker,
+            queue_item=item,
+            vcs_info=vcs_info,
+            worker_link=worker_link
         )
-        try:
-            await queue_processor.finish_run(active_run, result)
-        except RunExists:
-            pass
 
-    queue_processor = request.app['queue_processor']
+        await queue_processor.register_run(active_run)
 
-    async with queue_processor.database.acquire() as conn:
-        item = None
-        while item is None:
-            with span.new_child('sql:queue-item'):
-                item, vcs_info = await queue_processor.next_queue_item(
-                    conn, package=package, campaign=campaign)
-            if item is None:
-                return web.json_response({'reason': 'queue empty'}, status=503)
-
-            if backchannel and backchannel['kind'] == 'http':
-                bc = PollingBackchannel(my_url=URL(backchannel['url']))
-            elif backchannel and backchannel['kind'] == 'jenkins':
-                bc = JenkinsBackchannel(my_url=URL(backchannel['url']))
-            else:
-                bc = None
-
-            active_run = ActiveRun.from_queue_item(
-                backchannel=bc,
-                worker_name=worker,
-                queue_item=item,
-                vcs_info=vcs_info,
-                worker_link=worker_link
-            )
+        if vcs_info["branch_url"] is None:
+            await abort_assignment(
+                queue_processor, active_run, 'not-in-vcs',
+                "No VCS URL known for package.")
+            continue
 
-            await queue_processor.register_run(active_run)
+        try:
+            campaign_config = get_campaign_config(queue_processor.config, item.campaign)
+        except KeyError:
+            logging.warning(
+                'Unable to find details for campaign %r', item.campaign)
+            await abort_assignment(
+                queue_processor, active_run, 'unknown-campaign',
+                "Campaign %s unknown" % item.campaign)
+            continue
 
-            if vcs_info["branch_url"] is None:
-                await abort(active_run, 'not-in-vcs', "No VCS URL known for package.")
-                item = None
-                continue
+        return active_run, item, vcs_info, campaign_config
 
-            try:
-                campaign_config = get_campaign_config(queue_processor.config, item.campaign)
-            except KeyError:
-                logging.warning(
-                    'Unable to find details for campaign %r', item.campaign)
-                await abort(active_run, 'unknown-campaign', "Campaign %s unknown" % item.campaign)
-                item = None
-                continue
 
-        # This is simple for now, since we only support one distribution.
-        builder = get_builder(queue_processor.config, campaign_config)
+async def prepare_assignment(
+        queue_processor, conn, span, active_run, item, vcs_info,
+        campaign_config):
+    """Open the branches for an active run and create its assignment.
 
-        with span.new_child('build-env'):
-            build_env = await builder.build_env(conn, campaign_config, item)
+    Raises:
+      BranchRateLimited: when the host of one of the branches is rate
+        limiting us; the active run will have been aborted
+    """
+    possible_transports = []
+    possible_forges = []
 
-        try:
-            with span.new_child('branch:open'):
-                probers = select_preferred_probers(vcs_info['vcs_type'])
-                logging.info(
-                    'Opening branch %s with %r', vcs_info['branch_url'],
-                    [p.__name__ for p in probers])
-                main_branch = await to_thread_timeout(
-                    REMOTE_BRANCH_OPEN_TIMEOUT, open_branch_ext,
-                    vcs_info['branch_url'],
-                    possible_transports=possible_transports, probers=probers)
-        except BranchRateLimited as e:
-            host = urlutils.URL.from_string(vcs_info['branch_url']).host
-            logging.warning('Rate limiting for %s: %r', host, e)
-            await queue_processor.rate_limited(host, e.retry_after)
-            await abort(active_run, 'pull-rate-limited', str(e))
-            return web.json_response(
-                {'reason': str(e)}, status=429, headers={
-                    'Retry-After': e.retry_after or DEFAULT_RETRY_AFTER})
-        except BranchOpenFailure as e:
-            logging.debug(
-                'Error opening branch %s: %s', vcs_info['branch_url'],
-                e)
-            resume_branch = None
-            vcs_type = vcs_info['vcs_type']
-        except asyncio.TimeoutError:
-            logging.debug('Timeout opening branch %s', vcs_info['branch_url'])
-            resume_branch = None
-            vcs_type = vcs_info['vcs_type']
-        else:
-            # We try the public branch first, since perhaps a maintainer
-            # has made changes to the branch there.
-            active_run.vcs_info["branch_url"] = full_branch_url(main_branch).rstrip('/')
-            vcs_type = get_vcs_abbreviation(main_branch.repository)
-            if not item.refresh:
-                with span.new_child('resume-branch:open'):
-                    try:
-                        resume_branch = await to_thread_timeout(
-                            REMOTE_BRANCH_OPEN_TIMEOUT,
-                            open_resume_branch,
-                            main_branch,
-                            campaign_config.branch_name,
-                            item.package,
-                            possible_forges=possible_forges)
-                    except BranchRateLimited as e:
-                        host = urlutils.URL.from_string(e.url).host
-                        logging.warning('Rate limiting for %s: %r', host, e)
-                        await queue_processor.rate_limited(host, e.retry_after)
-                        await abort(active_run, 'resume-rate-limited', str(e))
-                        return web.json_response(
-                            {'reason': str(e)}, status=429, headers={
-                                'Retry-After': e.retry_after or DEFAULT_RETRY_AFTER})
-                    except asyncio.TimeoutError:
-                        logging.debug('Timeout opening resume branch')
-                        resume_branch = None
-            else:
-                resume_branch = None
+    # This is simple for now, since we only support one distribution.
+    builder = get_builder(queue_processor.config, campaign_config)
 
-        if vcs_type is not None:
-            vcs_type = vcs_type.lower()
+    with span.new_child('build-env'):
+        build_env = await builder.build_env(conn, campaign_config, item)
 
-        if resume_branch is None and not item.refresh:
+    try:
+        with span.new_child('branch:open'):
+            probers = select_preferred_probers(vcs_info['vcs_type'])
+            logging.info(
+                'Opening branch %s with %r', vcs_info['branch_url'],
+                [p.__name__ for p in probers])
+            main_branch = await to_thread_timeout(
+                REMOTE_BRANCH_OPEN_TIMEOUT, open_branch_ext,
+                vcs_info['branch_url'],
+                possible_transports=possible_transports, probers=probers)
+    except BranchRateLimited as e:
+        host = urlutils.URL.from_string(vcs_info['branch_url']).host
+        logging.warning('Rate limiting for %s: %r', host, e)
+        await queue_processor.rate_limited(host, e.retry_after)
+        await abort_assignment(
+            queue_processor, active_run, 'pull-rate-limited', str(e))
+        raise
+    except BranchOpenFailure as e:
+        logging.debug(
+            'Error opening branch %s: %s', vcs_info['branch_url'],
+            e)
+        resume_branch = None
+        vcs_type = vcs_info['vcs_type']
+    except asyncio.TimeoutError:
+        logging.debug('Timeout opening branch %s', vcs_info['branch_url'])
+        resume_branch = None
+        vcs_type = vcs_info['vcs_type']
+    else:
+        # We try the public branch first, since perhaps a maintainer
+        # has made changes to the branch there.
+        active_run.vcs_info["branch_url"] = full_branch_url(main_branch).rstrip('/')
+        vcs_type = get_vcs_abbreviation(main_branch.repository)
+        if not item.refresh:
             with span.new_child('resume-branch:open'):
                 try:
-                    vcs_manager = queue_processor.public_vcs_managers[vcs_type]
-                except KeyError:
-                    logging.warning(
-                        'Unsupported vcs %s for resume branch of %s',
-                        vcs_type, item.package)
+                    resume_branch = await to_thread_timeout(
+                        REMOTE_BRANCH_OPEN_TIMEOUT,
+                        open_resume_branch,
+                        main_branch,
+                        campaign_config.branch_name,
+                        item.package,
+                        possible_forges=possible_forges)
+                except BranchRateLimited as e:
+                    host = urlutils.URL.from_string(e.url).host
+                    logging.warning('Rate limiting for %s: %r', host, e)
+                    await queue_processor.rate_limited(host, e.retry_after)
+                    await abort_assignment(
+                        queue_processor, active_run, 'resume-rate-limited',
+                        str(e))
+                    raise
+                except asyncio.TimeoutError:
+                    logging.debug('Timeout opening resume branch')
                     resume_branch = None
-                else:
-                    try:
-                        resume_branch = await to_thread_timeout(
-                            VCS_STORE_BRANCH_OPEN_TIMEOUT,
-                            vcs_manager.get_branch,
-                            item.package, '%s/%s' % (campaign_config.name, 'main'))
-                    except asyncio.TimeoutError:
-                        logging.warning('Timeout opening resume branch')
-
-        if resume_branch is not None:
-            with span.new_child('resume-branch:check'):
-                resume = await check_resume_result(conn, item.campaign, resume_branch)
-                if resume is not None:
-                    if is_authenticated_url(resume.branch.user_url):
-                        raise AssertionError('invalid resume branch %r' % (
-                            resume.branch))
-                    active_run.resume_from = resume.run_id
-                    logging.info(
-                        'Resuming %s/%s from run %s', item.package, item.campaign,
-                        resume.run_id)
         else:
-            resume = None
+            resume_branch = None
+
+    if vcs_type is not None:
+        vcs_type = vcs_type.lower()
+
+    if resume_branch is None and not item.refresh:
+        with span.new_child('resume-branch:open'):
+            try:
+                vcs_manager = queue_processor.public_vcs_managers[vcs_type]
+            except KeyError:
+                logging.warning(
+                    'Unsupported vcs %s for resume branch of %s',
+                    vcs_type, item.package)
+                resume_branch = None
+            else:
+                try:
+                    resume_branch = await to_thread_timeout(
+                        VCS_STORE_BRANCH_OPEN_TIMEOUT,
+                        vcs_manager.get_branch,
+                        item.package, '%s/%s' % (campaign_config.name, 'main'))
+                except asyncio.TimeoutError:
+                    logging.warning('Timeout opening resume branch')
+
+    if resume_branch is not None:
+        with span.new_child('resume-branch:check'):
+            resume = await check_resume_result(conn, item.campaign, resume_branch)
+            if resume is not None:
+                if is_authenticated_url(resume.branch.user_url):
+                    raise AssertionError('invalid resume branch %r' % (
+                        resume.branch))
+                active_run.resume_from = resume.run_id
+                logging.info(
+                    'Resuming %s/%s from run %s', item.package, item.campaign,
+                    resume.run_id)
+    else:
+        resume = None
 
     try:
         with span.new_child('cache-branch:check'):
@@ -2010,7 +2328,7 @@ async def next_item(request, mode, worker=None, worker_link=None, backchannel=No
     extra_env, command = splitout_env(item.command)
     env.update(extra_env)
 
-    assignment = {
+    return {
         "id": active_run.log_id,
         "description": "%s on %s" % (item.campaign, item.package),
         "queue_id": item.id,
@@ -2033,6 +2351,33 @@ async def next_item(request, mode, worker=None, worker_link=None, backchannel=No
         }
     }
 
+
+def rate_limited_response(e):
+    return web.json_response(
+        {'reason': str(e)}, status=429, headers={
+            'Retry-After': str(e.retry_after or DEFAULT_RETRY_AFTER)})
+
+
+async def next_item(request, mode, worker=None, worker_link=None, backchannel=None, package=None, campaign=None):
+    span = aiozipkin.request_span(request)
+
+    queue_processor = request.app['queue_processor']
+
+    async with queue_processor.database.acquire() as conn:
+        claim = await claim_active_run(
+            queue_processor, conn, span, worker=worker,
+            worker_link=worker_link, backchannel=backchannel,
+            package=package, campaign=campaign)
+        if claim is None:
+            return web.json_response({'reason': 'queue empty'}, status=503)
+        active_run = claim[0]
+
+        try:
+            assignment = await prepare_assignment(
+                queue_processor, conn, span, *claim)
+        except BranchRateLimited as e:
+            return rate_limited_response(e)
+
     if mode == 'assign':
         pass
     else:
@@ -2040,6 +2385,58 @@ async def next_item(request, mode, worker=None, worker_link=None, backchannel=No
     return web.json_response(assignment, status=201)
 
 
+async def next_items(request, count, worker=None, worker_link=None, backchannel=None, package=None, campaign=None):
+    """Assign up to count queue items in one go.
+
+    The branches for the claimed items are opened concurrently.
+    """
+    span = aiozipkin.request_span(request)
+
+    queue_processor = request.app['queue_processor']
+
+    claims = []
+    async with queue_processor.database.acquire() as conn:
+        while len(claims) < count:
+            claim = await claim_active_run(
+                queue_processor, conn, span, worker=worker,
+                worker_link=worker_link, backchannel=backchannel,
+                package=package, campaign=campaign)
+            if claim is None:
+                break
+            claims.append(claim)
+
+    if not claims:
+        return web.json_response({'reason': 'queue empty'}, status=503)
+
+    async def prepare(claim):
+        async with queue_processor.database.acquire() as conn:
+            return await prepare_assignment(
+                queue_processor, conn, span, *claim)
+
+    results = await asyncio.gather(
+        *[prepare(claim) for claim in claims], return_exceptions=True)
+
+    assignments = []
+    rate_limited = None
+    for claim, result in zip(claims, results):
+        if isinstance(result, BranchRateLimited):
+            rate_limited = result
+        elif isinstance(result, BaseException):
+            active_run = claim[0]
+            logging.warning(
+                'Unable to create assignment for %s/%s: %r',
+                active_run.package, active_run.campaign, result)
+            await queue_processor.unclaim_run(active_run.log_id)
+        else:
+            assignments.append(result)
+
+    if not assignments and rate_limited is not None:
+        return rate_limited_response(rate_limited)
+
+    assignment_count.labels(worker=worker).inc(len(assignments))
+    return web.json_response(assignments, status=201)
+
+
 @routes.get("/health", name="health")
 async def handle_health(request):
     return web.Response(text="OK")
@@ -2081,8 +2478,14 @@ async def handle_finish(request):
             else:
                 filenames.append(part.filename)
                 output_path = os.path.join(output_directory, part.filename)
+                # Write the part out as it arrives, rather than holding
+                # (potentially large) build artifacts in memory.
                 with open(output_path, "wb") as f:
-                    f.write(await part.read())
+                    while True:
+                        chunk = await part.read_chunk()
+                        if not chunk:
+                            break
+                        f.write(chunk)
 
         if worker_result is None:
             return web.json_response({"reason": "Missing result JSON"}, status=400)
@@ -2110,21 +2513,17 @@ async def handle_finish(request):
             change_set=active_run.change_set,
         )
 
-        await import_logs(
-            logfiles,
-            queue_processor.logfile_manager,
-            queue_processor.backup_logfile_manager,
-            active_run.package,
-            run_id,
-            mtime=result.finish_time.timestamp(),
-        )
-
         if result.builder_result is not None:
             result.builder_result.from_directory(output_directory)
-
             artifact_names = result.builder_result.artifact_filenames()
+        else:
+            artifact_names = None
+
+        async def store_artifacts():
+            nonlocal artifact_names
             try:
-                await store_artifacts_with_backup(
+                (result.artifacts,
+                 result.artifacts_in_backup) = await store_artifacts_with_backup(
                     queue_processor.artifact_manager,
                     queue_processor.backup_artifact_manager,
                     output_directory,
@@ -2137,8 +2536,20 @@ async def handle_finish(request):
                 artifact_upload_failed_count.inc()
                 # TODO(jelmer): Mark ourselves as unhealthy?
                 artifact_names = None
-        else:
-            artifact_names = None
+
+        uploads = [import_logs(
+            logfiles,
+            queue_processor.logfile_manager,
+            queue_processor.backup_logfile_manager,
+            active_run.package,
+            run_id,
+            mtime=result.finish_time.timestamp(),
+        )]
+        if artifact_names is not None:
+            uploads.append(store_artifacts())
+        for ret in await asyncio.gather(*uploads, return_exceptions=True):
+            if isinstance(ret, BaseException):
+                raise ret
 
     try:
         await queue_processor.finish_run(active_run, result)
@@ -2219,6 +2630,18 @@ async def main(argv=None):
     parser.add_argument(
         "--run-timeout", type=int, help="Time before marking a run as having timed out (minutes)",
         default=60)
+    parser.add_argument(
+        "--status-interval", type=int, default=30,
+        help="Minimum interval between full queue status updates (seconds)")
+    parser.add_argument(
+        "--queue-position-interval", type=int, default=30,
+        help="Interval between queue position refreshes (seconds)")
+    parser.add_argument(
+        "--seekable-logs", action="store_true",
+        help="Store logs in a block-compressed format with a line index")
+    parser.add_argument(
+        "--content-addressed-artifacts", action="store_true",
+        help="Store artifacts by content, so identical files are stored once")
     parser.add_argument(
         "--avoid-host", type=str,
         help="Avoid processing runs on a host (e.g. 'salsa.debian.org')",
@@ -2255,8 +2678,12 @@ async def main(argv=None):
         tracer = await aiozipkin.create_custom(endpoint)
     trace_configs = [aiozipkin.make_trace_config(tracer)]
 
-    logfile_manager = get_log_manager(config.logs_location, trace_configs=trace_configs)
-    artifact_manager = get_artifact_manager(config.artifact_location, trace_configs=trace_configs)
+    logfile_manager = get_log_manager(
+        config.logs_location, trace_configs=trace_configs,
+        seekable=args.seekable_logs)
+    artifact_manager = get_artifact_manager(
+        config.artifact_location, trace_configs=trace_configs,
+        content_addressed=args.content_addressed_artifacts)
 
     loop = asyncio.get_event_loop()
     if args.debug:
@@ -2276,15 +2703,17 @@ async def main(argv=None):
             backup_artifact_manager = LocalArtifactManager(backup_artifact_directory)
             await stack.enter_async_context(backup_artifact_manager)
             backup_logfile_manager = FileSystemLogFileManager(backup_logfile_directory)
-            loop.create_task(
-                upload_backup_artifacts(
-                    backup_artifact_manager, artifact_manager, timeout=60 * 15
-                )
-            )
         else:
             backup_artifact_manager = None
             backup_logfile_manager = None
         db = await state.create_pool(config.database_location)
+        if backup_artifact_manager is not None:
+            loop.create_task(
+                upload_backup_artifacts(
+                    backup_artifact_manager, artifact_manager,
+                    timeout=60 * 15, db=db
+                )
+            )
         redis = await aioredis.create_redis(config.redis_location)
         stack.callback(redis.close)
         with open(args.policy, 'r') as f:
@@ -2305,9 +2734,18 @@ async def main(argv=None):
             backup_artifact_manager=backup_artifact_manager,
             backup_logfile_manager=backup_logfile_manager,
             avoid_hosts=set(args.avoid_host),
+            status_interval=args.status_interval,
+            queue_position_interval=args.queue_position_interval,
         )
 
         queue_processor.start_watchdog()
+        queue_processor.start_status_publisher()
+        queue_processor.start_queue_position_refresher()
+
+        rate_limit_redis = await aioredis.create_redis_pool(
+            config.redis_location, minsize=1, maxsize=1)
+        stack.callback(rate_limit_redis.close)
+        await queue_processor.start_rate_limit_listener(rate_limit_redis)
 
         app = await create_app(queue_processor, tracer=tracer)
         runner = web.AppRunner(app)
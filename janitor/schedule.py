@@ -19,11 +19,14 @@ from __future__ import absolute_import
 
 __all__ = [
     "bulk_add_to_queue",
+    "RunStatistics",
+    "update_run_statistics",
+    "refresh_run_statistics",
 ]
 
 from datetime import datetime, timedelta
 import logging
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, Iterable, Any
 
 from debian.changelog import Version
 
@@ -88,6 +91,18 @@ IGNORE_RESULT_CODE.update(
     {code: lambda run: True for code in TRANSIENT_ERROR_RESULT_CODES}
 )
 
+# Weight of the previous runs relative to the last one when estimating
+# the success probability; i.e. how quickly older runs stop mattering.
+RUN_STATISTICS_DECAY = 0.8
+
+# Weight of the last run when updating the mean duration.
+RUN_STATISTICS_DURATION_WEIGHT = 0.3
+
+# Maximum number of contexts and unsatisfied dependencies to remember
+# per package/campaign.
+MAX_RUN_STATISTICS_CONTEXTS = 50
+MAX_RUN_STATISTICS_UNSATISFIED = 20
+
 
 PUBLISH_MODE_VALUE = {
     "skip": 0,
@@ -151,49 +166,268 @@ def queue_item_from_candidate_and_policy(row, config):
             value, row['success_chance'])
 
 
-async def estimate_success_probability(
-    conn: asyncpg.Connection, package: str, campaign: str, context: Optional[str] = None
-) -> Tuple[float, int]:
-    # TODO(jelmer): Bias this towards recent runs?
-    total = 0
-    success = 0
-    if context is None:
-        same_context_multiplier = 0.5
-    else:
-        same_context_multiplier = 1.0
-    for run in await conn.fetch("""
-SELECT result_code, instigated_context, context, failure_details, start_time
-FROM run
-WHERE package = $1 AND suite = $2
-ORDER BY start_time DESC
-""", package, campaign):
-        try:
-            ignore_checker = IGNORE_RESULT_CODE[run['result_code']]
-        except KeyError:
-            pass
+class RunStatistics(object):
+    """Statistics about the previous runs for a package/campaign.
+
+    These are maintained incrementally as runs are stored, so that
+    scheduling doesn't have to look at the full run history.
+    """
+
+    __slots__ = [
+        "package",
+        "campaign",
+        "total",
+        "success",
+        "weighted_total",
+        "weighted_success",
+        "contexts",
+        "unsatisfied",
+        "mean_duration",
+    ]
+
+    def __init__(
+            self, package: str, campaign: str, total: int = 0,
+            success: int = 0, weighted_total: float = 0.0,
+            weighted_success: float = 0.0,
+            contexts: Optional[List[str]] = None,
+            unsatisfied: Optional[List[Any]] = None,
+            mean_duration: Optional[timedelta] = None):
+        self.package = package
+        self.campaign = campaign
+        self.total = total
+        self.success = success
+        self.weighted_total = weighted_total
+        self.weighted_success = weighted_success
+        self.contexts = contexts or []
+        self.unsatisfied = unsatisfied or []
+        self.mean_duration = mean_duration
+
+    @classmethod
+    def from_row(cls, row) -> "RunStatistics":
+        return cls(
+            package=row['package'],
+            campaign=row['campaign'],
+            total=row['total'],
+            success=row['success'],
+            weighted_total=row['weighted_total'],
+            weighted_success=row['weighted_success'],
+            contexts=row['contexts'],
+            unsatisfied=row['unsatisfied_dependencies'],
+            mean_duration=row['mean_duration'],
+        )
+
+    def add_run(
+            self, result_code: str, instigated_context: Optional[str],
+            context: Optional[str], failure_details: Optional[Any],
+            duration: Optional[timedelta]) -> None:
+        """Update the statistics for a new run."""
+        if duration is not None:
+            if self.mean_duration is None:
+                self.mean_duration = duration
+            else:
+                self.mean_duration = (
+                    duration * RUN_STATISTICS_DURATION_WEIGHT
+                    + self.mean_duration * (1 - RUN_STATISTICS_DURATION_WEIGHT))
+        # Worker failures are only ignored once they are older than a day;
+        # since these statistics can't be updated after the fact, they're
+        # ignored entirely.
+        if (result_code in IGNORE_RESULT_CODE
+                or result_code == "worker-failure"):
+            return
+        self.total += 1
+        self.weighted_total = self.weighted_total * RUN_STATISTICS_DECAY + 1
+        self.weighted_success *= RUN_STATISTICS_DECAY
+        if result_code == "success":
+            self.success += 1
+            self.weighted_success += 1
+        run_contexts = [c for c in (instigated_context, context) if c]
+        if (result_code == "install-deps-unsatisfied-dependencies"
+                and failure_details and failure_details.get('relations')):
+            # Whether this was a success depends on whether the dependencies
+            # have become available since.
+            self.unsatisfied.append({
+                'relations': failure_details['relations'],
+                'contexts': run_contexts,
+                'index': self.total})
+            del self.unsatisfied[:-MAX_RUN_STATISTICS_UNSATISFIED]
         else:
-            if ignore_checker(run):
-                continue
-        total += 1
-        if run['result_code'] == "success":
-            success += 1
-        same_context = False
-        if context and context in (run['instigated_context'], run['context']):
-            same_context = True
-        if (run['result_code'] == "install-deps-unsatisfied-dependencies" and run['failure_details']
-                and run['failure_details'].get('relations')):
-            if await deps_satisfied(conn, campaign, run['failure_details']['relations']):
-                success += 1
-                same_context = False
-        if same_context:
+            for c in run_contexts:
+                if c in self.contexts:
+                    self.contexts.remove(c)
+                self.contexts.append(c)
+            del self.contexts[:-MAX_RUN_STATISTICS_CONTEXTS]
+
+    async def success_probability(
+            self, conn: asyncpg.Connection,
+            context: Optional[str] = None,
+            dep_cache: Optional["DependencyCache"] = None) -> float:
+        """Estimate the probability that a new run will be successful.
+
+        Recent runs weigh more heavily than older ones.
+        """
+        weighted_success = self.weighted_success
+        same_context = bool(context) and context in self.contexts
+        for entry in self.unsatisfied:
+            if await deps_satisfied(
+                    conn, self.campaign, entry['relations'], dep_cache):
+                weighted_success += RUN_STATISTICS_DECAY ** (
+                    self.total - entry['index'])
+            elif context and context in entry['contexts']:
+                same_context = True
+        if self.total == 0:
+            # If there were no previous runs, then it doesn't really matter that
+            # we don't know the context.
+            same_context_multiplier = 1.0
+        elif same_context:
             same_context_multiplier = 0.1
+        elif context is None:
+            same_context_multiplier = 0.5
+        else:
+            same_context_multiplier = 1.0
+        return ((weighted_success * 10 + 1) / (self.weighted_total * 10 + 1)
+                * same_context_multiplier)
 
-    if total == 0:
-        # If there were no previous runs, then it doesn't really matter that
-        # we don't know the context.
-        same_context_multiplier = 1.0
 
-    return ((success * 10 + 1) / (total * 10 + 1) * same_context_multiplier), total
+async def _run_statistics_from_history(
+        conn: asyncpg.Connection,
+        keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], RunStatistics]:
+    ret = {key: RunStatistics(*key) for key in keys}
+    for run in await conn.fetch("""
+SELECT package, suite, result_code, instigated_context, context,
+       failure_details, finish_time - start_time AS duration
+FROM run
+WHERE (package, suite) IN (SELECT * FROM unnest($1::text[], $2::text[]))
+ORDER BY start_time ASC
+""", [p for (p, c) in keys], [c for (p, c) in keys]):
+        ret[(run['package'], run['suite'])].add_run(
+            run['result_code'], run['instigated_context'], run['context'],
+            run['failure_details'], run['duration'])
+    return ret
+
+
+async def load_run_statistics(
+        conn: asyncpg.Connection,
+        keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], RunStatistics]:
+    """Load the run statistics for a set of package/campaign pairs.
+
+    Statistics that have not been stored yet are calculated from the run
+    history.
+    """
+    keys = list(set(keys))
+    ret = {
+        (row['package'], row['campaign']): RunStatistics.from_row(row)
+        for row in await conn.fetch(
+            "SELECT * FROM run_statistics WHERE (package, campaign) IN "
+            "(SELECT * FROM unnest($1::text[], $2::text[]))",
+            [p for (p, c) in keys], [c for (p, c) in keys])}
+    missing = [key for key in keys if key not in ret]
+    if missing:
+        ret.update(await _run_statistics_from_history(conn, missing))
+    return ret
+
+
+async def store_run_statistics(
+        conn: asyncpg.Connection, stats: Iterable[RunStatistics]) -> None:
+    await conn.executemany(
+        "INSERT INTO run_statistics (package, campaign, total, success, "
+        "weighted_total, weighted_success, contexts, "
+        "unsatisfied_dependencies, mean_duration) "
+        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) "
+        "ON CONFLICT (package, campaign) DO UPDATE SET "
+        "total = EXCLUDED.total, success = EXCLUDED.success, "
+        "weighted_total = EXCLUDED.weighted_total, "
+        "weighted_success = EXCLUDED.weighted_success, "
+        "contexts = EXCLUDED.contexts, "
+        "unsatisfied_dependencies = EXCLUDED.unsatisfied_dependencies, "
+        "mean_duration = EXCLUDED.mean_duration",
+        [(st.package, st.campaign, st.total, st.success, st.weighted_total,
+          st.weighted_success, st.contexts, st.unsatisfied,
+          st.mean_duration) for st in stats])
+
+
+async def update_run_statistics(
+        conn: asyncpg.Connection, package: str, campaign: str,
+        result_code: str, instigated_context: Optional[str],
+        context: Optional[str], failure_details: Optional[Any],
+        duration: Optional[timedelta]) -> None:
+    """Update the run statistics for a newly stored run.
+
+    This should be called in the same transaction that stores the run.
+    """
+    # Claim the row first; a concurrent transaction for the same
+    # package/campaign blocks here until this one has committed, and then
+    # updates the stored statistics rather than the run history.
+    created = await conn.fetchval(
+        "INSERT INTO run_statistics (package, campaign) VALUES ($1, $2) "
+        "ON CONFLICT (package, campaign) DO NOTHING RETURNING true",
+        package, campaign)
+    if created:
+        # The run history already includes the new run.
+        await refresh_run_statistics(conn, [(package, campaign)])
+        return
+    row = await conn.fetchrow(
+        "SELECT * FROM run_statistics WHERE package = $1 AND campaign = $2 "
+        "FOR UPDATE", package, campaign)
+    stats = RunStatistics.from_row(row)
+    stats.add_run(
+        result_code, instigated_context, context, failure_details, duration)
+    await store_run_statistics(conn, [stats])
+
+
+async def refresh_run_statistics(
+        conn: asyncpg.Connection,
+        keys: Optional[Iterable[Tuple[str, str]]] = None) -> None:
+    """Recalculate run statistics from the run history.
+
+    Args:
+      keys: package/campaign pairs to refresh; defaults to all
+    """
+    if keys is None:
+        keys = [
+            (row['package'], row['suite']) for row in
+            await conn.fetch("SELECT DISTINCT package, suite FROM run")]
+    stats = await _run_statistics_from_history(conn, list(keys))
+    await store_run_statistics(conn, stats.values())
+
+
+async def estimate_success_probability(
+    conn: asyncpg.Connection, package: str, campaign: str, context: Optional[str] = None,
+    dep_cache: Optional["DependencyCache"] = None
+) -> Tuple[float, int]:
+    stats = (await load_run_statistics(conn, [(package, campaign)]))[
+        (package, campaign)]
+    return (
+        await stats.success_probability(conn, context, dep_cache),
+        stats.total)
+
+
+async def bulk_estimate_success_probability(
+    conn: asyncpg.Connection,
+    todo: Iterable[Tuple[str, str, Optional[str]]],
+    dep_cache: Optional["DependencyCache"] = None,
+) -> Dict[Tuple[str, str, Optional[str]], Tuple[float, int]]:
+    """Estimate the success probability for many candidates at once.
+
+    Args:
+      conn: Database connection
+      todo: Iterable over (package, campaign, context) tuples
+      dep_cache: Cache for dependency availability; a new one is used
+        if this is not specified
+    Returns:
+      dictionary mapping (package, campaign, context) to
+      (probability, total previous runs) tuples
+    """
+    todo = list(todo)
+    if dep_cache is None:
+        dep_cache = DependencyCache()
+    stats = await load_run_statistics(
+        conn, [(package, campaign) for (package, campaign, context) in todo])
+    ret = {}
+    for (package, campaign, context) in todo:
+        st = stats[(package, campaign)]
+        ret[(package, campaign, context)] = (
+            await st.success_probability(conn, context, dep_cache), st.total)
+    return ret
 
 
 async def _estimate_duration(
@@ -226,9 +460,8 @@ async def estimate_duration(
     conn: asyncpg.Connection, package: str, campaign: str
 ) -> timedelta:
     """Estimate the duration of a package build for a certain campaign."""
-    estimated_duration = await _estimate_duration(
-        conn, package=package, campaign=campaign
-    )
+    estimated_duration = (await load_run_statistics(
+        conn, [(package, campaign)]))[(package, campaign)].mean_duration
     if estimated_duration is not None:
         return estimated_duration
 
@@ -243,13 +476,65 @@ async def estimate_duration(
     return timedelta(seconds=DEFAULT_ESTIMATED_DURATION)
 
 
+async def bulk_estimate_duration(
+    conn: asyncpg.Connection,
+    todo: Iterable[Tuple[str, str]],
+    limit: int = 1000,
+) -> Dict[Tuple[str, str], timedelta]:
+    """Estimate the duration for many (package, campaign) pairs at once.
+
+    This uses the same fallbacks as estimate_duration, but retrieves the
+    averages for all pairs with one query per fallback level.
+    """
+    todo = list(todo)
+    packages = list(set([package for (package, campaign) in todo]))
+    campaigns = list(set([campaign for (package, campaign) in todo]))
+    stats = await load_run_statistics(conn, todo)
+
+    async def averages(partition, where, arg):
+        query = """
+SELECT %(partition)s, AVG(duration) AS duration FROM (
+  SELECT %(partition)s, finish_time - start_time AS duration,
+    row_number() OVER (
+      PARTITION BY %(partition)s ORDER BY finish_time DESC) AS rn
+  FROM run WHERE %(where)s = ANY($1::text[])) AS q
+WHERE rn <= $2
+GROUP BY %(partition)s
+""" % {'partition': partition, 'where': where}
+        return {
+            tuple(list(row.values())[:-1]): row['duration']
+            for row in await conn.fetch(query, arg, limit)
+            if row['duration'] is not None}
+
+    per_package = await averages('package', 'package', packages)
+    per_campaign = await averages('suite', 'suite', campaigns)
+
+    ret = {}
+    for (package, campaign) in todo:
+        if stats[(package, campaign)].mean_duration is not None:
+            ret[(package, campaign)] = stats[(package, campaign)].mean_duration
+            continue
+        for (estimates, key) in [
+                (per_package, (package, )),
+                (per_campaign, (campaign, ))]:
+            if key in estimates:
+                ret[(package, campaign)] = estimates[key]
+                break
+        else:
+            ret[(package, campaign)] = timedelta(
+                seconds=DEFAULT_ESTIMATED_DURATION)
+    return ret
+
+
 async def bulk_add_to_queue(
     conn: asyncpg.Connection,
     todo,
     dry_run: bool = False,
     default_offset: float = 0.0,
     bucket: str = "default",
+    dep_cache: Optional["DependencyCache"] = None,
 ) -> None:
+    todo = list(todo)
     popcon = {k: (v or 0) for (k, v) in await conn.fetch("SELECT name, popcon_inst FROM package")}
     if popcon:
         max_inst = max([(v or 0) for v in popcon.values()])
@@ -257,17 +542,23 @@ async def bulk_add_to_queue(
             logging.info("Maximum inst count: %d", max_inst)
     else:
         max_inst = None
+    estimated_durations = await bulk_estimate_duration(
+        conn, [(package, campaign) for (package, context, command, campaign, value, success_chance) in todo])
+    success_probabilities = await bulk_estimate_success_probability(
+        conn, [(package, campaign, context) for (package, context, command, campaign, value, success_chance) in todo],
+        dep_cache)
+    items = []
     for package, context, command, campaign, value, success_chance in todo:
         assert package is not None
         assert value > 0, "Value: %s" % value
-        estimated_duration = await estimate_duration(conn, package, campaign)
+        estimated_duration = estimated_durations[(package, campaign)]
         assert estimated_duration >= timedelta(
             0
         ), "%s: estimated duration < 0.0: %r" % (package, estimated_duration)
         (
             estimated_probability_of_success,
             total_previous_runs,
-        ) = await estimate_success_probability(conn, package, campaign, context)
+        ) = success_probabilities[(package, campaign, context)]
         if total_previous_runs == 0:
             value += FIRST_RUN_BONUS
         assert (
@@ -310,21 +601,26 @@ async def bulk_add_to_queue(
             estimated_cost,
         )
 
-        if not dry_run:
-            queue = Queue(conn)
-            await queue.add(
-                package=package,
-                campaign=campaign,
-                change_set=None,
-                command=command,
-                offset=offset,
-                bucket=bucket,
-                estimated_duration=estimated_duration,
-                context=context,
-                requestor="scheduler",
-            )
+        items.append(dict(
+            package=package,
+            campaign=campaign,
+            change_set=None,
+            command=command,
+            offset=offset,
+            bucket=bucket,
+            estimated_duration=estimated_duration,
+            context=context,
+            requestor="scheduler",
+        ))
         logging.info("Scheduled %s (%s) with offset %f", package, campaign, offset)
 
+    if not dry_run:
+        queue = Queue(conn)
+        inserted, updated = await queue.add_many(items)
+        logging.info(
+            "Added %d new items to the queue, updated %d",
+            len(inserted), len(updated))
+
 
 async def dep_available(
     conn: asyncpg.Connection,
@@ -354,10 +650,82 @@ WHERE
         query % {"version_match": version_match}, *args))
 
 
-async def deps_satisfied(conn: asyncpg.Connection, campaign: str, dependencies) -> bool:
+class DependencyCache(object):
+    """Cache of dependency availability, keyed by campaign and relation.
+
+    This is meant to be used for a single scheduling pass, so that each
+    distinct relation is only looked up once. Entries for a source package
+    are dropped when a new build of it is stored or its archive version
+    changes; see listen().
+    """
+
+    def __init__(self):
+        self._available: Dict[Tuple[Any, ...], bool] = {}
+
+    def __len__(self):
+        return len(self._available)
+
+    async def dep_available(
+            self, conn: asyncpg.Connection, campaign: str, name: str,
+            archqual: Optional[str] = None, arch: Optional[str] = None,
+            version: Optional[Tuple[str, Version]] = None,
+            **kwargs) -> bool:
+        key = (campaign, name, archqual, arch,
+               (version[0], str(version[1])) if version else None)
+        try:
+            return self._available[key]
+        except KeyError:
+            pass
+        ret = self._available[key] = await dep_available(
+            conn, name, archqual=archqual, arch=arch, version=version,
+            **kwargs)
+        return ret
+
+    def invalidate(self, source: Optional[str] = None) -> None:
+        """Forget cached availability.
+
+        Args:
+          source: Source package to forget about; all entries are dropped
+            if this is None
+        """
+        if source is None:
+            self._available.clear()
+            return
+        for key in [key for key in self._available if key[1] == source]:
+            del self._available[key]
+
+    # Channels on which the names of source packages with new versions
+    # are announced.
+    NOTIFY_CHANNELS = ['debian_build', 'debian_archive_version']
+
+    def _on_new_version(self, connection, pid, channel, payload):
+        self.invalidate(payload or None)
+
+    async def listen(self, conn: asyncpg.Connection) -> None:
+        """Invalidate entries as new builds or archive versions are stored.
+
+        conn should be a dedicated connection that is kept open for as
+        long as the cache is used.
+        """
+        for channel in self.NOTIFY_CHANNELS:
+            await conn.add_listener(channel, self._on_new_version)
+
+    async def unlisten(self, conn: asyncpg.Connection) -> None:
+        for channel in self.NOTIFY_CHANNELS:
+            await conn.remove_listener(channel, self._on_new_version)
+
+
+async def deps_satisfied(
+        conn: asyncpg.Connection, campaign: str, dependencies,
+        dep_cache: Optional[DependencyCache] = None) -> bool:
     for dep in dependencies:
         for subdep in dep:
-            if await dep_available(conn, **subdep):
+            if dep_cache is not None:
+                available = await dep_cache.dep_available(
+                    conn, campaign, **subdep)
+            else:
+                available = await dep_available(conn, **subdep)
+            if available:
                 break
         else:
             return False
@@ -390,6 +758,9 @@ async def main():
     parser.add_argument("--gcp-logging", action='store_true', help='Use Google cloud logging.')
     parser.add_argument("packages", help="Package to process.", nargs="*")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--refresh-statistics", action="store_true",
+        help="Recalculate run statistics from the run history.")
 
     args = parser.parse_args()
 
@@ -414,6 +785,10 @@ async def main():
         config = read_config(f)
 
     async with state.create_pool(config.database_location) as conn:
+        if args.refresh_statistics:
+            logging.info('Refreshing run statistics')
+            async with conn.acquire() as c, c.transaction():
+                await refresh_run_statistics(c)
         logging.info('Finding candidates with policy')
         logging.info('Determining schedule for candidates')
         todo = [
@@ -422,7 +797,16 @@ async def main():
             await iter_candidates_with_policy(
                 conn, packages=(args.packages or None), campaign=args.campaign)]
         logging.info('Adding %d items to queue', len(todo))
-        await bulk_add_to_queue(conn, todo, dry_run=args.dry_run)
+        dep_cache = DependencyCache()
+        async with conn.acquire() as listen_conn:
+            await dep_cache.listen(listen_conn)
+            try:
+                await bulk_add_to_queue(
+                    conn, todo, dry_run=args.dry_run, dep_cache=dep_cache)
+            finally:
+                await dep_cache.unlisten(listen_conn)
+        logging.info(
+            'Resolved %d distinct dependencies', len(dep_cache))
 
     last_success_gauge.set_to_current_time()
     if args.prometheus:
@@ -501,6 +885,66 @@ async def do_schedule(
     return offset, estimated_duration
 
 
+async def bulk_do_schedule(
+    conn: asyncpg.Connection,
+    todo: Iterable[Tuple[str, str, Optional[timedelta]]],
+    change_set: Optional[str] = None,
+    offset: Optional[float] = None,
+    bucket: str = "default",
+    refresh: bool = False,
+    requestor: Optional[str] = None,
+) -> Tuple[List[Tuple[str, str, Optional[str]]],
+           List[Tuple[str, str, Optional[str]]]]:
+    """Schedule many package/campaign pairs at once.
+
+    Pairs without a policy are skipped.
+
+    Args:
+      conn: Database connection
+      todo: Iterable over (package, campaign, estimated_duration) tuples;
+        the duration is estimated if it is None
+    Returns:
+      tuple with lists of inserted and updated queue items, as returned
+      by Queue.add_many
+    """
+    if offset is None:
+        offset = DEFAULT_SCHEDULE_OFFSET
+    todo = list(todo)
+    commands = {
+        (row['package'], row['suite']): row['command']
+        for row in await conn.fetch(
+            "SELECT package, suite, command FROM policy "
+            "WHERE (package, suite) IN "
+            "(SELECT * FROM unnest($1::text[], $2::text[]))",
+            [package for (package, campaign, duration) in todo],
+            [campaign for (package, campaign, duration) in todo])}
+    items = []
+    for package, campaign, estimated_duration in todo:
+        try:
+            command = commands[(package, campaign)]
+        except KeyError:
+            logging.debug(
+                'Not scheduling %s/%s: policy unavailable',
+                package, campaign)
+            continue
+        items.append(dict(
+            package=package, campaign=campaign, command=command,
+            change_set=change_set, offset=offset, bucket=bucket,
+            estimated_duration=estimated_duration, refresh=refresh,
+            requestor=requestor))
+    missing_durations = [
+        (item['package'], item['campaign']) for item in items
+        if item['estimated_duration'] is None]
+    if missing_durations:
+        estimated_durations = await bulk_estimate_duration(
+            conn, missing_durations)
+        for item in items:
+            if item['estimated_duration'] is None:
+                item['estimated_duration'] = estimated_durations[
+                    (item['package'], item['campaign'])]
+    return await Queue(conn).add_many(items)
+
+
 if __name__ == "__main__":
     import asyncio
 
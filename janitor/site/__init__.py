@@ -236,3 +236,32 @@ def tracker_url(config: Config, base_distribution: str, pkg: str) -> Optional[st
 
 def iter_accept(request):
     return [h.strip() for h in request.headers.get("Accept", "*/*").split(",")]
+
+
+async def stream_chunks(
+    request: web.Request, chunks, not_found_text: str,
+    content_type: Optional[str] = None,
+    charset: Optional[str] = None
+) -> web.StreamResponse:
+    """Stream the chunks from an async iterator as a response.
+
+    The first chunk is retrieved before the headers are sent, so that a
+    missing file still results in a 404.
+    """
+    try:
+        first_chunk = await chunks.__anext__()
+    except FileNotFoundError:
+        raise web.HTTPNotFound(text=not_found_text)
+    except StopAsyncIteration:
+        first_chunk = b""
+    response = web.StreamResponse()
+    if content_type is not None:
+        response.content_type = content_type
+    if charset is not None:
+        response.charset = charset
+    await response.prepare(request)
+    await response.write(first_chunk)
+    async for chunk in chunks:
+        await response.write(chunk)
+    await response.write_eof()
+    return response
@@ -54,6 +54,38 @@ format_duration = function(n) {
    return d.seconds() + "s";
 };
 
+// Apply a queue status delta published by the runner. Returns null if the
+// delta can not be applied, in which case the next full snapshot should be
+// awaited.
+// Please keep this logic in sync with janitor/site/pubsub.py:apply_queue_delta
+apply_queue_delta = function(status, delta) {
+   var processing;
+   if (delta['delta'] == 'add') {
+      processing = status['processing'].filter(function(p) {
+         return p['id'] != delta['run']['id'];
+      });
+      processing.push(delta['run']);
+   } else if (delta['delta'] == 'remove') {
+      processing = status['processing'].filter(function(p) {
+         return p['id'] != delta['id'];
+      });
+   } else if (delta['delta'] == 'keepalive') {
+      processing = status['processing'].map(function(p) {
+         if (p['id'] == delta['id']) {
+            p = Object.assign({}, p);
+            p['last-keepalive'] = delta['last-keepalive'];
+            p['keepalive_age'] = 0;
+            p['mia'] = false;
+         }
+         return p;
+      });
+   } else {
+      console.log('Unknown queue delta: ' + delta['delta']);
+      return null;
+   }
+   return Object.assign({}, status, {'processing': processing});
+};
+
 
 window.chartColors = {
    red: 'rgb(255, 99, 132)',
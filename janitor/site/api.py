@@ -63,9 +63,10 @@ from . import (
 from .common import (
     render_template_for_request,
 )
-from janitor.logs import get_log_manager
+from janitor.logs import get_log_manager, LogFileManager
 from .webhook import process_webhook
 from ..schedule import (
+    bulk_do_schedule,
     do_schedule,
     do_schedule_control,
     PolicyUnavailable,
@@ -1019,6 +1020,8 @@ async def handle_run_assign(request):
         worker_name = await check_worker_creds(request.app['db'], request)
     with span.new_child('forward-runner'):
         url = URL(request.app['runner_url']) / "active-runs"
+        if 'count' in request.query:
+            url = url.with_query({'count': request.query['count']})
         try:
             json["worker"] = worker_name
             async with request.app['http_client_session'].post(
@@ -1329,23 +1332,18 @@ package IN (SELECT name FROM package WHERE NOT removed) AND
 
     async def do_reschedule():
         async with request.app['db'].acquire() as conn:
-            for run in runs:
-                logging.info("Rescheduling %s, %s" % (run['package'], run['campaign']))
-                try:
-                    await do_schedule(
-                        conn,
-                        run['package'],
-                        run['campaign'],
-                        estimated_duration=run.get('duration'),
-                        requestor="reschedule",
-                        refresh=refresh,
-                        offset=offset,
-                        bucket="reschedule",
-                    )
-                except PolicyUnavailable:
-                    logging.debug(
-                        'Not rescheduling %s/%s: policy unavailable',
-                        run['package'], run['campaign'])
+            inserted, updated = await bulk_do_schedule(
+                conn,
+                [(run['package'], run['campaign'], run.get('duration'))
+                 for run in runs],
+                requestor="reschedule",
+                refresh=refresh,
+                offset=offset,
+                bucket="reschedule",
+            )
+        logging.info(
+            "Rescheduled %d runs (%d newly queued)",
+            len(inserted) + len(updated), len(inserted))
 
     create_background_task(do_reschedule(), 'mass-reschedule')
     return web.json_response([
@@ -1410,13 +1408,17 @@ def create_app(
     config: Config,
     external_url: Optional[URL] = None,
     trace_configs=None,
+    logfile_manager: Optional[LogFileManager] = None,
 ) -> web.Application:
     trailing_slash_redirect = normalize_path_middleware(append_slash=True)
     app = web.Application(middlewares=[trailing_slash_redirect])
     app.router.add_routes(routes)
     app['http_client_session'] = ClientSession(trace_configs=trace_configs)
     app['config'] = config
-    app['logfile_manager'] = get_log_manager(config.logs_location)
+    if logfile_manager is None:
+        logfile_manager = get_log_manager(
+            config.logs_location, trace_configs=trace_configs)
+    app['logfile_manager'] = logfile_manager
     app['db'] = db
     app['external_url'] = external_url
     app['publisher_url'] = publisher_url
@@ -343,8 +343,14 @@ WHERE run.package = $1 AND run.suite = $2
 async def generate_candidates(db, suite):
     candidates = []
     async with db.acquire() as conn:
-        for row in await iter_candidates(conn, suite=suite):
-            candidates.append((row['package'], row['value']))
+        rows = await iter_candidates(conn, suite=suite)
+        positions = await Queue(conn).get_positions(
+            [(suite, row['package']) for row in rows])
+        for row in rows:
+            (queue_position, queue_wait_time) = positions.get(
+                (suite, row['package']), (None, None))
+            candidates.append(
+                (row['package'], row['value'], queue_position, queue_wait_time))
         candidates.sort(key=lambda x: x[1], reverse=True)
     return {"candidates": candidates, "suite": suite}
 
@@ -26,7 +26,13 @@ from aiohttp import web
 
 from ... import state
 
-from .. import is_admin, env, check_logged_in, is_qa_reviewer
+from .. import (
+    is_admin,
+    env,
+    check_logged_in,
+    is_qa_reviewer,
+    stream_chunks,
+)
 from ..common import html_template
 
 
@@ -446,27 +452,16 @@ async def handle_result_file(request):
                 text="No log file %s for run %s" % (filename, run_id)
             )
 
-        try:
-            logfile = await request.app.logfile_manager.get_log(pkg, run_id, filename)
-        except FileNotFoundError:
-            raise web.HTTPNotFound(
-                text="No log file %s for run %s" % (filename, run_id)
-            )
-        else:
-            with logfile as f:
-                text = f.read().decode("utf-8", "replace")
-        return web.Response(
-            content_type="text/plain",
-            text=text,
-        )
+        return await stream_chunks(
+            request,
+            request.app.logfile_manager.iter_log(pkg, run_id, filename),
+            "No log file %s for run %s" % (filename, run_id),
+            content_type="text/plain", charset="utf-8")
     else:
-        try:
-            f = await request.app['artifact_manager'].get_artifact(
-                run_id, filename
-            )
-        except FileNotFoundError:
-            raise web.HTTPNotFound(text="No artifact %s for run %s" % (filename, run_id))
-        return web.Response(body=f.read())
+        return await stream_chunks(
+            request,
+            request.app['artifact_manager'].iter_artifact(run_id, filename),
+            "No artifact %s for run %s" % (filename, run_id))
 
 
 @html_template(env, "cupboard/ready-list.html", headers={"Vary": "Cookie"})
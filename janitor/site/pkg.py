@@ -18,8 +18,8 @@
 
 from datetime import datetime
 from functools import partial
-from io import BytesIO
 import logging
+import tempfile
 
 from typing import Optional, Tuple
 
@@ -41,6 +41,7 @@ from buildlog_consultant.sbuild import (
     find_build_failure_description,
     worker_failure_from_sbuild_log,
 )
+from janitor.compat import to_thread
 from janitor.logs import LogRetrievalError
 from janitor.site import (
     get_archive_diff,
@@ -58,6 +59,20 @@ BUILD_LOG_NAME = "build.log"
 WORKER_LOG_NAME = "worker.log"
 DIST_LOG_NAME = "dist.log"
 
+# Logs that are scanned for failures are spooled to disk above this size.
+LOG_SPOOL_SIZE = 4 * 1024 * 1024
+
+
+def read_log_lines(logf, start, end=None):
+    """Read (lineno, line) tuples for a range of lines from a log file."""
+    ret = []
+    for i, line in enumerate(logf, 1):
+        if end is not None and i > end:
+            break
+        if i >= start:
+            ret.append((i, line.decode("utf-8", "replace")))
+    return ret
+
 
 def find_build_log_failure(logf, length):
     sbuildlog = SbuildLog.parse(logf)
@@ -83,27 +98,24 @@ def find_build_log_failure(logf, length):
     return (linecount, include_lines, [])
 
 
-def find_dist_log_failure(logf, length):
-    lines = [line.decode('utf-8', 'replace') for line in logf.readlines()]
-    match, unused_err = find_build_failure_description(lines)
+def find_dist_log_failure(lines, line_count):
+    """Find the failure in a dist log.
+
+    Args:
+      lines: The last lines of the log
+      line_count: Total number of lines in the log
+    """
+    first_line = line_count - len(lines) + 1
+    match, unused_err = find_build_failure_description(
+        [line.decode('utf-8', 'replace') for line in lines])
     if match is not None:
-        highlight_lines = [match.lineno]
+        highlight_lines = [first_line + match.lineno - 1]
     else:
         highlight_lines = None
 
-    include_lines = (max(1, len(lines) - length), len(lines),)
-
-    return (len(lines), include_lines, highlight_lines)
-
+    include_lines = (max(1, first_line), line_count,)
 
-def in_line_boundaries(i, boundaries):
-    if boundaries is None:
-        return True
-    if boundaries[0] is not None and i < boundaries[0]:
-        return False
-    if boundaries[1] is not None and i > boundaries[1]:
-        return False
-    return True
+    return (line_count, include_lines, highlight_lines)
 
 
 async def get_publish_history(
@@ -240,36 +252,88 @@ async def generate_run_file(
             kwargs['campaign'].debian_build.base_distribution)
     kwargs["resume_from"] = run['resume_from']
 
-    def read_file(f):
-        return [line.decode("utf-8", "replace") for line in f.readlines()]
-
-    kwargs["read_file"] = read_file
-
-    kwargs["in_line_boundaries"] = in_line_boundaries
-
-    cache_logs = {}
-
-    async def _get_log(name):
-        try:
-            return (await logfile_manager.get_log(run['package'], run['id'], name)).read()
-        except FileNotFoundError:
-            return None
-        except LogRetrievalError as e:
-            return str(e).encode('utf-8')
-
     def has_log(name):
         return name in run['logfilenames']
 
-    async def get_log(name):
-        if name not in run['logfilenames']:
-            log = None
+    async def fetch_log(name):
+        """Retrieve a complete log into a local temporary file."""
+        logf = tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE)
+        if not has_log(name):
+            logf.write(b"Log file missing.")
         else:
-            if name not in cache_logs:
-                cache_logs[name] = await _get_log(name)
-            log = cache_logs[name]
-        if log is None:
-            return BytesIO(b"Log file missing.")
-        return BytesIO(log)
+            try:
+                async for chunk in logfile_manager.iter_log(
+                        run['package'], run['id'], name):
+                    await to_thread(logf.write, chunk)
+            except FileNotFoundError:
+                logf.seek(0)
+                logf.truncate()
+                logf.write(b"Log file missing.")
+            except LogRetrievalError as e:
+                logf.seek(0)
+                logf.truncate()
+                logf.write(str(e).encode('utf-8'))
+        logf.seek(0)
+        return logf
+
+    # Lines of the primary log that were already read while looking for
+    # the failure, keyed by log name and then by line range.
+    prefetched_lines = {}
+
+    async def scan_log(name, find_failure):
+        """Scan a log for failures, fetching it only once.
+
+        The lines that will be displayed are kept, so rendering the
+        template does not need to retrieve the log again.
+        """
+        with await fetch_log(name) as logf:
+            line_count, include_lines, highlight_lines = await to_thread(
+                find_failure, logf, FAIL_BUILD_LOG_LEN)
+            display_lines = include_lines or (max(1, line_count), None)
+            logf.seek(0)
+            prefetched_lines[name] = {
+                tuple(display_lines): await to_thread(
+                    read_log_lines, logf, *display_lines)}
+        return line_count, include_lines, highlight_lines
+
+    async def get_log_lines(name, include_lines=None):
+        """Retrieve (lineno, line) tuples for a range of lines in a log.
+
+        Only the requested lines are kept in memory.
+        """
+        (start, end) = include_lines or (1, None)
+        start = start or 1
+        try:
+            return prefetched_lines[name][(start, end)]
+        except KeyError:
+            pass
+        if not has_log(name):
+            return [(1, "Log file missing.")]
+        try:
+            lines = await logfile_manager.get_log_lines(
+                run['package'], run['id'], name, start, end)
+        except FileNotFoundError:
+            return [(1, "Log file missing.")]
+        except LogRetrievalError as e:
+            return [(1, str(e))]
+        return [
+            (i, line.decode("utf-8", "replace"))
+            for (i, line) in enumerate(lines, start)]
+
+    async def get_log_tail(name, count):
+        """Retrieve the number of lines in a log and its last lines.
+
+        For seekable logs, only the end of the log is retrieved.
+        """
+        if not has_log(name):
+            return 1, [b"Log file missing."]
+        try:
+            return await logfile_manager.get_log_tail(
+                run['package'], run['id'], name, count)
+        except FileNotFoundError:
+            return 1, [b"Log file missing."]
+        except LogRetrievalError as e:
+            return 1, [str(e).encode('utf-8')]
 
     if has_log(BUILD_LOG_NAME):
         kwargs["build_log_name"] = BUILD_LOG_NAME
@@ -280,7 +344,7 @@ async def generate_run_file(
     if has_log(DIST_LOG_NAME):
         kwargs["dist_log_name"] = DIST_LOG_NAME
 
-    kwargs["get_log"] = get_log
+    kwargs["get_log_lines"] = get_log_lines
     if run['result_code'].startswith('worker-') or run['result_code'].startswith('result-'):
         kwargs["primary_log"] = "worker"
     elif has_log(BUILD_LOG_NAME):
@@ -291,20 +355,23 @@ async def generate_run_file(
             kwargs["earlier_build_log_names"].append((i, log_name))
             i += 1
 
-        logf = await get_log(BUILD_LOG_NAME)
-        line_count, include_lines, highlight_lines = find_build_log_failure(
-            logf, FAIL_BUILD_LOG_LEN
-        )
+        line_count, include_lines, highlight_lines = await scan_log(
+            BUILD_LOG_NAME, find_build_log_failure)
         kwargs["build_log_line_count"] = line_count
         kwargs["build_log_include_lines"] = include_lines
         kwargs["build_log_highlight_lines"] = highlight_lines
         kwargs["primary_log"] = "build"
     elif has_log(DIST_LOG_NAME) and run['result_code'].startswith('dist-'):
         kwargs["primary_log"] = "dist"
-        logf = await get_log(DIST_LOG_NAME)
+        # Only the lines that are displayed are scanned for the failure.
+        line_count, lines = await get_log_tail(
+            DIST_LOG_NAME, FAIL_BUILD_LOG_LEN + 1)
         line_count, include_lines, highlight_lines = find_dist_log_failure(
-            logf, FAIL_BUILD_LOG_LEN
-        )
+            lines, line_count)
+        prefetched_lines[DIST_LOG_NAME] = {
+            include_lines: [
+                (i, line.decode("utf-8", "replace"))
+                for (i, line) in enumerate(lines, include_lines[0])]}
         kwargs["dist_log_line_count"] = line_count
         kwargs["dist_log_include_lines"] = include_lines
         kwargs["dist_log_highlight_lines"] = highlight_lines
@@ -17,12 +17,15 @@
 
 import asyncio
 import json
-from typing import Set
+from typing import Any, Callable, Iterable, Optional, Set
 
 
 from aiohttp import web
 from aiohttp_openmetrics import Gauge
 
+# Shared with the notifiers, which only have janitor_client available.
+from janitor_client import apply_queue_delta  # noqa: F401
+
 
 subscription_count = Gauge(
     "subscriptions", "Subscriptions per topic", labelnames=("topic",)
@@ -35,6 +38,9 @@ class Subscription(object):
     def __init__(self, topic: "Topic") -> None:
         self.topic = topic
         self.queue: asyncio.Queue = asyncio.Queue()
+        if topic.snapshot is not None:
+            for message in topic.snapshot():
+                self.queue.put_nowait(message)
         if topic.last:
             self.queue.put_nowait(topic.last)
 
@@ -51,11 +57,22 @@ class Subscription(object):
 class Topic(object):
     """A pubsub topic."""
 
-    def __init__(self, name, repeat_last: bool = False):
+    def __init__(
+            self, name, repeat_last: bool = False,
+            snapshot: Optional[Callable[[], Iterable[Any]]] = None):
+        """Create a topic.
+
+        Args:
+          name: Name of the topic
+          repeat_last: Send the last published message to new subscribers
+          snapshot: Callable returning messages to send to new subscribers,
+            e.g. the current state that later messages are deltas against
+        """
         self.name = name
         self.subscriptions: Set[asyncio.Queue] = set()
         self.last = None
         self.repeat_last = repeat_last
+        self.snapshot = snapshot
 
     def publish(self, message):
         if self.repeat_last:
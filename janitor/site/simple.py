@@ -37,11 +37,17 @@ from aiohttp.web_middlewares import normalize_path_middleware
 import gpg
 
 from .. import state
-from ..logs import get_log_manager
+from ..logs import (
+    CachingLogFileManager,
+    DEFAULT_LOG_CACHE_SIZE,
+    DEFAULT_LOG_CACHE_TTL,
+    get_log_manager,
+)
 from ..vcs import get_vcs_managers_from_config
 
 from . import (
     env,
+    stream_chunks,
 )
 
 from .common import (
@@ -49,7 +55,7 @@ from .common import (
     render_template_for_request,
 )
 from .openid import setup_openid
-from .pubsub import pubsub_handler, Topic
+from .pubsub import apply_queue_delta, pubsub_handler, Topic
 
 
 def create_background_task(fn, title):
@@ -219,27 +225,16 @@ async def handle_result_file(request):
                 text="No log file %s for run %s" % (filename, run_id)
             )
 
-        try:
-            logfile = await request.app.logfile_manager.get_log(pkg, run_id, filename)
-        except FileNotFoundError:
-            raise web.HTTPNotFound(
-                text="No log file %s for run %s" % (filename, run_id)
-            )
-        else:
-            with logfile as f:
-                text = f.read().decode("utf-8", "replace")
-        return web.Response(
-            content_type="text/plain",
-            text=text,
-        )
+        return await stream_chunks(
+            request,
+            request.app.logfile_manager.iter_log(pkg, run_id, filename),
+            "No log file %s for run %s" % (filename, run_id),
+            content_type="text/plain", charset="utf-8")
     else:
-        try:
-            f = await request.app['artifact_manager'].get_artifact(
-                run_id, filename
-            )
-        except FileNotFoundError:
-            raise web.HTTPNotFound(text="No artifact %s for run %s" % (filename, run_id))
-        return web.Response(body=f.read())
+        return await stream_chunks(
+            request,
+            request.app['artifact_manager'].iter_artifact(run_id, filename),
+            "No artifact %s for run %s" % (filename, run_id))
 
 
 @html_template(env, "ready-list.html", headers={"Vary": "Cookie"})
@@ -289,7 +284,9 @@ async def create_app(
         runner_url=None, publisher_url=None,
         archiver_url=None, vcs_managers=None,
         differ_url=None,
-        listen_address=None, port=None):
+        listen_address=None, port=None,
+        log_cache_directory=None, log_cache_size=DEFAULT_LOG_CACHE_SIZE,
+        log_cache_ttl=DEFAULT_LOG_CACHE_TTL):
     if minified:
         minified_prefix = ""
     else:
@@ -304,7 +301,14 @@ async def create_app(
     private_app.router.add_get("/metrics", metrics, name="metrics")
     private_app.router.add_get("/health", handle_health, name="health")
 
-    app.topic_notifications = Topic("notifications")
+    app['runner_status'] = None
+
+    def notifications_snapshot():
+        if app['runner_status'] is not None:
+            yield ["queue", app['runner_status']]
+
+    app.topic_notifications = Topic(
+        "notifications", snapshot=notifications_snapshot)
     app.router.add_get(
         "/ws/notifications",
         functools.partial(pubsub_handler, app.topic_notifications),  # type: ignore
@@ -365,14 +369,30 @@ async def create_app(
             while (await ch.wait_message()):
                 app.topic_notifications.publish(["merge-proposal", await ch.get_json()])
 
-        app['runner_status'] = None
+        def active_ids(status):
+            return {js['id'] for js in status['processing']}
 
         async def listen_to_queue(app):
             ch = (await app['redis'].subscribe('queue'))[0]
             while (await ch.wait_message()):
                 msg = await ch.get_json()
-                app['runner_status'] = msg
-                app.topic_notifications.publish(["queue", msg])
+                if 'delta' in msg:
+                    if app['runner_status'] is None:
+                        # Wait for the next full snapshot
+                        continue
+                    app['runner_status'] = apply_queue_delta(
+                        app['runner_status'], msg)
+                    if app['runner_status'] is not None:
+                        app.topic_notifications.publish(["queue-delta", msg])
+                else:
+                    # Subscribers apply the deltas themselves, so they only
+                    # need the full snapshot if they have fallen out of sync.
+                    resync = (
+                        app['runner_status'] is None
+                        or active_ids(app['runner_status']) != active_ids(msg))
+                    app['runner_status'] = msg
+                    if resync:
+                        app.topic_notifications.publish(["queue", msg])
 
         async def listen_to_result(app):
             ch = (await app['redis'].subscribe('result'))[0]
@@ -528,6 +548,14 @@ async def create_app(
     app.add_subapp(
         "/cupboard/stats", stats_app(app['pool'], config, app['external_url']))
 
+    # The API shares the log file manager, and thus the log cache.
+    app.logfile_manager = get_log_manager(
+        config.logs_location, trace_configs=trace_configs)
+    if log_cache_directory:
+        app.logfile_manager = CachingLogFileManager(
+            app.logfile_manager, log_cache_directory,
+            max_size=log_cache_size, ttl=log_cache_ttl)
+
     app.add_subapp(
         "/api",
         create_api_app(
@@ -541,6 +569,7 @@ async def create_app(
                 app['external_url'].join(URL("api")) if app['external_url'] else None
             ),
             trace_configs=trace_configs,
+            logfile_manager=app.logfile_manager,
         ),
     )
     import aiohttp_apispec
@@ -551,10 +580,6 @@ async def create_app(
         # install aiohttp_debugtoolbar
         aiohttp_debugtoolbar.setup(app, hosts=debugtoolbar)
 
-    async def setup_logfile_manager(app):
-        app.logfile_manager = get_log_manager(config.logs_location, trace_configs=trace_configs)
-
-    app.on_startup.append(setup_logfile_manager)
     return private_app, app
 
 
@@ -608,6 +633,15 @@ async def main(argv=None):
     )
     parser.add_argument("--gcp-logging", action='store_true', help='Use Google cloud logging.')
     parser.add_argument("--external-url", type=str, default=None, help="External URL")
+    parser.add_argument(
+        "--log-cache-directory", type=str, default=None,
+        help="Directory to cache retrieved logs in.")
+    parser.add_argument(
+        "--log-cache-size", type=int, default=DEFAULT_LOG_CACHE_SIZE // (1024 * 1024),
+        help="Maximum size of the log cache (MiB).")
+    parser.add_argument(
+        "--log-cache-ttl", type=int, default=DEFAULT_LOG_CACHE_TTL,
+        help="Maximum age of cached logs (seconds).")
 
     args = parser.parse_args()
 
@@ -632,7 +666,10 @@ async def main(argv=None):
         vcs_managers=get_vcs_managers_from_config(config),
         differ_url=args.differ_url,
         listen_address=args.host,
-        port=args.port)
+        port=args.port,
+        log_cache_directory=args.log_cache_directory,
+        log_cache_size=args.log_cache_size * 1024 * 1024,
+        log_cache_ttl=args.log_cache_ttl)
 
     private_runner = web.AppRunner(private_app)
     public_runner = web.AppRunner(public_app)
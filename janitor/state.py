@@ -21,7 +21,7 @@ import json
 import asyncpg
 import asyncpg.pool
 import logging
-from typing import Optional, Tuple, List, Any
+from typing import Dict, Optional, Tuple, List, Any
 
 from breezy import urlutils
 
@@ -237,6 +237,41 @@ WHERE NOT package.removed AND package.name = $1
     ]
 
 
+async def get_artifact_manifest(
+    conn: asyncpg.Connection, run_id: str
+) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Retrieve the recorded artifacts of a run.
+
+    Returns:
+      dictionary mapping artifact names to their size and sha256, or None
+      if no artifacts were recorded for the run
+    """
+    rows = await conn.fetch(
+        "SELECT name, size, sha256 FROM artifact WHERE run_id = $1", run_id)
+    if not rows:
+        return None
+    return {
+        row['name']: {"size": row['size'], "sha256": row['sha256']}
+        for row in rows}
+
+
+async def get_artifact_run_ids(
+    conn: asyncpg.Connection, backup: Optional[bool] = None
+) -> List[str]:
+    """Retrieve the ids of runs with recorded artifacts.
+
+    Args:
+      backup: If not None, only return runs whose artifacts are (or are
+        not) in the backup artifact store
+    """
+    query = "SELECT DISTINCT run_id FROM artifact"
+    args = []
+    if backup is not None:
+        query += " WHERE backup = $1"
+        args.append(backup)
+    return [row['run_id'] for row in await conn.fetch(query, *args)]
+
+
 async def has_cotenants(
     conn: asyncpg.Connection, package: str, url: str
 ) -> Optional[bool]:
@@ -20,8 +20,17 @@ import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
-from janitor.artifacts import LocalArtifactManager, ArtifactManager, ArtifactsMissing
+from janitor import artifacts
+from janitor.artifacts import (
+    BLOB_PREFIX,
+    LocalArtifactManager,
+    ArtifactManager,
+    ArtifactsMissing,
+    store_artifacts_with_backup,
+    upload_backup_artifacts,
+)
 
 
 class ArtifactManagerTests:
@@ -51,6 +60,31 @@ class ArtifactManagerTests:
         with tempfile.TemporaryDirectory() as td:
             self.assertRaises(ArtifactsMissing, loop.run_until_complete, self.manager.retrieve_artifacts('some-run-id', td))
 
+    def test_artifact_paths(self):
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            for name in ['a.deb', 'b.dsc']:
+                with open(os.path.join(td, name), 'w') as f:
+                    f.write(name)
+            loop.run_until_complete(self.manager.store_artifacts('some-run-id', td))
+
+        async def get_paths():
+            async with self.manager.artifact_paths(
+                    'some-run-id', filter_fn=lambda n: n.endswith('.deb')) as paths:
+                self.assertEqual(['a.deb'], [name for (name, path) in paths])
+                self.assertEqual('a.deb', os.path.basename(paths[0][1]))
+                with open(paths[0][1]) as f:
+                    self.assertEqual('a.deb', f.read())
+        loop.run_until_complete(get_paths())
+
+    def test_artifact_paths_nonexistent(self):
+        loop = asyncio.get_event_loop()
+
+        async def get_paths():
+            async with self.manager.artifact_paths('some-run-id'):
+                pass
+        self.assertRaises(ArtifactsMissing, loop.run_until_complete, get_paths())
+
 
 class LocalArtifactManagerTests(ArtifactManagerTests, unittest.TestCase):
 
@@ -59,3 +93,156 @@ class LocalArtifactManagerTests(ArtifactManagerTests, unittest.TestCase):
         self.path = tempfile.mkdtemp()
         self.addCleanup(shutil.rmtree, self.path)
         self.manager = LocalArtifactManager(self.path)
+
+    def test_retrieve_is_not_linked(self):
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            loop.run_until_complete(self.manager.store_artifacts('some-run-id', td))
+        with tempfile.TemporaryDirectory() as td:
+            loop.run_until_complete(self.manager.retrieve_artifacts('some-run-id', td))
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('modified')
+        with loop.run_until_complete(self.manager.get_artifact('some-run-id', 'somefile')) as f:
+            self.assertEqual(b'lalala', f.read())
+
+
+class ContentAddressedLocalArtifactManagerTests(ArtifactManagerTests, unittest.TestCase):
+
+    def setUp(self):
+        super(ContentAddressedLocalArtifactManagerTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.manager = LocalArtifactManager(self.path, content_addressed=True)
+
+    def test_deduplicated(self):
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            loop.run_until_complete(self.manager.store_artifacts('run-1', td))
+            loop.run_until_complete(self.manager.store_artifacts('run-2', td))
+        blobs = [
+            name for (dirpath, dirnames, filenames) in os.walk(
+                os.path.join(self.path, BLOB_PREFIX))
+            for name in filenames]
+        self.assertEqual(1, len(blobs))
+        self.assertEqual(
+            ['run-1', 'run-2'],
+            sorted(loop.run_until_complete(self._ids())))
+        with loop.run_until_complete(self.manager.get_artifact('run-2', 'somefile')) as f:
+            self.assertEqual(b'lalala', f.read())
+
+    def test_plain_layout_readable(self):
+        loop = asyncio.get_event_loop()
+        plain = LocalArtifactManager(self.path)
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            loop.run_until_complete(plain.store_artifacts('some-run-id', td))
+        with loop.run_until_complete(self.manager.get_artifact('some-run-id', 'somefile')) as f:
+            self.assertEqual(b'lalala', f.read())
+
+    async def _ids(self):
+        return [id async for id in self.manager.iter_ids()]
+
+
+class StoreArtifactsWithBackupTests(unittest.TestCase):
+
+    def test_manifest(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        manager = LocalArtifactManager(path)
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            manifest, backup = loop.run_until_complete(
+                store_artifacts_with_backup(
+                    manager, None, td, 'some-run-id', None))
+        self.assertFalse(backup)
+        self.assertEqual({
+            'somefile': {
+                'size': 6,
+                'sha256': '3f29e1b2b05f8371595dc761fed8e8b37544b38d56dfce81a551b46c82f2f56b',
+            }}, manifest)
+
+    def test_content_addressed_hashed_once(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        manager = LocalArtifactManager(path, content_addressed=True)
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            with mock.patch.object(
+                    artifacts, '_hash_file',
+                    wraps=artifacts._hash_file) as hash_file:
+                manifest, backup = loop.run_until_complete(
+                    store_artifacts_with_backup(
+                        manager, None, td, 'some-run-id', None))
+        self.assertEqual(1, hash_file.call_count)
+        self.assertEqual(6, manifest['somefile']['size'])
+
+    def test_backup(self):
+        class BrokenArtifactManager(ArtifactManager):
+            async def store_artifacts(self, run_id, local_path, names=None):
+                raise ConnectionError('unable to connect')
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        backup_manager = LocalArtifactManager(path)
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            manifest, backup = loop.run_until_complete(
+                store_artifacts_with_backup(
+                    BrokenArtifactManager(), backup_manager, td,
+                    'some-run-id', None))
+        self.assertTrue(backup)
+        self.assertEqual(['somefile'], list(manifest))
+        self.assertEqual(
+            ['somefile'], os.listdir(os.path.join(path, 'some-run-id')))
+
+
+class UploadBackupArtifactsTests(unittest.TestCase):
+
+    def setUp(self):
+        super(UploadBackupArtifactsTests, self).setUp()
+        self.backup_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup_path)
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.manager = LocalArtifactManager(self.path)
+
+    def store_backup(self, backup_manager, run_id):
+        with tempfile.TemporaryDirectory() as td:
+            with open(os.path.join(td, 'somefile'), 'w') as f:
+                f.write('lalala')
+            asyncio.get_event_loop().run_until_complete(
+                backup_manager.store_artifacts(run_id, td))
+
+    def test_upload(self):
+        backup_manager = LocalArtifactManager(self.backup_path)
+        self.store_backup(backup_manager, 'run-1')
+        asyncio.get_event_loop().run_until_complete(
+            upload_backup_artifacts(backup_manager, self.manager))
+        self.assertEqual(
+            ['somefile'], os.listdir(os.path.join(self.path, 'run-1')))
+        self.assertEqual([], os.listdir(self.backup_path))
+
+    def test_missing(self):
+        class StaleArtifactManager(LocalArtifactManager):
+            async def iter_ids(self):
+                yield 'run-0'
+                async for run_id in super(
+                        StaleArtifactManager, self).iter_ids():
+                    yield run_id
+
+        backup_manager = StaleArtifactManager(self.backup_path)
+        self.store_backup(backup_manager, 'run-1')
+        asyncio.get_event_loop().run_until_complete(
+            upload_backup_artifacts(backup_manager, self.manager))
+        self.assertEqual(['run-1'], os.listdir(self.path))
@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from janitor.logs import (
+    CachingLogFileManager,
+    FileSystemLogFileManager,
+    LogFileManager,
+)
+
+
+# Large enough to span several blocks in a seekable log.
+LOG_LINES = [b"line %d\n" % i for i in range(1, 20001)]
+
+
+class LogFileManagerTests:
+
+    manager: LogFileManager
+
+    def run_async(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def import_log(self, lines=LOG_LINES, name='build.log'):
+        with tempfile.TemporaryDirectory() as td:
+            path = os.path.join(td, name)
+            with open(path, 'wb') as f:
+                f.writelines(lines)
+            self.run_async(self.manager.import_log('pkg', 'run-id', path))
+
+    async def _read(self, name='build.log', chunk_size=1024):
+        return [chunk async for chunk in self.manager.iter_log(
+            'pkg', 'run-id', name, chunk_size=chunk_size)]
+
+    def test_iter_log(self):
+        self.import_log()
+        chunks = self.run_async(self._read())
+        self.assertEqual(b''.join(LOG_LINES), b''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+
+    def test_iter_log_nonexistent(self):
+        self.assertRaises(
+            FileNotFoundError, self.run_async, self._read('missing.log'))
+
+    def test_has_log(self):
+        self.import_log()
+        self.assertTrue(
+            self.run_async(self.manager.has_log('pkg', 'run-id', 'build.log')))
+        self.assertFalse(
+            self.run_async(self.manager.has_log('pkg', 'run-id', 'dist.log')))
+
+    def test_get_log_lines(self):
+        self.import_log()
+        self.assertEqual(
+            LOG_LINES[9:20], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', 10, 20)))
+
+    def test_get_log_lines_to_end(self):
+        self.import_log()
+        self.assertEqual(
+            LOG_LINES[-10:], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', len(LOG_LINES) - 9)))
+
+    def test_get_log_lines_out_of_range(self):
+        self.import_log()
+        self.assertEqual(
+            [], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', 30000, 30010)))
+        self.assertEqual(
+            LOG_LINES[-5:], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', len(LOG_LINES) - 4, 30010)))
+
+    def test_get_log_lines_no_trailing_newline(self):
+        self.import_log([b"a\n", b"b"])
+        self.assertEqual(
+            [b"a\n", b"b"], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log')))
+
+    def test_get_log_lines_nonexistent(self):
+        self.assertRaises(
+            FileNotFoundError, self.run_async,
+            self.manager.get_log_lines('pkg', 'run-id', 'missing.log'))
+
+    def test_get_log_tail(self):
+        self.import_log()
+        self.assertEqual(
+            (len(LOG_LINES), LOG_LINES[-15:]), self.run_async(
+                self.manager.get_log_tail('pkg', 'run-id', 'build.log', 15)))
+
+    def test_get_log_tail_short(self):
+        self.import_log(LOG_LINES[:3])
+        self.assertEqual(
+            (3, LOG_LINES[:3]), self.run_async(
+                self.manager.get_log_tail('pkg', 'run-id', 'build.log', 15)))
+
+    def test_get_log_tail_empty(self):
+        self.import_log([])
+        self.assertEqual(
+            (0, []), self.run_async(
+                self.manager.get_log_tail('pkg', 'run-id', 'build.log', 15)))
+
+
+class FileSystemLogFileManagerTests(LogFileManagerTests, unittest.TestCase):
+
+    def setUp(self):
+        super(FileSystemLogFileManagerTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.manager = FileSystemLogFileManager(self.path)
+
+    def test_iter_logs(self):
+        self.import_log()
+
+        async def iter_logs():
+            return [entry async for entry in self.manager.iter_logs()]
+        self.assertEqual(
+            [('pkg', 'run-id', ['build.log.gz'])], self.run_async(iter_logs()))
+
+    def test_delete_log(self):
+        self.import_log()
+        self.run_async(self.manager.delete_log('pkg', 'run-id', 'build.log'))
+        self.assertFalse(
+            self.run_async(self.manager.has_log('pkg', 'run-id', 'build.log')))
+
+
+class SeekableFileSystemLogFileManagerTests(
+        LogFileManagerTests, unittest.TestCase):
+
+    def setUp(self):
+        super(SeekableFileSystemLogFileManagerTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.manager = FileSystemLogFileManager(self.path, seekable=True)
+        self.ranges = []
+        get_range = self.manager._get_range
+
+        async def _get_range(pkg, run_id, name, offset, length, timeout=None):
+            self.ranges.append((offset, length))
+            return await get_range(
+                pkg, run_id, name, offset, length, timeout=timeout)
+        self.manager._get_range = _get_range
+
+    def get_index(self):
+        with open(os.path.join(
+                self.path, 'pkg', 'run-id', 'build.log.gz.idx')) as f:
+            return json.load(f)
+
+    def test_index(self):
+        self.import_log()
+        index = self.get_index()
+        self.assertEqual(len(LOG_LINES), index['lines'])
+        self.assertGreater(len(index['blocks']), 2)
+        # Blocks are contiguous and start on line boundaries.
+        with open(os.path.join(
+                self.path, 'pkg', 'run-id', 'build.log.gz'), 'rb') as f:
+            data = f.read()
+        offset = 0
+        lineno = 1
+        for (block_offset, length, first_line, nlines) in index['blocks']:
+            self.assertEqual(offset, block_offset)
+            self.assertEqual(lineno, first_line)
+            self.assertEqual(
+                b''.join(LOG_LINES[first_line - 1:first_line - 1 + nlines]),
+                gzip.decompress(data[offset:offset + length]))
+            offset += length
+            lineno += nlines
+        self.assertEqual(len(data), offset)
+        self.assertEqual(len(LOG_LINES) + 1, lineno)
+
+    def test_readable_as_gzip(self):
+        self.import_log()
+        with gzip.open(os.path.join(
+                self.path, 'pkg', 'run-id', 'build.log.gz')) as f:
+            self.assertEqual(b''.join(LOG_LINES), f.read())
+
+    def test_get_log_lines_reads_range(self):
+        self.import_log()
+        self.assertEqual(
+            LOG_LINES[9:20], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', 10, 20)))
+        self.assertEqual(1, len(self.ranges))
+        (offset, length) = self.ranges[0]
+        self.assertEqual(0, offset)
+        self.assertEqual(self.get_index()['blocks'][0][1], length)
+
+    def test_get_log_lines_across_blocks(self):
+        self.import_log()
+        blocks = self.get_index()['blocks']
+        boundary = blocks[1][2]
+        self.assertEqual(
+            LOG_LINES[boundary - 3:boundary + 2],
+            self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', boundary - 2, boundary + 2)))
+        self.assertEqual(
+            [(blocks[0][0], blocks[0][1] + blocks[1][1])], self.ranges)
+
+    def test_get_log_tail_reads_range(self):
+        self.import_log()
+        self.run_async(
+            self.manager.get_log_tail('pkg', 'run-id', 'build.log', 15))
+        last_block = self.get_index()['blocks'][-1]
+        self.assertEqual([(last_block[0], last_block[1])], self.ranges)
+
+    def test_iter_logs(self):
+        self.import_log()
+
+        async def iter_logs():
+            return [entry async for entry in self.manager.iter_logs()]
+        self.assertEqual(
+            [('pkg', 'run-id', ['build.log.gz'])], self.run_async(iter_logs()))
+
+    def test_delete_log(self):
+        self.import_log()
+        self.run_async(self.manager.delete_log('pkg', 'run-id', 'build.log'))
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.path, 'pkg', 'run-id')))
+
+
+class CountingLogFileManager(FileSystemLogFileManager):
+
+    def __init__(self, log_directory, seekable=False):
+        super(CountingLogFileManager, self).__init__(
+            log_directory, seekable=seekable)
+        self.fetched = []
+
+    async def iter_log(self, pkg, run_id, name, chunk_size=1024,
+                       timeout=None):
+        self.fetched.append(name)
+        async for chunk in super(CountingLogFileManager, self).iter_log(
+                pkg, run_id, name, chunk_size=chunk_size):
+            # Give concurrent readers a chance to run.
+            await asyncio.sleep(0)
+            yield chunk
+
+
+class CachingLogFileManagerTests(LogFileManagerTests, unittest.TestCase):
+
+    seekable = False
+
+    def setUp(self):
+        super(CachingLogFileManagerTests, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.inner = CountingLogFileManager(
+            os.path.join(self.path, 'logs'), seekable=self.seekable)
+        self.manager = CachingLogFileManager(
+            self.inner, os.path.join(self.path, 'cache'))
+
+    def cache_files(self):
+        return os.listdir(os.path.join(self.path, 'cache'))
+
+    def test_cached(self):
+        self.import_log()
+        self.run_async(self._read())
+        self.run_async(self._read())
+        self.assertEqual(['build.log'], self.inner.fetched)
+        self.assertEqual(1, len(self.cache_files()))
+
+    def test_single_download(self):
+        self.import_log()
+
+        async def read_concurrently():
+            return await asyncio.gather(self._read(), self._read())
+        first, second = self.run_async(read_concurrently())
+        self.assertEqual(b''.join(LOG_LINES), b''.join(first))
+        self.assertEqual(b''.join(LOG_LINES), b''.join(second))
+        self.assertEqual(['build.log'], self.inner.fetched)
+
+    def test_nonexistent_not_cached(self):
+        self.assertRaises(
+            FileNotFoundError, self.run_async, self._read('missing.log'))
+        self.assertEqual([], self.cache_files())
+
+    def test_evicts_least_recently_used(self):
+        self.import_log(name='a.log')
+        self.import_log(name='b.log')
+        self.import_log(name='c.log')
+        self.manager.max_size = 2 * len(b''.join(LOG_LINES))
+        self.run_async(self._read('a.log'))
+        self.run_async(self._read('b.log'))
+        self.run_async(self._read('a.log'))
+        self.run_async(self._read('c.log'))
+        self.assertEqual(2, len(self.cache_files()))
+        self.inner.fetched = []
+        self.run_async(self._read('a.log'))
+        self.run_async(self._read('c.log'))
+        self.assertEqual([], self.inner.fetched)
+        self.run_async(self._read('b.log'))
+        self.assertEqual(['b.log'], self.inner.fetched)
+
+    def test_pinned_not_evicted(self):
+        self.import_log(name='a.log')
+        self.import_log(name='b.log')
+        self.manager.max_size = len(b''.join(LOG_LINES))
+
+        async def read_concurrently():
+            return await asyncio.gather(
+                self._read('a.log'), self._read('b.log'))
+        first, second = self.run_async(read_concurrently())
+        self.assertEqual(b''.join(LOG_LINES), b''.join(first))
+        self.assertEqual(b''.join(LOG_LINES), b''.join(second))
+        self.assertEqual({}, self.manager._pins)
+
+    def test_expired(self):
+        self.import_log()
+        self.manager.ttl = 0
+        self.run_async(self._read())
+        self.run_async(self._read())
+        self.assertEqual(['build.log', 'build.log'], self.inner.fetched)
+
+    def test_load_existing(self):
+        self.import_log()
+        self.run_async(self._read())
+        manager = CachingLogFileManager(
+            self.inner, os.path.join(self.path, 'cache'))
+        self.assertEqual(1, len(manager._entries))
+
+    def test_delete_log(self):
+        self.import_log()
+        self.run_async(self._read())
+        self.run_async(self.manager.delete_log('pkg', 'run-id', 'build.log'))
+        self.assertEqual([], self.cache_files())
+        self.assertFalse(
+            self.run_async(self.manager.has_log('pkg', 'run-id', 'build.log')))
+
+
+class SeekableCachingLogFileManagerTests(CachingLogFileManagerTests):
+
+    seekable = True
+
+    def test_get_log_lines_not_cached(self):
+        self.import_log()
+        self.assertEqual(
+            LOG_LINES[9:20], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', 10, 20)))
+        self.assertEqual([], self.inner.fetched)
+        self.assertEqual([], self.cache_files())
+
+    def test_get_log_lines_cached(self):
+        self.import_log()
+        self.run_async(self._read())
+        os.unlink(os.path.join(
+            self.path, 'logs', 'pkg', 'run-id', 'build.log.gz'))
+        self.assertEqual(
+            LOG_LINES[9:20], self.run_async(self.manager.get_log_lines(
+                'pkg', 'run-id', 'build.log', 10, 20)))
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+from io import StringIO
+import json
+import sys
+import unittest
+from unittest import mock
+
+from janitor import publish_one
+from janitor.publish import (
+    PublishWorkerError,
+    PublishWorkerPool,
+)
+
+
+# Runs the real serve() loop, with a handle_request that is driven by the
+# request contents.
+STUB_WORKER = """
+import os
+import sys
+import time
+
+from janitor import publish_one
+
+
+def handle_request(template_env, request, **kwargs):
+    if request.get("exit"):
+        os._exit(1)
+    if request.get("fail"):
+        raise Exception("failed")
+    if request.get("big"):
+        return 0, {"data": "x" * (2 * 1024 * 1024)}
+    if request.get("sleep"):
+        time.sleep(request["sleep"])
+    return 0, {"echo": request, "pid": os.getpid()}
+
+
+publish_one.handle_request = handle_request
+publish_one.serve(None, sys.stdin, sys.stdout)
+"""
+
+
+def stub_handle_request(template_env, request, **kwargs):
+    if request.get("fail"):
+        raise Exception("failed")
+    return 0, {"echo": request}
+
+
+class ServeTests(unittest.TestCase):
+
+    def serve(self, *requests):
+        responses = StringIO()
+        with mock.patch.object(
+                publish_one, "handle_request", stub_handle_request):
+            publish_one.serve(
+                None, StringIO("".join(json.dumps(r) + "\n" for r in requests)),
+                responses)
+        return [json.loads(line) for line in responses.getvalue().splitlines()]
+
+    def test_responses(self):
+        responses = self.serve({"log_id": "a"}, {"log_id": "b"})
+        self.assertEqual(
+            [(0, {"echo": {"log_id": "a"}}), (0, {"echo": {"log_id": "b"}})],
+            [(r["status"], r["response"]) for r in responses])
+        for r in responses:
+            self.assertIsInstance(r["maxrss"], int)
+
+    def test_error(self):
+        [error, ok] = self.serve({"log_id": "a", "fail": True}, {"log_id": "b"})
+        self.assertEqual(1, error["status"])
+        self.assertEqual(
+            "publisher-invalid-response", error["response"]["code"])
+        self.assertEqual((0, {"echo": {"log_id": "b"}}), (ok["status"], ok["response"]))
+
+
+class StubPublishWorkerPool(PublishWorkerPool):
+
+    def _worker_args(self):
+        return [sys.executable, "-c", STUB_WORKER]
+
+
+class PublishWorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_pool(self, fn, **kwargs):
+        async def run():
+            pool = StubPublishWorkerPool(size=1, **kwargs)
+            try:
+                return await fn(pool)
+            finally:
+                await pool.close()
+        return self.loop.run_until_complete(run())
+
+    def test_request(self):
+        async def fn(pool):
+            status, response = await pool.request({"log_id": "a"})
+            self.assertEqual(0, status)
+            self.assertEqual({"log_id": "a"}, response["echo"])
+            status, response2 = await pool.request({"log_id": "b"})
+            # The worker is reused
+            self.assertEqual(response["pid"], response2["pid"])
+        self.run_pool(fn)
+
+    def test_max_jobs(self):
+        async def fn(pool):
+            status, response = await pool.request({"log_id": "a"})
+            self.assertEqual([], pool._idle)
+            status, response2 = await pool.request({"log_id": "b"})
+            self.assertNotEqual(response["pid"], response2["pid"])
+        self.run_pool(fn, max_jobs=1)
+
+    def test_handler_error(self):
+        async def fn(pool):
+            status, response = await pool.request({"fail": True})
+            self.assertEqual(1, status)
+            self.assertEqual("publisher-invalid-response", response["code"])
+            self.assertEqual(1, len(pool._idle))
+        self.run_pool(fn)
+
+    def test_worker_exit(self):
+        async def fn(pool):
+            with self.assertRaises(PublishWorkerError):
+                await pool.request({"exit": True})
+            # A new worker is started for the next request
+            status, response = await pool.request({"log_id": "a"})
+            self.assertEqual(0, status)
+        self.run_pool(fn)
+
+    def test_worker_killed(self):
+        async def fn(pool):
+            await pool.request({"log_id": "a"})
+            [(p, jobs)] = pool._idle
+            p.kill()
+            with self.assertRaises(PublishWorkerError):
+                await pool.request({"log_id": "b"})
+        self.run_pool(fn)
+
+    def test_response_too_long(self):
+        async def fn(pool):
+            with self.assertRaises(PublishWorkerError):
+                await pool.request({"big": True})
+            self.assertEqual([], pool._idle)
+            status, response = await pool.request({"log_id": "a"})
+            self.assertEqual(0, status)
+        self.run_pool(fn)
+
+    def test_cancelled(self):
+        async def fn(pool):
+            await pool.request({"log_id": "a"})
+            task = asyncio.ensure_future(pool.request({"sleep": 10}))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual([], pool._idle)
+        self.run_pool(fn)
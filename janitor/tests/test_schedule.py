@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# Copyright (C) 2021 Jelmer Vernooij <jelmer@jelmer.uk>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+from datetime import timedelta
+import unittest
+
+from janitor.schedule import (
+    MAX_RUN_STATISTICS_CONTEXTS,
+    RUN_STATISTICS_DECAY,
+    RunStatistics,
+)
+
+
+class FakeDependencyCache(object):
+
+    def __init__(self, available):
+        self.available = available
+
+    async def dep_available(self, conn, campaign, name, **kwargs):
+        return name in self.available
+
+
+class RunStatisticsTests(unittest.TestCase):
+
+    def success_probability(self, stats, context=None, available=()):
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(stats.success_probability(
+            None, context, FakeDependencyCache(available)))
+
+    def test_empty(self):
+        stats = RunStatistics('pkg', 'campaign')
+        self.assertEqual(1.0, self.success_probability(stats))
+        self.assertEqual(1.0, self.success_probability(stats, 'ctx'))
+
+    def test_add_run(self):
+        stats = RunStatistics('pkg', 'campaign')
+        stats.add_run('success', None, 'ctx', None, timedelta(seconds=10))
+        stats.add_run('build-failed', None, None, None, timedelta(seconds=20))
+        self.assertEqual(2, stats.total)
+        self.assertEqual(1, stats.success)
+        self.assertAlmostEqual(1 + RUN_STATISTICS_DECAY, stats.weighted_total)
+        self.assertAlmostEqual(RUN_STATISTICS_DECAY, stats.weighted_success)
+        self.assertEqual(['ctx'], stats.contexts)
+        self.assertEqual(timedelta(seconds=13), stats.mean_duration)
+
+    def test_ignored_result_codes(self):
+        stats = RunStatistics('pkg', 'campaign')
+        stats.add_run('worker-failure', None, 'ctx', None, timedelta(seconds=10))
+        self.assertEqual(0, stats.total)
+        self.assertEqual([], stats.contexts)
+        # The duration is still taken into account.
+        self.assertEqual(timedelta(seconds=10), stats.mean_duration)
+
+    def test_contexts_bounded(self):
+        stats = RunStatistics('pkg', 'campaign')
+        for i in range(MAX_RUN_STATISTICS_CONTEXTS + 5):
+            stats.add_run('build-failed', None, 'ctx%d' % i, None, None)
+        stats.add_run('build-failed', None, 'ctx10', None, None)
+        self.assertEqual(MAX_RUN_STATISTICS_CONTEXTS, len(stats.contexts))
+        self.assertEqual('ctx10', stats.contexts[-1])
+        self.assertNotIn('ctx0', stats.contexts)
+
+    def test_same_context(self):
+        stats = RunStatistics('pkg', 'campaign')
+        stats.add_run('success', None, 'ctx', None, None)
+        self.assertAlmostEqual(
+            self.success_probability(stats, 'other') * 0.1,
+            self.success_probability(stats, 'ctx'))
+        self.assertAlmostEqual(
+            self.success_probability(stats, 'other') * 0.5,
+            self.success_probability(stats, None))
+
+    def test_recent_runs_weigh_more(self):
+        failed_last = RunStatistics('pkg', 'campaign')
+        failed_last.add_run('success', None, None, None, None)
+        failed_last.add_run('build-failed', None, None, None, None)
+        succeeded_last = RunStatistics('pkg', 'campaign')
+        succeeded_last.add_run('build-failed', None, None, None, None)
+        succeeded_last.add_run('success', None, None, None, None)
+        self.assertLess(
+            self.success_probability(failed_last, 'ctx'),
+            self.success_probability(succeeded_last, 'ctx'))
+
+    def test_unsatisfied_dependencies(self):
+        stats = RunStatistics('pkg', 'campaign')
+        stats.add_run(
+            'install-deps-unsatisfied-dependencies', None, 'ctx',
+            {'relations': [[{'name': 'libfoo-dev'}]]}, None)
+        self.assertEqual(0, stats.success)
+        self.assertEqual([], stats.contexts)
+        self.assertEqual(1, len(stats.unsatisfied))
+        # Still unsatisfied, and the same context
+        self.assertAlmostEqual(
+            1 / 11 * 0.1, self.success_probability(stats, 'ctx'))
+        # The dependency has become available since
+        self.assertAlmostEqual(
+            1.0, self.success_probability(
+                stats, 'ctx', available={'libfoo-dev'}))
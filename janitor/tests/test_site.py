@@ -18,6 +18,7 @@
 from datetime import timedelta
 
 from janitor.site import format_duration
+from janitor.site.pubsub import apply_queue_delta
 
 import unittest
 
@@ -29,3 +30,36 @@ class FormatDurationTests(unittest.TestCase):
         self.assertEqual("1h0m", format_duration(timedelta(hours=1)))
         self.assertEqual("1d1h", format_duration(timedelta(days=1, hours=1)))
         self.assertEqual("2w1d", format_duration(timedelta(weeks=2, days=1)))
+
+
+class ApplyQueueDeltaTests(unittest.TestCase):
+    def setUp(self):
+        super(ApplyQueueDeltaTests, self).setUp()
+        self.status = {
+            "processing": [{"id": "a", "keepalive_age": 20, "mia": True}],
+            "avoid_hosts": [],
+            "rate_limit_hosts": {},
+        }
+
+    def test_add(self):
+        status = apply_queue_delta(
+            self.status, {"delta": "add", "run": {"id": "b"}})
+        self.assertEqual(["a", "b"], [js["id"] for js in status["processing"]])
+        self.assertEqual(["a"], [js["id"] for js in self.status["processing"]])
+
+    def test_remove(self):
+        status = apply_queue_delta(self.status, {"delta": "remove", "id": "a"})
+        self.assertEqual([], status["processing"])
+        self.assertEqual([], status["avoid_hosts"])
+
+    def test_keepalive(self):
+        status = apply_queue_delta(self.status, {
+            "delta": "keepalive", "id": "a",
+            "last-keepalive": "2021-01-01T00:00:00"})
+        self.assertEqual([{
+            "id": "a", "keepalive_age": 0, "mia": False,
+            "last-keepalive": "2021-01-01T00:00:00"}], status["processing"])
+
+    def test_unknown(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(apply_queue_delta(self.status, {"delta": "foo"}))
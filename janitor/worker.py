@@ -20,7 +20,6 @@ from datetime import datetime
 import errno
 from functools import partial
 from http.client import IncompleteRead
-from io import BytesIO
 import json
 import logging
 import os
@@ -848,13 +847,17 @@ async def abort_run(
         logging.warning('Result upload for abort failed: %s', e)
 
 
-def handle_sigterm(session, base_url: yarl.URL, workitem, signum):
+def handle_sigterm(session, base_url: yarl.URL, workitem, signum, pending=None):
     logging.warning('Received signal %d, aborting and exiting...', signum)
 
     async def shutdown():
         if workitem:
             await abort_run(
                 session, base_url, workitem['assignment']['id'], workitem['metadata'], "Killed by signal")
+        for assignment in list(pending or []):
+            await abort_run(
+                session, base_url, assignment['id'],
+                {"queue_id": assignment["queue_id"]}, "Killed by signal")
         sys.exit(1)
     loop = asyncio.get_event_loop()
     loop.create_task(shutdown())
@@ -879,8 +882,9 @@ def bundle_results(metadata: Any, directory: Optional[str] = None):
                     if entry.is_file():
                         f = open(entry.path, "rb")
                         es.enter_context(f)
+                        # aiohttp streams file objects in chunks.
                         mpwriter.append(
-                            BytesIO(f.read()),
+                            f,
                             headers=[  # type: ignore
                                 (
                                     "Content-Disposition",
@@ -1154,8 +1158,15 @@ async def get_assignment(
     jenkins_build_url: Optional[str],
     package: Optional[str] = None,
     campaign: Optional[str] = None,
+    count: Optional[int] = None,
 ) -> Any:
+    """Request an assignment from the runner.
+
+    If count is specified, a list with up to count assignments is returned.
+    """
     assign_url = base_url / "active-runs"
+    if count is not None:
+        assign_url = assign_url.with_query({'count': str(count)})
     build_arch = subprocess.check_output(
         ["dpkg-architecture", "-qDEB_BUILD_ARCH"]
     ).decode().strip()
@@ -1322,10 +1333,13 @@ async def handle_health(request):
 
 
 async def handle_log_id(request):
+    # Leased runs that have not been started yet are reported as well, so
+    # that the runner doesn't consider them gone.
+    log_ids = [assignment['id'] for assignment in request.app['pending']]
     assignment = request.app['workitem'].get('assignment')
-    if assignment is None:
-        return web.Response(text='', status=200)
-    return web.Response(text=assignment.get('id', ''), status=200)
+    if assignment is not None:
+        log_ids.insert(0, assignment.get('id', ''))
+    return web.Response(text='\n'.join(log_ids), status=200)
 
 
 async def process_single_item(
@@ -1338,6 +1352,40 @@ async def process_single_item(
         jenkins_build_url=jenkins_build_url,
         package=package, campaign=campaign,
     )
+    await process_assignment(
+        session, base_url, assignment, workitem, prometheus=prometheus,
+        tee=tee)
+
+
+async def process_batch(
+        session, my_url: Optional[yarl.URL], base_url: yarl.URL, node_name, workitem,
+        pending, count: int, jenkins_build_url=None,
+        prometheus: Optional[str] = None, package: Optional[str] = None,
+        campaign: Optional[str] = None, tee: bool = False):
+    """Lease a batch of assignments and process them.
+
+    The assignments are processed one after the other, since processing
+    redirects the output of the whole process.
+    """
+    assignments = await get_assignment(
+        session, my_url, base_url, node_name,
+        jenkins_build_url=jenkins_build_url,
+        package=package, campaign=campaign, count=count,
+    )
+    if not assignments:
+        raise EmptyQueue()
+    logging.info('Leased %d assignments', len(assignments))
+    pending.extend(assignments)
+    while pending:
+        assignment = pending.pop(0)
+        await process_assignment(
+            session, base_url, assignment, workitem, prometheus=prometheus,
+            tee=tee)
+
+
+async def process_assignment(
+        session, base_url: yarl.URL, assignment, workitem,
+        prometheus: Optional[str] = None, tee: bool = False):
     workitem['assignment'] = assignment
 
     logging.debug("Got back assignment: %r", assignment)
@@ -1515,6 +1563,9 @@ async def main(argv=None):
     parser.add_argument(
         "--tee", action="store_true",
         help="Copy work output to standard out, in addition to worker.log")
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Number of assignments to lease from the runner at once")
 
     args = parser.parse_args(argv)
 
@@ -1547,6 +1598,7 @@ async def main(argv=None):
 
     app = web.Application()
     app['workitem'] = {}
+    app['pending'] = []
     app.router.add_get('/', handle_index, name='index')
     app.router.add_get('/assignment', handle_assignment, name='assignment')
     app.router.add_get('/logs/', handle_log_index, name='log-index')
@@ -1627,22 +1679,35 @@ async def main(argv=None):
     async with ClientSession(auth=auth) as session:
         loop.add_signal_handler(
             signal.SIGINT, handle_sigterm, session, base_url,
-            app['workitem'], signal.SIGINT)
+            app['workitem'], signal.SIGINT, app['pending'])
         loop.add_signal_handler(
             signal.SIGTERM, handle_sigterm, session, base_url,
-            app['workitem'], signal.SIGTERM)
+            app['workitem'], signal.SIGTERM, app['pending'])
 
         while True:
             try:
-                await process_single_item(
-                    session, my_url=my_url,
-                    base_url=base_url,
-                    node_name=node_name,
-                    workitem=app['workitem'],
-                    jenkins_build_url=jenkins_build_url,
-                    prometheus=args.prometheus,
-                    package=args.package, campaign=args.campaign,
-                    tee=args.tee)
+                if args.batch_size > 1:
+                    await process_batch(
+                        session, my_url=my_url,
+                        base_url=base_url,
+                        node_name=node_name,
+                        workitem=app['workitem'],
+                        pending=app['pending'],
+                        count=args.batch_size,
+                        jenkins_build_url=jenkins_build_url,
+                        prometheus=args.prometheus,
+                        package=args.package, campaign=args.campaign,
+                        tee=args.tee)
+                else:
+                    await process_single_item(
+                        session, my_url=my_url,
+                        base_url=base_url,
+                        node_name=node_name,
+                        workitem=app['workitem'],
+                        jenkins_build_url=jenkins_build_url,
+                        prometheus=args.prometheus,
+                        package=args.package, campaign=args.campaign,
+                        tee=args.tee)
             except AssignmentFailure as e:
                 logging.fatal("failed to get assignment: %s", e.reason)
                 return 1
@@ -66,6 +66,39 @@ async def pubsub_reader(
         await asyncio.sleep(reconnect_interval)
 
 
+def apply_queue_delta(status, delta):
+    """Apply a queue status delta published by the runner.
+
+    Args:
+      status: Last known queue status
+      delta: Delta message
+    Returns:
+      updated queue status, or None if the delta could not be applied and
+      the caller should wait for the next full snapshot
+    """
+    if delta["delta"] == "add":
+        processing = [
+            js for js in status["processing"]
+            if js["id"] != delta["run"]["id"]]
+        processing.append(delta["run"])
+    elif delta["delta"] == "remove":
+        processing = [
+            js for js in status["processing"] if js["id"] != delta["id"]]
+    elif delta["delta"] == "keepalive":
+        processing = []
+        for js in status["processing"]:
+            if js["id"] == delta["id"]:
+                js = dict(js)
+                js["last-keepalive"] = delta["last-keepalive"]
+                js["keepalive_age"] = 0
+                js["mia"] = False
+            processing.append(js)
+    else:
+        logging.warning("Unknown queue delta: %r", delta)
+        return None
+    return dict(status, processing=processing)
+
+
 class JanitorClient(object):
     """Interface to the public API of the janitor."""
 
@@ -26,7 +26,7 @@ from aiohttp import web
 import pydle
 
 
-from janitor_client import JanitorClient
+from janitor_client import apply_queue_delta, JanitorClient
 from aiohttp_openmetrics import setup_metrics, Counter
 
 
@@ -144,6 +144,11 @@ async def main(args):
                 )
             if msg[0] == "queue":
                 await notifier.set_runner_status(msg[1])
+            if msg[0] == "queue-delta" and notifier._runner_status:
+                # If the delta can't be applied, the status is unknown
+                # until the site sends the next full snapshot.
+                await notifier.set_runner_status(
+                    apply_queue_delta(notifier._runner_status, msg[1]))
             if (
                 msg[0] == "publish"
                 and msg[1]["mode"] == "push"
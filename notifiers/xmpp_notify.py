@@ -25,7 +25,7 @@ from urllib.parse import urljoin
 
 import slixmpp
 
-from janitor_client import JanitorClient
+from janitor_client import apply_queue_delta, JanitorClient
 from aiohttp_openmetrics import setup_metrics, Counter
 
 xmpp_messages_sent = Counter(
@@ -162,6 +162,11 @@ async def main(args):
                 )
             if msg[0] == "queue":
                 await notifier.set_runner_status(msg[1])
+            if msg[0] == "queue-delta" and notifier._runner_status:
+                # If the delta can't be applied, the status is unknown
+                # until the site sends the next full snapshot.
+                await notifier.set_runner_status(
+                    apply_queue_delta(notifier._runner_status, msg[1]))
             if (
                 msg[0] == "publish"
                 and msg[1]["mode"] == "push"
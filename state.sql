@@ -97,6 +97,20 @@ CREATE INDEX ON run (result_code);
 CREATE INDEX ON run (revision);
 CREATE INDEX ON run (main_branch_revision);
 CREATE INDEX ON run (change_set);
+-- Artifacts stored for a run, so that they can be found without listing
+-- the artifact store.
+CREATE TABLE IF NOT EXISTS artifact (
+   run_id text not null references run (id),
+   name text not null,
+   size bigint not null,
+   sha256 text not null,
+   -- Whether the artifacts were stored in the backup artifact store, and
+   -- still need to be uploaded to the main one.
+   backup boolean not null default false,
+   unique(run_id, name)
+);
+CREATE INDEX ON artifact (sha256);
+CREATE INDEX ON artifact (run_id) WHERE backup;
 CREATE TYPE publish_mode AS ENUM('push', 'attempt-push', 'propose', 'build-only', 'push-derived', 'skip', 'bts');
 CREATE TYPE review_policy AS ENUM('not-required', 'required');
 CREATE TABLE IF NOT EXISTS publish (
@@ -144,6 +158,27 @@ CREATE UNIQUE INDEX queue_package_suite_set ON queue(package, suite, coalesce(ch
 CREATE INDEX ON queue (change_set);
 CREATE INDEX ON queue (priority ASC, id ASC);
 CREATE INDEX ON queue (bucket ASC, priority ASC, id ASC);
+-- Statistics about previous runs, used by the scheduler.
+-- These are updated incrementally as runs are stored, and can be
+-- recalculated from the run table with janitor.schedule --refresh-statistics.
+CREATE TABLE IF NOT EXISTS run_statistics (
+   package text not null,
+   campaign suite_name not null,
+   -- Number of runs, excluding transient failures
+   total integer not null default 0,
+   success integer not null default 0,
+   -- Decay-weighted counts, biased towards recent runs
+   weighted_total double precision not null default 0,
+   weighted_success double precision not null default 0,
+   -- Contexts of recent runs
+   contexts text[] not null default '{}',
+   -- Recent runs that failed because of unsatisfied dependencies
+   unsatisfied_dependencies json not null default '[]',
+   -- Moving average of run durations
+   mean_duration interval,
+   foreign key (package) references package(name),
+   unique(package, campaign)
+);
 CREATE TABLE IF NOT EXISTS candidate (
    package text not null,
    suite suite_name not null,
@@ -507,15 +542,34 @@ CREATE TRIGGER expire_site_session_delete_old_rows_trigger
    AFTER INSERT ON site_session
    EXECUTE PROCEDURE expire_site_session_delete_old_rows();
 
-CREATE OR REPLACE VIEW queue_positions AS SELECT
+-- Queue positions are expensive to calculate, so they are materialized and
+-- periodically refreshed by the runner. Queue items that were added since the
+-- last refresh are positioned relative to their predecessor; see
+-- Queue.get_positions.
+-- Older databases have queue_positions as a plain view, which would
+-- otherwise make the CREATE below a no-op.
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM pg_views WHERE viewname = 'queue_positions') THEN
+        DROP VIEW queue_positions;
+    END IF;
+END
+$$;
+CREATE MATERIALIZED VIEW IF NOT EXISTS queue_positions AS SELECT
+    id,
     package,
     suite,
+    bucket,
+    priority,
+    estimated_duration,
     row_number() OVER (ORDER BY bucket ASC, priority ASC, id ASC) AS position,
-    SUM(estimated_duration) OVER (ORDER BY priority ASC, id ASC)
+    SUM(estimated_duration) OVER (ORDER BY bucket ASC, priority ASC, id ASC)
         - coalesce(estimated_duration, interval '0') AS wait_time
 FROM
     queue
 ORDER BY bucket ASC, priority ASC, id ASC;
+CREATE UNIQUE INDEX ON queue_positions (id);
+CREATE INDEX ON queue_positions (bucket, priority, id);
 
 CREATE TABLE result_branch (
  role text not null,
@@ -580,7 +634,6 @@ INNER JOIN change_set ON change_set.id = run.change_set
 WHERE
   result_code = 'success' AND NOT package.removed;
 
-CREATE OR REPLACE VIEW publish_ready AS SELECT * FROM publishable WHERE ARRAY_LENGTH(unpublished_branches, 1) > 0;
 
 CREATE VIEW upstream_branch_urls as (
     select package, result->>'upstream_branch_url' as url from run where suite in ('fresh-snapshots', 'fresh-releases') and result->>'upstream_branch_url' != '')
@@ -662,3 +715,190 @@ CREATE INDEX ON package (vcs_url);
 CREATE INDEX ON package (branch_url);
 CREATE INDEX ON package (maintainer_email);
 CREATE INDEX ON package (uploader_emails);
+
+-- Runs that are ready to be published. Computing this from the publishable
+-- view is expensive, so it is materialized per package/campaign and kept up
+-- to date by triggers on the tables that publishable is derived from.
+-- Older databases have publish_ready as a plain view, which would otherwise
+-- make the CREATE below a no-op. The table is populated further down.
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM pg_views WHERE viewname = 'publish_ready') THEN
+        DROP VIEW publish_ready;
+    END IF;
+END
+$$;
+CREATE TABLE IF NOT EXISTS publish_ready AS
+  SELECT * FROM publishable WHERE ARRAY_LENGTH(unpublished_branches, 1) > 0
+  WITH NO DATA;
+CREATE UNIQUE INDEX ON publish_ready (id);
+CREATE UNIQUE INDEX ON publish_ready (package, suite);
+CREATE INDEX ON publish_ready (suite);
+CREATE INDEX ON publish_ready (change_set);
+CREATE INDEX ON publish_ready (change_set_state);
+CREATE INDEX ON publish_ready (review_status);
+
+CREATE OR REPLACE FUNCTION refresh_publish_ready(_package text, _campaign text)
+  RETURNS void
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    -- Serialise refreshes of the same package/campaign; otherwise a
+    -- concurrent refresh can re-insert the row between this DELETE and
+    -- INSERT, and the INSERT fails on the unique index.
+    PERFORM pg_advisory_xact_lock(
+        hashtext('publish_ready'), hashtext(_package || '/' || _campaign));
+    DELETE FROM publish_ready WHERE package = _package AND suite = _campaign;
+    INSERT INTO publish_ready
+      SELECT * FROM publishable
+      WHERE package = _package AND suite = _campaign
+      AND ARRAY_LENGTH(unpublished_branches, 1) > 0;
+    END;
+$$;
+
+CREATE OR REPLACE FUNCTION refresh_publish_ready(run_id text)
+  RETURNS void
+  LANGUAGE PLPGSQL
+  AS $$
+    DECLARE row RECORD;
+    BEGIN
+
+    SELECT package, suite INTO row FROM run WHERE id = run_id;
+    IF FOUND THEN
+        perform refresh_publish_ready(row.package, row.suite);
+    end if;
+    END;
+$$;
+
+-- Rebuild publish_ready from scratch, e.g. after loading data without
+-- triggers.
+CREATE OR REPLACE FUNCTION refresh_publish_ready()
+  RETURNS void
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    -- Conflicts with the row-level refreshes, so they wait for this one.
+    LOCK TABLE publish_ready IN EXCLUSIVE MODE;
+    DELETE FROM publish_ready;
+    INSERT INTO publish_ready
+      SELECT * FROM publishable WHERE ARRAY_LENGTH(unpublished_branches, 1) > 0;
+    END;
+$$;
+
+-- publish_ready is created empty; populate it when upgrading from the view.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM publish_ready) THEN
+        PERFORM refresh_publish_ready();
+    END IF;
+END
+$$;
+
+-- Runs this after run_refresh_last_run, since triggers fire in name order.
+CREATE OR REPLACE FUNCTION run_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP = 'DELETE' THEN
+      PERFORM refresh_publish_ready(OLD.package, OLD.suite);
+    ELSIF TG_OP = 'UPDATE' THEN
+      PERFORM refresh_publish_ready(NEW.package, NEW.suite);
+      IF OLD.package != NEW.package OR OLD.suite != NEW.suite THEN
+         PERFORM refresh_publish_ready(OLD.package, OLD.suite);
+      END IF;
+    ELSE
+      PERFORM refresh_publish_ready(NEW.package, NEW.suite);
+    END IF;
+
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER run_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON run
+  FOR EACH ROW
+  EXECUTE PROCEDURE run_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION new_result_branch_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP = 'DELETE' THEN
+      PERFORM refresh_publish_ready(OLD.run_id);
+    ELSE
+      PERFORM refresh_publish_ready(NEW.run_id);
+    END IF;
+
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER new_result_branch_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON new_result_branch
+  FOR EACH ROW
+  EXECUTE PROCEDURE new_result_branch_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION policy_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    IF TG_OP = 'DELETE' THEN
+      PERFORM refresh_publish_ready(OLD.package, OLD.suite);
+    ELSE
+      PERFORM refresh_publish_ready(NEW.package, NEW.suite);
+    END IF;
+
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER policy_refresh_publish_ready
+  AFTER INSERT OR UPDATE OR DELETE
+  ON policy
+  FOR EACH ROW
+  EXECUTE PROCEDURE policy_trigger_refresh_publish_ready();
+
+CREATE OR REPLACE FUNCTION package_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    DECLARE row RECORD;
+    BEGIN
+    FOR row IN SELECT campaign FROM last_run WHERE package = NEW.name LOOP
+        PERFORM refresh_publish_ready(NEW.name, row.campaign);
+    END LOOP;
+
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER package_refresh_publish_ready
+  AFTER UPDATE OF removed, maintainer_email
+  ON package
+  FOR EACH ROW
+  EXECUTE PROCEDURE package_trigger_refresh_publish_ready();
+
+-- Change set states are updated by refresh_change_set_state whenever runs
+-- or publishes change; only the state column needs to follow along.
+CREATE OR REPLACE FUNCTION change_set_trigger_refresh_publish_ready()
+  RETURNS TRIGGER
+  LANGUAGE PLPGSQL
+  AS $$
+    BEGIN
+    UPDATE publish_ready SET change_set_state = NEW.state
+      WHERE change_set = NEW.id;
+
+    RETURN NEW;
+    END;
+$$;
+
+CREATE TRIGGER change_set_refresh_publish_ready
+  AFTER UPDATE OF state
+  ON change_set
+  FOR EACH ROW
+  EXECUTE PROCEDURE change_set_trigger_refresh_publish_ready();